@@ -0,0 +1,73 @@
+"""Compares Cart.add_items with the sort-and-merge it replaced.
+
+    python -m benchmarks.cart_merge
+"""
+import random
+import time
+from typing import List
+
+from jetcart.domain.cart import Cart, CartItem
+
+SIZES = (1000, 2000, 5000, 10000)
+REPEAT = 5
+
+
+def sorted_merge(cart: Cart, other_items: List[CartItem]) -> Cart:
+    """The previous Cart.add_items"""
+    all_items = sorted(cart.items + other_items, key=lambda item: item.sku)
+    all_merged_items = []
+    last_item = all_items[0]
+    for an_item in all_items[1:]:
+        if an_item.sku == last_item.sku and an_item.unit_price == last_item.unit_price:
+            last_item = CartItem(
+                sku=last_item.sku,
+                unit_price=last_item.unit_price,
+                quantity=last_item.quantity + an_item.quantity,
+                sales_tax_type=last_item.sales_tax_type,
+                unit_sales_tax=last_item.unit_sales_tax
+            )
+        else:
+            all_merged_items.append(last_item)
+            last_item = an_item
+    all_merged_items.append(last_item)
+    cart.items = all_merged_items
+    return cart
+
+
+def hash_merge(cart: Cart, other_items: List[CartItem]) -> Cart:
+    return cart.add_items(other_items)
+
+
+def random_items(rnd: random.Random, size: int) -> List[CartItem]:
+    return [
+        CartItem(
+            sku=f'sku-{rnd.randrange(size)}',
+            quantity=rnd.randint(1, 5),
+            unit_price=rnd.choice([99.0, 149.0, 199.0])
+        )
+        for _ in range(size)
+    ]
+
+
+def bench(merge, size: int) -> float:
+    """Best time, in ms, to merge ``size`` items into a cart of ``size`` lines"""
+    rnd = random.Random(size)
+    best = float('inf')
+    for _ in range(REPEAT):
+        cart = Cart(items=random_items(rnd, size))
+        other_items = random_items(rnd, size)
+        start = time.perf_counter()
+        merge(cart, other_items)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    print(f"{'lines':>8} {'sorted merge ms':>16} {'hash merge ms':>14} {'speedup':>8}")
+    for size in SIZES:
+        before, after = bench(sorted_merge, size), bench(hash_merge, size)
+        print(f'{size:>8} {before:>16.2f} {after:>14.2f} {before / after:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Per-product CPU cost of turning a stored product into a listing dict,
+through a mongoengine Product document (the previous read path) and
+straight from the projected raw document (catalog.as_listing).
+
+    python -m benchmarks.catalog_listing
+"""
+import time
+
+from bson import ObjectId
+
+from jetcart.domain import catalog
+
+PRODUCTS = 20000
+REPEAT = 5
+
+
+def full_son(i: int) -> dict:
+    return {
+        '_id': ObjectId(),
+        'title': f'Product {i} with a reasonably long marketing title',
+        'description': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 10,
+        'price': 100.0 + i,
+        'mrp': 120.0 + i,
+        'category': f'category-{i % 50}',
+        'attrs': {'color': 'black', 'storage': '128 GB', 'ram': '6 GB', 'brand': 'Acme'},
+        'images': [f'https://img.example.com/{i}/{n}.jpg' for n in range(6)],
+        'sales_tax': 18.0,
+    }
+
+
+def projected_son(son: dict) -> dict:
+    """What the server returns for the listing projection"""
+    projected = {field: son[field] for field in ('_id',) + catalog.LISTING_FIELDS}
+    projected['images'] = son['images'][:1]
+    return projected
+
+
+def bench(convert, sons) -> float:
+    """Best time per product, in microseconds"""
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for son in sons:
+            convert(son)
+        best = min(best, time.perf_counter() - start)
+    return best / len(sons) * 1e6
+
+
+def main():
+    sons = [full_son(i) for i in range(PRODUCTS)]
+    projected = [projected_son(son) for son in sons]
+
+    before = bench(lambda son: catalog.Product._from_son(son).as_dict(), sons)
+    after = bench(catalog.listing_from_son, projected)
+    print(f'Product document + as_dict: {before:8.2f} us/product')
+    print(f'raw projected document:     {after:8.2f} us/product ({before / after:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
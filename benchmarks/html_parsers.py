@@ -0,0 +1,58 @@
+"""Times the extractors of scrapper.extractor on every parser backend
+installed, over the saved pages of test/fixtures, and checks that they all
+extract the same as html5lib.
+
+    python -m benchmarks.html_parsers [--rounds 50]
+"""
+import argparse
+import glob
+import os
+import time
+
+from scrapper import extractor
+
+FIXTURES = os.path.join(os.path.dirname(__file__), os.pardir, 'test', 'fixtures')
+
+
+def extract_all(pages, features):
+    pdp_parser = extractor.FlipkartPDPParser(features)
+    plp_parser = extractor.FlipkartPLPExtractor(features)
+    extracted = []
+    for kind, html in pages:
+        try:
+            extracted.append(pdp_parser.extract(html) if kind == 'pdp' else plp_parser.extract(html))
+        except Exception as err:
+            extracted.append(type(err).__name__)
+    return extracted
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    pages = [('plp', open(os.path.join(FIXTURES, 'plp.html'), encoding='utf-8').read())]
+    pages += [('pdp', open(path, encoding='utf-8').read())
+              for path in sorted(glob.glob(os.path.join(FIXTURES, 'pdp', '*.html')))]
+    size = sum(len(html) for _, html in pages)
+    expected = extract_all(pages, 'html5lib')
+
+    timings = {}
+    for features in extractor.available_parsers():
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            extracted = extract_all(pages, features)
+        timings[features] = (time.perf_counter() - start) / args.rounds / len(pages)
+        assert extracted == expected, f'{features} extracts differently from html5lib'
+
+    print(f'{len(pages)} pages, {size / 1024:.0f} KB, {args.rounds} rounds, same output on every backend')
+    for features, per_page in timings.items():
+        print(f'{features:>12}: {per_page * 1000:7.2f} ms/page   {1 / per_page:7.0f} pages/s   '
+              f'x{timings["html5lib"] / per_page:.1f}')
+    missing = set(extractor.PARSERS) - set(extractor.available_parsers())
+    if missing:
+        print(f'not installed: {", ".join(sorted(missing))}')
+
+
+if __name__ == '__main__':
+    main()
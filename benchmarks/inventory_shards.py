@@ -0,0 +1,67 @@
+"""Blocks of a single hot SKU from many threads, with its stock in one
+Inventory and spread over shards.
+
+    python -m benchmarks.inventory_shards --host mongodb://localhost [--threads 64] [--shards 1 4 16]
+
+Write contention only shows against a real mongod; mongomock serializes
+every write. The scratch ``jetcart_bench`` database is dropped afterwards.
+"""
+import argparse
+import concurrent.futures
+import statistics
+import time
+
+from mongoengine import connect, disconnect
+
+from jetcart.domain import catalog
+
+SKU = 'hot-sku'
+
+
+def run(shards: int, threads: int, blocks: int):
+    catalog.Inventory.objects.delete()
+    catalog.InventoryShard.objects.delete()
+    catalog.BlockedInventory.objects.delete()
+    catalog.Inventory(sku=SKU, quantity=blocks, buyer_limit=10).save()
+    catalog._sharded_inventories.invalidate()
+    catalog.shard_inventory(SKU, shards if shards > 1 else 0)
+
+    def block(_):
+        start = time.perf_counter()
+        try:
+            catalog.block_inventory(SKU, 1)
+            failed = False
+        except catalog.NotEnoughInventory:
+            failed = True
+        return (time.perf_counter() - start) * 1000, failed
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(block, range(blocks)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    print(f'{shards:>3} shard(s): {blocks / elapsed:8.0f} blocks/s   '
+          f'p50 {statistics.median(latencies):6.2f} ms   p99 {latencies[int(len(latencies) * 0.99) - 1]:6.2f} ms   '
+          f'missed {sum(failed for _, failed in results)}   left {catalog.get_inventory_by_id(SKU).quantity}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='mongodb://localhost')
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--blocks', type=int, default=5000)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4, 16])
+    args = parser.parse_args()
+
+    disconnect()
+    connect('jetcart_bench', host=args.host)
+    try:
+        for shards in args.shards:
+            run(shards, args.threads, args.blocks)
+    finally:
+        catalog.Inventory._get_db().client.drop_database('jetcart_bench')
+
+
+if __name__ == '__main__':
+    main()
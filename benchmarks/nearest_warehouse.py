@@ -0,0 +1,52 @@
+"""Compares the nearest warehouse lookups of geo.NearestIndex with computing
+the distance to every warehouse.
+
+    python -m benchmarks.nearest_warehouse
+"""
+import heapq
+import itertools
+import random
+import time
+
+from jetcart import geo
+
+SIZES = (1000, 5000, 20000)
+QUERIES = 1000
+K = 3
+
+
+def random_location(rnd: random.Random):
+    # India, roughly
+    return rnd.uniform(8, 35), rnd.uniform(68, 97)
+
+
+def brute_force(points, lat, lng, k):
+    return heapq.nsmallest(k, ((geo.distance_km(lat, lng, p_lat, p_lng), key) for key, p_lat, p_lng in points))
+
+
+def main():
+    rnd = random.Random(42)
+    for size in SIZES:
+        points = [(f'W{i}', *random_location(rnd)) for i in range(size)]
+        queries = [random_location(rnd) for _ in range(QUERIES)]
+
+        start = time.perf_counter()
+        index = geo.NearestIndex(points)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [[key for _, key in itertools.islice(index.nearest(lat, lng), K)] for lat, lng in queries]
+        indexed = (time.perf_counter() - start) / QUERIES
+
+        start = time.perf_counter()
+        expected = [[key for _, key in brute_force(points, lat, lng, K)] for lat, lng in queries]
+        scanned = (time.perf_counter() - start) / QUERIES
+
+        assert found == expected
+        print(f'{size:>6} warehouses: build {build * 1000:7.1f} ms   '
+              f'nearest {K} {indexed * 1e6:8.1f} us   scan {scanned * 1e6:9.1f} us   '
+              f'x{scanned / indexed:.0f}')
+
+
+if __name__ == '__main__':
+    main()
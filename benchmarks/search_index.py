@@ -0,0 +1,100 @@
+"""Compares the in memory search index with the mongo $text search on a
+generated catalog.
+
+    python -m benchmarks.search_index [--size 500000] [--mongo-host mongodb://localhost]
+
+The mongo side needs a real mongod (mongomock has no text search); the
+corpus is loaded into a scratch ``jetcart_bench`` database which is dropped
+afterwards. Without --mongo-host only the index is measured.
+"""
+import argparse
+import random
+import statistics
+import time
+
+from bson import ObjectId
+
+from jetcart.domain import search
+
+BRANDS = ['acme', 'globex', 'initech', 'umbrella', 'hooli', 'stark', 'wayne', 'wonka', 'tyrell', 'cyberdyne']
+NOUNS = ['phone', 'laptop', 'tablet', 'headphones', 'speaker', 'camera', 'watch', 'charger', 'cable', 'case',
+         'monitor', 'keyboard', 'mouse', 'router', 'printer', 'television', 'projector', 'drone', 'console', 'lamp']
+ADJECTIVES = ['black', 'white', 'red', 'blue', 'wireless', 'smart', 'portable', 'compact', 'pro', 'ultra',
+              'mini', 'max', 'slim', 'rugged', 'gaming', 'premium', 'classic', 'lite', 'plus', 'neo']
+FILLER = ['with', 'long', 'battery', 'life', 'fast', 'charging', 'dual', 'display', 'hd', 'sound', 'warranty',
+          'year', 'edition', 'series', 'original', 'new', 'bundle', 'pack', 'power', 'design']
+QUERIES = ['wireless headphones', 'acme phone', 'smart watch', 'gaming laptop', 'portable speaker',
+           'black case', 'hooli tablet pro', 'usb cable', 'ultra hd television', 'mini drone']
+PREFIX_QUERIES = ['wirel', 'head', 'acme ph', 'smart wa', 'gam', 'televi', 'projec', 'hooli tab']
+
+
+def generate(size: int, seed: int = 42):
+    rnd = random.Random(seed)
+    for i in range(size):
+        noun = rnd.choice(NOUNS)
+        yield dict(
+            _id=ObjectId(),
+            title=' '.join([rnd.choice(BRANDS), *rnd.sample(ADJECTIVES, 2), noun, f'model{rnd.randrange(5000)}']),
+            description=' '.join(rnd.choices(FILLER + ADJECTIVES, k=20)),
+            category=noun,
+            price=float(rnd.randrange(100, 100000)),
+            mrp=float(rnd.randrange(100, 100000)),
+            attrs={'color': rnd.choice(ADJECTIVES[:4]), 'brand': rnd.choice(BRANDS)},
+            images=[f'https://img.example.com/{i}.jpg']
+        )
+
+
+def measure(fn, queries, repeat=5):
+    """Latencies in milliseconds of running every query ``repeat`` times"""
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            fn(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f'{name:<32} p50 {statistics.median(latencies):8.2f} ms   p95 {p95:8.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=500000)
+    parser.add_argument('--mongo-host')
+    args = parser.parse_args()
+
+    corpus = list(generate(args.size))
+
+    start = time.perf_counter()
+    index = search.InvertedIndexSearchBackend.build(corpus)
+    print(f'built index of {len(index)} products in {time.perf_counter() - start:.1f} s')
+
+    report('index', measure(lambda q: index.search({}, q), QUERIES))
+    report('index, prefix', measure(lambda q: index.search({}, q), PREFIX_QUERIES))
+    report('index, category filter', measure(lambda q: index.search({'category': 'phone'}, q), QUERIES))
+
+    if args.mongo_host:
+        from mongoengine import connect, disconnect
+        from jetcart.domain import catalog
+
+        disconnect()
+        connect('jetcart_bench', host=args.mongo_host)
+        collection = catalog.Product._get_collection()
+        collection.drop()
+        try:
+            for offset in range(0, len(corpus), 10000):
+                collection.insert_many(corpus[offset:offset + 10000])
+            catalog.Product.ensure_indexes()
+            mongo = search.MongoTextSearchBackend()
+            report('mongo $text', measure(lambda q: mongo.search({}, q), QUERIES))
+            report('mongo $text, category filter', measure(lambda q: mongo.search({'category': 'phone'}, q), QUERIES))
+        finally:
+            collection.drop()
+
+
+if __name__ == '__main__':
+    main()
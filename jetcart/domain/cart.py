@@ -1,5 +1,5 @@
 import abc
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple
 
 from mongoengine import Document, EmbeddedDocument, StringField, IntField, FloatField, \
     EmbeddedDocumentListField, EmbeddedDocumentField
@@ -24,15 +24,6 @@ class CartItem(EmbeddedDocument):
             unit_sales_tax=self.unit_sales_tax
         )
 
-    def merge(self, other: 'CartItem') -> Union['CartItem', None]:
-        if other.sku == self.sku and other.unit_price == self.unit_price:
-            return CartItem(
-                sku=self.sku,
-                unit_price=self.unit_price,
-                quantity=self.quantity + other.quantity
-            )
-        return None
-
 
 class CartCalculation(EmbeddedDocument):
     total_value = FloatField(required=True)
@@ -52,11 +43,19 @@ class CartCalculation(EmbeddedDocument):
 CART_STATE_CREATED = 0
 CART_STATE_CHECKED_OUT = 2
 
+CART_UPDATE_RETRIES = 5
+
+
+class CartUpdateConflict(Exception):
+    status_code = 409
+
 
 class Cart(Document):
     items = EmbeddedDocumentListField(document_type=CartItem, required=True)
     value = EmbeddedDocumentField(document_type=CartCalculation, required=False)
     state = IntField(default=CART_STATE_CREATED)
+    # bumped on every partial update, used for optimistic concurrency control
+    version = IntField(default=0)
 
     def as_dict(self):
         return dict(
@@ -74,29 +73,66 @@ class Cart(Document):
         self.value = calculator_value_calc.calculate(self)
         return self.value
 
-    def add_items(self, other_items: List[CartItem]) -> 'Cart':
-        if not other_items:
-            return self
-        # merge items based on the sku and unit_price/discount
-        all_items = sorted(
-            self.items + other_items,
-            key=lambda item: item.sku
-        )
-
-        if not all_items:
-            return self
+    def calculate_added(self, calculator_value_calc: 'CartValueCalculator',
+                        other_items: List[CartItem]) -> 'CartCalculation':
+        """Adds the value of ``other_items`` to this cart value, pricing only
+        those items. The existing items are priced as well if the cart was
+        never calculated."""
+        if self.value is None:
+            other_items = self.items + other_items
+            self.value = CartCalculation(total_value=0, total_sales_tax=0, total_payable_amount=0)
+        self.value = calculator_value_calc.calculate_added(self.value, other_items)
+        return self.value
 
-        all_merged_items = []
-        last_item = all_items[0]
-        for an_item in all_items[1:]:
-            merged_item = last_item.merge(an_item)
-            if merged_item:
-                last_item = merged_item
+    def plan_additions(self, other_items: List[CartItem]) -> Tuple[Dict[int, int], List[CartItem]]:
+        """Works out how ``other_items`` merge into this cart without changing
+        it: the quantity to add to existing lines, keyed by their position, and
+        the new lines to append (``other_items`` sharing a sku and unit_price
+        are folded into one line)."""
+        positions = {}
+        for position, item in enumerate(self.items):
+            positions.setdefault((item.sku, item.unit_price), position)
+
+        increments, appended = {}, {}
+        for item in other_items:
+            key = (item.sku, item.unit_price)
+            if key in positions:
+                increments[positions[key]] = increments.get(positions[key], 0) + item.quantity
+            elif key in appended:
+                appended[key].quantity += item.quantity
             else:
-                all_merged_items.append(last_item)
-                last_item = an_item
-        all_merged_items.append(last_item)
-        self.items = all_merged_items
+                # a copy: the next items with this key are folded into it and
+                # the caller's items must come out of the merge unchanged
+                appended[key] = CartItem(**item.as_dict())
+        return increments, list(appended.values())
+
+    def find_item(self, sku: str, unit_price: float = None) -> int:
+        """Returns the position of the line for ``sku``; ``unit_price`` is only
+        needed when the sku is in the cart at more than one price."""
+        positions = [
+            position
+            for position, item in enumerate(self.items)
+            if item.sku == sku and (unit_price is None or item.unit_price == unit_price)
+        ]
+        if not positions:
+            raise ValueError(f"No item [{sku}] in cart [{self.id}]")
+        if len(positions) > 1 and unit_price is None:
+            raise ValueError(f"Item [{sku}] is in cart [{self.id}] at more than one price, unit_price is required")
+        return positions[0]
+
+    def add_items(self, other_items: List[CartItem]) -> 'Cart':
+        """Merges ``other_items`` into this cart in a single pass; items with
+        the sku and unit_price of an existing line add to its quantity, the
+        others are appended in the order they were given."""
+        increments, appended = self.plan_additions(other_items)
+        self.apply_additions(increments, appended)
+        return self
+
+    def apply_additions(self, increments: Dict[int, int], appended: List[CartItem]) -> 'Cart':
+        """Applies a plan made by ``plan_additions``"""
+        for position, quantity in increments.items():
+            self.items[position].quantity += quantity
+        self.items.extend(appended)
         return self
 
 
@@ -105,21 +141,51 @@ class CartValueCalculator:
     def calculate(self, cart: Cart) -> CartCalculation:
         pass
 
+    @abc.abstractmethod
+    def calculate_added(self, value: CartCalculation, items: List[CartItem]) -> CartCalculation:
+        pass
+
+    @abc.abstractmethod
+    def calculate_changed(self, value: CartCalculation, item: CartItem, quantity_delta: int) -> CartCalculation:
+        pass
+
 
 class SimpleCartValueCalculator(CartValueCalculator):
     def calculate(self, cart: Cart) -> CartCalculation:
-        sku_tax_map = self._build_sku_tax_map(cart.items)
-
-        total_amount, total_sales_tax, total_discounts = 0, 0, 0
-        for item in cart.items:
-            taxes = sku_tax_map.get(item.sku) or []
-            amount = item.unit_price * item.quantity
-            sales_tax = sum(map(lambda tax: tax.get('value', 0) * amount / 100.0, taxes))
-            item.unit_sales_tax = sales_tax / item.quantity
-            item.sales_tax_type = ','.join(map(lambda tax: tax.get('type'), taxes))
-            total_amount += amount
-            total_sales_tax += sales_tax
+        total_amount, total_sales_tax = self._price_items(cart.items)
+        return self._cart_calculation(total_amount, total_sales_tax, 0)
+
+    def calculate_added(self, value: CartCalculation, items: List[CartItem]) -> CartCalculation:
+        amount, sales_tax = self._price_items(items)
+        return self._cart_calculation(
+            value.total_value + amount,
+            value.total_sales_tax + sales_tax,
+            value.total_discount
+        )
+
+    def calculate_changed(self, value: CartCalculation, item: CartItem, quantity_delta: int) -> CartCalculation:
+        # the item was priced when it was added, no need to look its tax up again
+        return self._cart_calculation(
+            value.total_value + item.unit_price * quantity_delta,
+            value.total_sales_tax + item.unit_sales_tax * quantity_delta,
+            value.total_discount
+        )
+
+    def _price_items(self, items: List[CartItem]) -> Tuple[float, float]:
+        """Sets the sales tax of every item and returns their total amount and sales tax"""
+        sku_tax_map = self._build_sku_tax_map(items)
 
+        total_amount, total_sales_tax = 0, 0
+        for item in items:
+            category_tax = sku_tax_map.get(item.sku, tax_service.NO_TAX)
+            item.unit_sales_tax = item.unit_price * category_tax.rate / 100.0
+            item.sales_tax_type = category_tax.type
+            total_amount += item.unit_price * item.quantity
+            total_sales_tax += item.unit_sales_tax * item.quantity
+        return total_amount, total_sales_tax
+
+    @staticmethod
+    def _cart_calculation(total_amount: float, total_sales_tax: float, total_discounts: float) -> CartCalculation:
         return CartCalculation(
             total_value=total_amount,
             total_sales_tax=total_sales_tax,
@@ -131,25 +197,21 @@ class SimpleCartValueCalculator(CartValueCalculator):
         )
 
     @staticmethod
-    def _build_sku_tax_map(items: List[CartItem]):
-        sku_tax = {}
-        for item in items:
-            if item.sku not in sku_tax:
-                inventory = catalog_service.fetch_inventory(item.sku)
-                if inventory and inventory.get('product_id'):
-                    product = catalog_service.fetch_product(inventory.get('product_id'))
-                    if product and product.get('category'):
-                        taxes = tax_service.fetch_tax_by_category(product.get('category'))
-                        if taxes:
-                            sku_tax[item.sku] = taxes
-        return sku_tax
+    def _build_sku_tax_map(items: List[CartItem]) -> Dict[str, tax_service.CategoryTax]:
+        # a fixed number of queries for the whole cart, regardless of its size
+        sku_category = catalog_service.fetch_categories_by_skus(item.sku for item in items)
+        category_taxes = tax_service.fetch_category_taxes(sku_category.values())
+        return {
+            sku: category_taxes[cat]
+            for sku, cat in sku_category.items()
+        }
 
 
 cart_value_calculator = SimpleCartValueCalculator()
 
 
 def create_cart(**kwargs) -> Cart:
-    cart = Cart(items=[
+    cart = Cart(items=[]).add_items([
         CartItem(**item)
         for item in kwargs['items']
     ])
@@ -163,22 +225,112 @@ def get_cart_by_id(cart_id: str) -> Cart:
 
 
 def add_items_to_cart(cart_id: str, items: List[Dict]) -> Cart:
-    cart = get_cart_by_id(cart_id)
-    if not cart:
-        raise ValueError(f"No cart for ID [{cart_id}]")
-
-    if not items:
-        return cart
-
-    new_cart_items = [
-        CartItem(**item)
-        for item in items
-    ]
-    cart.add_items(new_cart_items)
-    cart.calculate(cart_value_calculator)
-    cart.save()
-    return cart
-
-
-def update_cart(cart_id: str, sku: str, quantity: int):
-    pass
+    for _ in range(CART_UPDATE_RETRIES):
+        cart = get_cart_by_id(cart_id)
+        if not cart:
+            raise ValueError(f"No cart for ID [{cart_id}]")
+
+        if not items:
+            return cart
+
+        new_cart_items = [
+            CartItem(**item)
+            for item in items
+        ]
+        if _add_items_atomically(cart, new_cart_items):
+            return cart
+    raise CartUpdateConflict(f"Cart [{cart_id}] was updated concurrently, please retry")
+
+
+def _add_items_atomically(cart: Cart, new_cart_items: List[CartItem]) -> bool:
+    """Writes only the changed lines and the cart value, provided nobody else
+    updated the cart since it was loaded. Returns False on a version conflict."""
+    recalculated = cart.value is None
+    increments, appended = cart.plan_additions(new_cart_items)
+    if recalculated:
+        cart.apply_additions(increments, appended)
+        cart.calculate(cart_value_calculator)
+    else:
+        # existing lines keep the sales tax they were priced with, only new lines are priced
+        for position, quantity in increments.items():
+            cart.value = cart_value_calculator.calculate_changed(cart.value, cart.items[position], quantity)
+        if appended:
+            cart.calculate_added(cart_value_calculator, appended)
+        cart.apply_additions(increments, appended)
+
+    update = {
+        '$inc': {'version': 1},
+        '$set': {'value': cart.value.to_mongo()}
+    }
+    if recalculated or (increments and appended):
+        # every line was repriced, or we'd need to $inc and $push on the same
+        # array in one update, which mongo rejects as a conflict
+        update['$set']['items'] = [item.to_mongo() for item in cart.items]
+    else:
+        for position, quantity in increments.items():
+            update['$inc'][f'items.{position}.quantity'] = quantity
+        if appended:
+            update['$push'] = {'items': {'$each': [item.to_mongo() for item in appended]}}
+
+    updated = Cart.objects(id=cart.id, __raw__=_version_query(cart.version)).update_one(__raw__=update)
+    if updated:
+        cart.version += 1
+    return bool(updated)
+
+
+def _version_query(version: int) -> Dict:
+    if version:
+        return {'version': version}
+    # carts saved before versioning was introduced have no version field
+    return {'version': {'$in': [0, None]}}
+
+
+def update_cart(cart_id: str, sku: str, quantity: int, unit_price: float = None) -> Cart:
+    """Sets the quantity of a cart line, removing it when the quantity is 0"""
+    if quantity < 0:
+        raise ValueError(f"Invalid quantity {quantity}")
+
+    for _ in range(CART_UPDATE_RETRIES):
+        cart = get_cart_by_id(cart_id)
+        if not cart:
+            raise ValueError(f"No cart for ID [{cart_id}]")
+
+        position = cart.find_item(sku, unit_price)
+        if _update_item_atomically(cart, position, quantity):
+            return cart
+    raise CartUpdateConflict(f"Cart [{cart_id}] was updated concurrently, please retry")
+
+
+def _update_item_atomically(cart: Cart, position: int, quantity: int) -> bool:
+    """Same as ``_add_items_atomically``, for a change to a single line"""
+    item = cart.items[position]
+    update = {'$inc': {'version': 1}}
+    if cart.value is None:
+        item.quantity = quantity
+        if not quantity:
+            del cart.items[position]
+        cart.calculate(cart_value_calculator)
+        update['$set'] = {'items': [item.to_mongo() for item in cart.items]}
+    elif quantity:
+        cart.value = cart_value_calculator.calculate_changed(cart.value, item, quantity - item.quantity)
+        item.quantity = quantity
+        update['$set'] = {f'items.{position}.quantity': quantity}
+    else:
+        # $pull removes every line of the sku at that price, which is more than
+        # one only for carts merged before lines were keyed on sku and price
+        key = (item.sku, item.unit_price)
+        kept = []
+        for other in cart.items:
+            if (other.sku, other.unit_price) == key:
+                cart.value = cart_value_calculator.calculate_changed(cart.value, other, -other.quantity)
+            else:
+                kept.append(other)
+        cart.items = kept
+        update['$set'] = {}
+        update['$pull'] = {'items': {'sku': item.sku, 'unit_price': item.unit_price}}
+    update['$set']['value'] = cart.value.to_mongo()
+
+    updated = Cart.objects(id=cart.id, __raw__=_version_query(cart.version)).update_one(__raw__=update)
+    if updated:
+        cart.version += 1
+    return bool(updated)
@@ -1,9 +1,24 @@
+import collections
 import enum
 import json
-from typing import List, Dict
+import logging
+import random
+import re
+from typing import List, Dict, Iterable, Iterator, Tuple, Union, Callable, Optional, TypeVar
 
 import arrow
-from mongoengine import Document, StringField, FloatField, DictField, IntField, ReferenceField, LongField, ListField
+from bson import ObjectId
+from mongoengine import Document, StringField, FloatField, DictField, IntField, ReferenceField, LongField, ListField, \
+    BooleanField, QuerySet
+from pymongo import UpdateOne, InsertOne, ReturnDocument
+from pymongo.client_session import ClientSession
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from jetcart import geo
+from jetcart.cache import LRUCache
+
+T = TypeVar('T')
 
 
 class Product(Document):
@@ -15,13 +30,26 @@ class Product(Document):
     attrs = DictField()
     images = ListField(field=StringField())
     sales_tax = FloatField(required=False, default=18)
+    # key of the product in the system it was ingested from, see upsert_products
+    external_id = StringField()
 
     meta = {
         'indexes': [
+            {
+                'fields': ['external_id'],
+                'unique': True,
+                'sparse': True
+            },
             {
                 'fields': ['$title'],
                 'default_language': 'english'
-            }
+            },
+            # keyset pagination of category browse, see get_products_after
+            ('category', 'id'),
+            # search filters, see FILTERABLE_FIELDS
+            ('category', 'price'),
+            'price',
+            'mrp'
         ]
     }
 
@@ -41,6 +69,46 @@ class Product(Document):
         )
 
 
+# fields of a product shown in listings and search results, see ``as_listing``
+LISTING_FIELDS = ('title', 'price', 'category')
+
+
+def as_listing(products: QuerySet) -> List[Dict]:
+    """Reads ``products`` as listing dicts straight from the raw documents, fetching only those fields"""
+    return [
+        listing_from_son(son)
+        for son in products.only(*LISTING_FIELDS).fields(slice__images=1).as_pymongo()
+    ]
+
+
+def listing_from_son(son: Dict) -> Dict:
+    images = son.get('images')
+    return dict(
+        id=str(son['_id']),
+        title=son.get('title'),
+        price=son.get('price'),
+        category=son.get('category'),
+        image=str(images[0]) if images else None
+    )
+
+
+def product_from_son(son: Dict) -> Dict:
+    """Same as ``Product.as_dict`` for a raw product document"""
+    return dict(
+        id=str(son['_id']),
+        title=son.get('title'),
+        description=son.get('description'),
+        category=son.get('category'),
+        price=son.get('price'),
+        mrp=son.get('mrp'),
+        attrs=son.get('attrs') or {},
+        images=[
+            str(img)
+            for img in son.get('images') or []
+        ]
+    )
+
+
 class Warehouse(Document):
     code = StringField(primary_key=True)
     name = StringField(required=True)
@@ -50,7 +118,44 @@ class Warehouse(Document):
     def as_dict(self):
         return dict(
             code=self.code,
-            name=self.name
+            name=self.name,
+            lat=self.lat,
+            lng=self.lng
+        )
+
+
+class WarehouseInventory(Document):
+    """The stock of a SKU in one warehouse: sellable, held by buyers or sold but not shipped yet"""
+    sku = StringField(required=True)
+    warehouse = StringField(required=True)
+    quantity = IntField(required=True, min_value=0)
+    # the last bulk write of the row, see _set_warehouse_stock
+    write = StringField()
+
+    meta = {
+        'indexes': [
+            {'fields': ('sku', 'warehouse'), 'unique': True}
+        ]
+    }
+
+    def as_dict(self):
+        return dict(
+            sku=self.sku,
+            warehouse_id=self.warehouse,
+            quantity=self.quantity
+        )
+
+
+class PostalCode(Document):
+    code = StringField(primary_key=True)
+    lat = FloatField(required=True)
+    lng = FloatField(required=True)
+
+    def as_dict(self):
+        return dict(
+            code=self.code,
+            lat=self.lat,
+            lng=self.lng
         )
 
 
@@ -60,6 +165,8 @@ class Inventory(Document):
     warehouse = ReferenceField(Warehouse)
     quantity = IntField(required=True, min_value=0)
     buyer_limit = IntField(required=False, min_value=1, default=3)
+    # how many InventoryShard counters hold most of the stock, see shard_inventory
+    shards = IntField(default=0, min_value=0)
 
     def as_dict(self):
         return dict(
@@ -70,9 +177,22 @@ class Inventory(Document):
         )
 
 
+class InventoryShard(Document):
+    """A slice of the stock of a hot SKU, so that concurrent blocks update different documents"""
+    id = StringField(primary_key=True)
+    sku = StringField(required=True)
+    quantity = IntField(required=True, min_value=0)
+
+    meta = {
+        'indexes': ['sku']
+    }
+
+
 class BlockedInventoryState(enum.Enum):
     BLOCKED = "blocked"
     COMMITTED = "committed"
+    EXPIRED = "expired"
+    RELEASED = "released"
 
 
 class BlockedInventory(Document):
@@ -80,14 +200,56 @@ class BlockedInventory(Document):
     quantity = IntField(required=True)
     expiry = LongField(required=True)
     state = StringField(required=True)
+    # marks the holds released by one call of _release_holds
+    release = StringField()
+    reservation = StringField()
+    # the warehouses a committed hold ships from, and the units in none, see _allocate
+    fulfilment = ListField(field=DictField())
+    unallocated = IntField()
+    allocated = BooleanField(default=False)
+
+    meta = {
+        'indexes': [
+            ('state', 'expiry'),
+            {'fields': ['release'], 'sparse': True},
+            {'fields': ['reservation'], 'sparse': True}
+        ]
+    }
+
+
+class Reservation(Document):
+    """The holds of several SKUs made by one ``block_inventories``, committed or released together"""
+    state = StringField(required=True)
+    expiry = LongField(required=True)
+    # units of each SKU sold that no warehouse had, see commit_reservation
+    unallocated = DictField()
+
+    def as_dict(self):
+        return dict(
+            id=str(self.id),
+            state=self.state,
+            expiry=self.expiry,
+            unallocated=self.unallocated
+        )
+
+
+class Lease(Document):
+    """Lets one of several processes run a periodic job, see ``claim_lease``"""
+    name = StringField(primary_key=True)
+    owner = StringField(required=True)
+    expires = LongField(required=True)
 
 
 class NotEnoughInventory(Exception):
-    pass
+    status_code = 409
 
 
 class BlockedInventoryExpired(Exception):
-    pass
+    status_code = 409
+
+
+class ConcurrentUpdate(Exception):
+    status_code = 409
 
 
 def create_product(**kwargs) -> Product:
@@ -96,25 +258,295 @@ def create_product(**kwargs) -> Product:
     return p
 
 
+def upsert_products(products: List[Dict]) -> Dict:
+    """Writes ``products`` in one bulk write, upserting those with an ``external_id`` on it"""
+    errors = []
+    last_rows = {p['external_id']: i for i, p in enumerate(products) if p.get('external_id')}
+    writes, positions, sons = [], [], []
+    for i, product in enumerate(products):
+        external_id = product.get('external_id')
+        if external_id and last_rows[external_id] != i:
+            errors.append((i, f"Duplicate external id [{external_id}], superseded by a later row"))
+            continue
+        son = Product(**product).to_mongo().to_dict()
+        if external_id:
+            writes.append(UpdateOne({'external_id': external_id}, {'$set': son}, upsert=True))
+        else:
+            son['_id'] = ObjectId()
+            writes.append(InsertOne(son))
+        positions.append(i)
+        sons.append(son)
+    if not writes:
+        return dict(inserted=0, upserted=0, modified=0, created=[], updated=[], errors=sorted(errors))
+
+    try:
+        result = Product._get_collection().bulk_write(writes, ordered=False).bulk_api_result
+    except BulkWriteError as error:
+        result = error.details
+    failed = set()
+    for write_error in result.get('writeErrors', []):
+        failed.add(write_error['index'])
+        errors.append((positions[write_error['index']], write_error['errmsg']))
+
+    upserted = {upsert['index'] for upsert in result.get('upserted', [])}
+    external_ids = [
+        son['external_id']
+        for n, son in enumerate(sons)
+        if n not in failed and son.get('external_id')
+    ]
+    stored = {
+        son['external_id']: son
+        for son in Product.objects(external_id__in=external_ids).as_pymongo()
+    } if external_ids else {}
+    created, updated = [], []
+    for n, son in enumerate(sons):
+        if n in failed:
+            continue
+        if son.get('external_id'):
+            son = stored[son['external_id']]
+        (created if n in upserted or not son.get('external_id') else updated).append(son)
+
+    return dict(
+        inserted=result.get('nInserted', 0),
+        upserted=result.get('nUpserted', 0),
+        modified=result.get('nModified', 0),
+        created=created,
+        updated=updated,
+        errors=sorted(errors)
+    )
+
+
 def get_product_by_id(product_id: str) -> Product:
     return Product.objects(id=product_id).first()
 
 
-def get_all_products_by_cat(cat: str, page: int = 0, size: int = 20) -> List[Product]:
-    return Product.objects(category=cat)[page * size:page * size + size]
+def get_products_by_ids(product_ids: Iterable[str], *fields: str) -> List[Product]:
+    products = Product.objects(id__in=list(product_ids))
+    if fields:
+        products = products.only(*fields)
+    return products
+
+
+PRICE_FACET_BOUNDARIES = (0, 500, 1000, 5000, 10000, 50000, 100000)
+
+_ATTR_KEY = re.compile(r'^[A-Za-z0-9]+$')
+
+# The fields search_products can filter on, with the type of their values and
+# the operators allowed on them. Each is the prefix of an index in
+# Product.meta. attrs__<key> equality filters are accepted as well but only
+# narrow down what the other filters matched, see check_filter_plan.
+FILTERABLE_FIELDS = {
+    'category': (str, ('', 'in')),
+    'price': (float, ('', 'gt', 'gte', 'lt', 'lte')),
+    'mrp': (float, ('', 'gt', 'gte', 'lt', 'lte')),
+}
+MAX_IN_VALUES = 100
+
+# Whether filters mongo can only answer with a collection scan are rejected,
+# or just logged
+REJECT_UNINDEXED_FILTERS = True
+
+
+class UnindexedFilter(ValueError):
+    status_code = 400
+
+
+def compile_filters(filters: Union[str, Dict, None]) -> Dict:
+    """Compiles mongoengine style filters, e.g. ``{"price__lte": 500}``, or their JSON into a raw query"""
+    if not filters:
+        return {}
+    if isinstance(filters, str):
+        try:
+            filters = json.loads(filters)
+        except ValueError:
+            raise ValueError(f"Invalid filters [{filters}]")
+    if not isinstance(filters, dict):
+        raise ValueError(f"Invalid filters [{filters}]")
+
+    query = {}
+    for key, value in filters.items():
+        field, _, op = key.partition('__')
+        if field == 'attrs' and _ATTR_KEY.fullmatch(op) and isinstance(value, (str, int, float, bool)):
+            query[f'attrs.{op}'] = value
+            continue
+        if field not in FILTERABLE_FIELDS or op not in FILTERABLE_FIELDS[field][1]:
+            raise ValueError(f"Can not filter on [{key}]")
+        if op == 'in':
+            if not isinstance(value, list) or not 0 < len(value) <= MAX_IN_VALUES:
+                raise ValueError(f"[{key}] takes a list of 1 to {MAX_IN_VALUES} values")
+            value = [_filter_value(key, v) for v in value]
+        else:
+            value = _filter_value(key, value)
+        if op:
+            query.setdefault(field, {})
+            if not isinstance(query[field], dict):
+                raise ValueError(f"Conflicting filters on [{field}]")
+            query[field][f'${op}'] = value
+        elif field in query:
+            raise ValueError(f"Conflicting filters on [{field}]")
+        else:
+            query[field] = value
+    return query
 
 
-def search_products(filters: Dict, title: str) -> List[Product]:
-    filters = json.loads(filters or '{}')
+def _filter_value(key: str, value):
+    kind = FILTERABLE_FIELDS[key.partition('__')[0]][0]
+    if kind is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if kind is str and isinstance(value, str):
+        return value
+    raise ValueError(f"Invalid value [{value}] for [{key}]")
+
+
+def check_filter_plan(query: Dict) -> None:
+    """Refuses, or logs, the queries mongo would answer with a collection scan"""
+    if not query:
+        return
+    shape = tuple(sorted(
+        (field, tuple(sorted(value)) if isinstance(value, dict) else None)
+        for field, value in query.items()
+    ))
+    scans = _filter_plans.get(shape)
+    if scans is None:
+        plan = _explain(query)
+        if plan is None:
+            return
+        scans = _has_collection_scan(plan)
+        _filter_plans.put(shape, scans)
+    if scans:
+        if REJECT_UNINDEXED_FILTERS:
+            raise UnindexedFilter(f"Filters on {[field for field, _ in shape]} need a category, price or mrp filter")
+        logging.warning(f'collection scan for search filters {query}')
+
+
+# plans change when indexes do, hence the ttl
+_filter_plans = LRUCache(maxsize=1024, ttl=3600)
+
+
+def _explain(query: Dict) -> Union[Dict, None]:
+    """The winning plan of ``query``, or None when the database can not explain queries (mongomock)"""
+    try:
+        return Product._get_collection().find(query).explain()['queryPlanner']['winningPlan']
+    except (AttributeError, NotImplementedError, KeyError):
+        return None
+
+
+def _has_collection_scan(plan) -> bool:
+    if isinstance(plan, dict):
+        return plan.get('stage') == 'COLLSCAN' or any(_has_collection_scan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collection_scan(value) for value in plan)
+    return False
+
+
+def search_products(filters: Union[str, Dict], title: str, page: int = 0, size: int = 20,
+                    facet_attrs: Iterable[str] = ()) -> Dict:
+    """Returns a page of matching listings, their total and facet counts, in a single aggregation"""
+    facet_attrs = list(facet_attrs)
+    for key in facet_attrs:
+        if not _ATTR_KEY.fullmatch(key):
+            raise ValueError(f"Invalid attribute [{key}]")
+
+    query = compile_filters(filters)
+    if not title:
+        # text searches always start from the text index
+        check_filter_plan(query)
+    products = Product.objects(__raw__=query)
+    pipeline = []
+    sort = {'_id': 1}
     if title:
-        return Product.objects(**filters).search_text(title).order_by('$text_score')
-    elif filters:
-        return Product.objects(**filters)
-    return get_all_products(0, 1000)
+        products = products.search_text(title)
+        pipeline.append({'$addFields': {'text_score': {'$meta': 'textScore'}}})
+        sort = {'text_score': -1, '_id': 1}
+
+    facets = {
+        'products': [
+            {'$sort': sort},
+            {'$skip': page * size},
+            {'$limit': size},
+            {'$project': {
+                **{field: 1 for field in LISTING_FIELDS},
+                'images': {'$slice': ['$images', 1]}
+            }}
+        ],
+        'total': [{'$count': 'count'}],
+        'category': _facet_counts('$category'),
+        'price': [
+            # anything left out of the boundaries is then above the last one
+            {'$match': {'price': {'$gte': PRICE_FACET_BOUNDARIES[0]}}},
+            {'$bucket': {
+                'groupBy': '$price',
+                'boundaries': list(PRICE_FACET_BOUNDARIES),
+                'default': 'other',
+                'output': {'count': {'$sum': 1}}
+            }}
+        ]
+    }
+    # facet names can not contain dots, hence attrs are numbered
+    for i, key in enumerate(facet_attrs):
+        facets[f'attr_{i}'] = [{'$match': {f'attrs.{key}': {'$exists': True}}}] + _facet_counts(f'$attrs.{key}')
+    pipeline.append({'$facet': facets})
+
+    result = next(products.aggregate(pipeline))
+    return dict(
+        total=result['total'][0]['count'] if result['total'] else 0,
+        products=[listing_from_son(son) for son in result['products']],
+        facets=dict(
+            category=_counts(result['category']),
+            price=price_buckets(result['price']),
+            attrs={
+                key: _counts(result[f'attr_{i}'])
+                for i, key in enumerate(facet_attrs)
+            }
+        )
+    )
+
+
+def _facet_counts(field: str) -> List[Dict]:
+    return [
+        {'$group': {'_id': field, 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1, '_id': 1}}
+    ]
+
+
+def _counts(groups: List[Dict]) -> Dict[str, int]:
+    return {
+        str(group['_id']): group['count']
+        for group in groups
+        if group['_id'] is not None
+    }
+
 
+def price_buckets(buckets: List[Dict]) -> List[Dict]:
+    """Turns ``$bucket`` groups over ``PRICE_FACET_BOUNDARIES`` into the price facet"""
+    counts = {bucket['_id']: bucket['count'] for bucket in buckets}
+    facet = [
+        dict(min=lower, max=upper, count=counts[lower])
+        for lower, upper in zip(PRICE_FACET_BOUNDARIES, PRICE_FACET_BOUNDARIES[1:])
+        if lower in counts
+    ]
+    if 'other' in counts:
+        # prices at or above the last boundary
+        facet.append(dict(min=PRICE_FACET_BOUNDARIES[-1], max=None, count=counts['other']))
+    return facet
 
-def get_all_products(page: int = 0, size: int = 10) -> List[Product]:
-    return Product.objects[page * size:page * size + size]
+
+def get_products_after(after_id: str = None, size: int = 10, cat: str = None) -> QuerySet:
+    """Returns the ``size`` products that follow ``after_id`` in ``_id`` order, optionally within a category"""
+    query = {}
+    if cat:
+        query['category'] = cat
+    if after_id:
+        query['id__gt'] = after_id
+    return Product.objects(**query).order_by('id').limit(size)
+
+
+def iter_products(batch_size: int = 1000, *fields: str) -> Iterator[Dict]:
+    """Iterates over the raw documents of the catalog through a single cursor, ``batch_size`` at a time"""
+    products = Product.objects.order_by('id').no_cache().batch_size(batch_size)
+    if fields:
+        products = products.only(*fields)
+    return products.as_pymongo()
 
 
 def delete_all_products() -> None:
@@ -124,9 +556,12 @@ def delete_all_products() -> None:
 def create_warehouse(**kwargs) -> Warehouse:
     warehouse = Warehouse(
         code=kwargs['code'],
-        name=kwargs['name']
+        name=kwargs['name'],
+        lat=kwargs.get('lat'),
+        lng=kwargs.get('lng')
     )
     warehouse.save()
+    _warehouse_index.invalidate()
     return warehouse
 
 
@@ -134,37 +569,634 @@ def get_warehouse_by_id(warehouse_id: str) -> Warehouse:
     return Warehouse.objects(pk=warehouse_id).first()
 
 
+# The locations of the warehouses, rebuilt on the first lookup after a
+# warehouse is created by this process, or after the ttl for the others
+WAREHOUSE_INDEX_TTL_SECONDS = 300
+
+_warehouse_index = LRUCache(maxsize=1, ttl=WAREHOUSE_INDEX_TTL_SECONDS)
+
+
+def get_warehouse_index() -> geo.NearestIndex:
+    return _warehouse_index.get_or_load('index', lambda: geo.NearestIndex(
+        (son['_id'], son['lat'], son['lng'])
+        for son in Warehouse.objects(lat__ne=None, lng__ne=None).only('lat', 'lng').as_pymongo()
+    ))
+
+
+def create_postal_code(code: str, lat: float, lng: float) -> PostalCode:
+    postal_code = PostalCode(code=code, lat=lat, lng=lng)
+    postal_code.save()
+    return postal_code
+
+
+def get_postal_code_by_id(code: str) -> PostalCode:
+    return PostalCode.objects(code=code).first()
+
+
 def create_inventory(**kwargs) -> Inventory:
-    inv = Inventory(
-        sku=kwargs['sku'],
-        product=get_product_by_id(kwargs['product_id']),
-        warehouse=get_warehouse_by_id(kwargs['warehouse_id']),
-        quantity=kwargs['quantity']
+    """Creates or updates the inventory of ``sku`` with ``quantity`` units in ``warehouse_id``"""
+    sku = kwargs['sku']
+    warehouse = get_warehouse_by_id(kwargs['warehouse_id'])
+    if not warehouse:
+        raise ValueError(f"Invalid warehouse [{kwargs['warehouse_id']}]")
+    # before the warehouse of the Inventory is overwritten
+    _seed_warehouse_rows({sku: warehouse.code})
+    Inventory.objects(sku=sku).update_one(
+        set__product=get_product_by_id(kwargs['product_id']),
+        set__warehouse=warehouse,
+        set_on_insert__quantity=0,
+        set_on_insert__buyer_limit=Inventory.buyer_limit.default,
+        upsert=True
+    )
+    set_warehouse_inventory(sku, warehouse.code, kwargs['quantity'])
+    return get_inventory_by_id(sku)
+
+
+def upsert_inventories(rows: List[Dict]) -> Dict:
+    """Creates or updates inventories in bulk like ``create_inventory``, returns the counts and the failed rows"""
+    errors = []
+    product_ids = {}
+    for i, row in enumerate(rows):
+        if ObjectId.is_valid(row['product_id']):
+            product_ids[i] = ObjectId(row['product_id'])
+        else:
+            errors.append((i, f"Invalid product [{row['product_id']}]"))
+    known_products = {
+        son['_id']
+        for son in Product.objects(id__in=list(set(product_ids.values()))).only('id').as_pymongo()
+    }
+    known_warehouses = {
+        son['_id']
+        for son in Warehouse.objects(code__in=list({row['warehouse_id'] for row in rows})).only('code').as_pymongo()
+    }
+
+    checked = []
+    for i, row in enumerate(rows):
+        if i not in product_ids:
+            continue
+        if product_ids[i] not in known_products:
+            errors.append((i, f"Unknown product [{row['product_id']}]"))
+        elif row['warehouse_id'] not in known_warehouses:
+            errors.append((i, f"Unknown warehouse [{row['warehouse_id']}]"))
+        else:
+            checked.append(i)
+    last_rows = {rows[i]['sku']: i for i in checked}
+    valid = []
+    for i in checked:
+        if last_rows[rows[i]['sku']] != i:
+            # the order of unordered writes is undefined, the last row wins
+            errors.append((i, f"Duplicate SKU [{rows[i]['sku']}], superseded by a later row"))
+        else:
+            valid.append(i)
+    if not valid:
+        return dict(upserted=0, modified=0, errors=sorted(errors))
+
+    # before the warehouses of the Inventories are overwritten
+    _seed_warehouse_rows({rows[i]['sku']: rows[i]['warehouse_id'] for i in valid})
+    inventory_updates = []
+    for i in valid:
+        row = rows[i]
+        update = {
+            '$set': {'product': product_ids[i], 'warehouse': row['warehouse_id']},
+            '$setOnInsert': {'quantity': 0, 'buyer_limit': Inventory.buyer_limit.default}
+        }
+        if row.get('buyer_limit'):
+            update['$set']['buyer_limit'] = row['buyer_limit']
+            del update['$setOnInsert']['buyer_limit']
+        inventory_updates.append(UpdateOne({'_id': row['sku']}, update, upsert=True))
+    valid, result = _bulk_write_rows(Inventory._get_collection(), inventory_updates, valid, errors)
+    created = set(result['upserted'])
+
+    valid = _set_warehouse_stock(rows, valid, errors)
+    return dict(
+        upserted=len(created),
+        modified=len([i for i in valid if i not in created]),
+        errors=sorted(errors)
+    )
+
+
+def _bulk_write_rows(collection: Collection, updates: List[UpdateOne], positions: List[int],
+                     errors: List) -> Tuple[List[int], Dict]:
+    """Bulk writes ``updates``, made from the rows at ``positions``, and returns the positions written"""
+    try:
+        result = collection.bulk_write(updates, ordered=False).bulk_api_result
+    except BulkWriteError as error:
+        result = error.details
+    failed = set()
+    for write_error in result.get('writeErrors', []):
+        failed.add(positions[write_error['index']])
+        errors.append((positions[write_error['index']], write_error['errmsg']))
+    return [i for i in positions if i not in failed], dict(
+        result,
+        upserted=[positions[upsert['index']] for upsert in result.get('upserted', [])]
+    )
+
+
+def _set_warehouse_stock(rows: List[Dict], positions: List[int], errors: List) -> List[int]:
+    """Sets the warehouse stock of the ``rows`` at ``positions`` in bulk, returns the positions written"""
+    warehouse_rows = WarehouseInventory._get_collection()
+    previous = {
+        (son['sku'], son['warehouse']): son['quantity']
+        for son in WarehouseInventory.objects(sku__in=[rows[i]['sku'] for i in positions])
+        .only('sku', 'warehouse', 'quantity').as_pymongo()
+    }
+    deltas = {}
+    for i in positions:
+        row = rows[i]
+        delta = row['quantity'] - previous.get((row['sku'], row['warehouse_id']), 0)
+        if delta < 0 and not _take_stock(row['sku'], -delta):
+            errors.append((i, f"Less than {-delta} units of {row['sku']} are not held by buyers"))
+            continue
+        deltas[i] = delta
+    if not deltas:
+        return []
+
+    write = str(ObjectId())
+    updates = []
+    for i in deltas:
+        row = rows[i]
+        key = (row['sku'], row['warehouse_id'])
+        update = {'$set': {'quantity': row['quantity'], 'write': write}}
+        if key in previous:
+            updates.append(UpdateOne({'sku': key[0], 'warehouse': key[1], 'quantity': previous[key]}, update))
+        else:
+            # fails on the unique index should the row have been created since
+            update['$setOnInsert'] = {'sku': key[0], 'warehouse': key[1]}
+            updates.append(UpdateOne({'sku': key[0], 'warehouse': key[1], 'quantity': {'$exists': False}},
+                                     update, upsert=True))
+    written, result = _bulk_write_rows(warehouse_rows, updates, list(deltas), errors)
+    if result.get('nMatched', 0) + len(result['upserted']) < len(written):
+        # rows changed since they were read are left alone
+        done = {
+            (son['sku'], son['warehouse'])
+            for son in WarehouseInventory.objects(sku__in=[rows[i]['sku'] for i in written], write=write)
+            .only('sku', 'warehouse').as_pymongo()
+        }
+        changed = [i for i in written if (rows[i]['sku'], rows[i]['warehouse_id']) not in done]
+        for i in changed:
+            errors.append((i, f"The stock of {rows[i]['sku']} in {rows[i]['warehouse_id']} changed meanwhile"))
+        written = [i for i in written if i not in changed]
+    given_back = {rows[i]['sku']: -deltas[i] for i in deltas if i not in written and deltas[i] < 0}
+    if given_back:
+        _add_stock(given_back)
+
+    arrived = {rows[i]['sku']: deltas[i] for i in written if deltas[i] > 0}
+    if arrived:
+        _add_stock(arrived)
+        for sku in Inventory.objects(sku__in=list(arrived), shards__gt=0).distinct('sku'):
+            rebalance_inventory(sku)
+    return written
+
+
+# Times set_warehouse_inventory is retried when the row it read changed
+SET_WAREHOUSE_ATTEMPTS = 3
+
+
+class _RowChanged(Exception):
+    pass
+
+
+def set_warehouse_inventory(sku: str, warehouse_id: str, quantity: int) -> WarehouseInventory:
+    """Sets the stock of ``sku`` in a warehouse and moves its sellable stock by as much as that changed"""
+    if quantity < 0:
+        raise ValueError(f"Invalid quantity [{quantity}]")
+    if not Inventory.objects(sku=sku).only('sku').first():
+        raise ValueError(f"Invalid SKU [{sku}]")
+    if not get_warehouse_by_id(warehouse_id):
+        raise ValueError(f"Invalid warehouse [{warehouse_id}]")
+
+    for _ in range(SET_WAREHOUSE_ATTEMPTS):
+        try:
+            _atomically(lambda session: _write_warehouse_row(sku, warehouse_id, quantity, session))
+        except _RowChanged:
+            continue
+        return WarehouseInventory.objects(sku=sku, warehouse=warehouse_id).first()
+    raise ConcurrentUpdate(f"The stock of {sku} in {warehouse_id} keeps changing")
+
+
+def _write_warehouse_row(sku: str, warehouse_id: str, quantity: int, session: ClientSession = None) -> None:
+    _seed_warehouse_rows({sku: warehouse_id}, session)
+    rows = WarehouseInventory._get_collection()
+    previous = rows.find_one({'sku': sku, 'warehouse': warehouse_id}, {'quantity': 1}, session=session)
+    delta = quantity - (previous['quantity'] if previous else 0)
+    # stock leaves the Inventory first, so units held by buyers are never taken
+    if delta < 0 and not _take_stock(sku, -delta, session):
+        raise NotEnoughInventory(f"Less than {-delta} units of {sku} are not held by buyers")
+    try:
+        if previous:
+            written = rows.update_one(
+                {'_id': previous['_id'], 'quantity': previous['quantity']},
+                {'$set': {'quantity': quantity}},
+                session=session
+            ).matched_count
+        else:
+            rows.insert_one({'sku': sku, 'warehouse': warehouse_id, 'quantity': quantity}, session=session)
+            written = True
+    except DuplicateKeyError:
+        written = False
+    if not written:
+        if delta < 0 and session is None:
+            _add_stock({sku: -delta})
+        raise _RowChanged
+    if delta > 0:
+        _add_stock({sku: delta}, session)
+
+
+def _seed_warehouse_rows(warehouses: Dict[str, str], session: ClientSession = None) -> None:
+    """Records the stock of inventories made before warehouses had stock as the stock of their own warehouse"""
+    skus = list(warehouses)
+    seeded = set(WarehouseInventory._get_collection().distinct('sku', {'sku': {'$in': skus}}, session=session))
+    unseeded = [sku for sku in skus if sku not in seeded]
+    if not unseeded:
+        return
+    skus = [son['_id'] for son in Inventory._get_collection().find({'_id': {'$in': unseeded}}, {'_id': 1},
+                                                                    session=session)]
+    if not skus:
+        return
+    # held units are read first, so that a concurrent block is missed rather than counted twice
+    stock = collections.Counter()
+    for son in BlockedInventory._get_collection().aggregate([
+        {'$match': {'sku': {'$in': skus}, 'state': str(BlockedInventoryState.BLOCKED)}},
+        {'$group': {'_id': '$sku', 'quantity': {'$sum': '$quantity'}}}
+    ], session=session):
+        stock[son['_id']] += son['quantity']
+    for son in InventoryShard._get_collection().find({'sku': {'$in': skus}}, {'sku': 1, 'quantity': 1},
+                                                     session=session):
+        stock[son['sku']] += son['quantity']
+    located = {}
+    for son in Inventory._get_collection().find({'_id': {'$in': skus}}, {'quantity': 1, 'warehouse': 1},
+                                                session=session):
+        stock[son['_id']] += son['quantity']
+        located[son['_id']] = son.get('warehouse') or warehouses[son['_id']]
+    seeds = [
+        UpdateOne({'sku': sku, 'warehouse': warehouse}, {'$setOnInsert': {'quantity': stock[sku]}}, upsert=True)
+        for sku, warehouse in located.items()
+        if stock[sku]
+    ]
+    if seeds:
+        try:
+            WarehouseInventory._get_collection().bulk_write(seeds, ordered=False, session=session)
+        except BulkWriteError:
+            # seeded concurrently
+            pass
+
+
+def _take_stock(sku: str, quantity: int, session: ClientSession = None) -> bool:
+    """Takes ``quantity`` units of ``sku`` out of its sellable stock, whatever its buyer limit"""
+    inventories = Inventory._get_collection()
+    taken = inventories.update_one(
+        {'_id': sku, 'quantity': {'$gte': quantity}},
+        {'$inc': {'quantity': -quantity}},
+        session=session
     )
-    inv.save()
-    return inv
+    if taken.modified_count:
+        return True
+    inventory = inventories.find_one({'_id': sku}, {'shards': 1}, session=session)
+    return bool(inventory and inventory.get('shards')
+                and _take_from_shards(sku, quantity, inventory['shards'], session))
+
+
+def _add_stock(units: Dict[str, int], session: ClientSession = None) -> None:
+    Inventory._get_collection().bulk_write([
+        UpdateOne({'_id': sku}, {'$inc': {'quantity': quantity}})
+        for sku, quantity in units.items()
+    ], ordered=False, session=session)
+
+
+def get_warehouse_inventories(sku: str) -> List[WarehouseInventory]:
+    return WarehouseInventory.objects(sku=sku)
+
+
+def select_fulfilment(sku: str, quantity: int, lat: float, lng: float) -> List[Dict]:
+    """Picks the warehouses nearest to ``lat``, ``lng`` that can ship ``quantity`` sellable units of ``sku``"""
+    if quantity <= 0:
+        raise ValueError(f"Invalid quantity [{quantity}]")
+    stock = _warehouse_stock([sku])[sku]
+    sellable = get_inventory_by_id(sku)
+    if sum(stock.values()) < quantity or not sellable or sellable.quantity < quantity:
+        raise NotEnoughInventory(f"Not enough inventory for {sku}")
+    selected, lacking = _pick_warehouses(stock, quantity, lat, lng)
+    if lacking:
+        # stock in warehouses without a location
+        raise NotEnoughInventory(f"Not enough inventory for {sku} in located warehouses")
+    return selected
+
+
+def _warehouse_stock(skus: List[str], session: ClientSession = None) -> Dict[str, Dict[str, int]]:
+    stock = {sku: {} for sku in skus}
+    for son in WarehouseInventory._get_collection().find(
+            {'sku': {'$in': skus}, 'quantity': {'$gt': 0}},
+            {'sku': 1, 'warehouse': 1, 'quantity': 1},
+            session=session
+    ):
+        stock[son['sku']][son['warehouse']] = son['quantity']
+    return stock
+
+
+def _pick_warehouses(stock: Dict[str, int], quantity: int, lat: float = None,
+                     lng: float = None) -> Tuple[List[Dict], int]:
+    """Takes ``quantity`` units out of ``stock``, nearest warehouses first, returns the picks and what is lacking"""
+    selected = []
+    if lat is not None and lng is not None:
+        for distance, warehouse in get_warehouse_index().nearest(lat, lng):
+            if not quantity:
+                break
+            if stock.get(warehouse):
+                taken = min(quantity, stock[warehouse])
+                stock[warehouse] -= taken
+                selected.append(dict(warehouse_id=warehouse, quantity=taken, distance_km=round(distance, 3)))
+                quantity -= taken
+        return selected, quantity
+    for warehouse in sorted(stock, key=stock.get, reverse=True):
+        if not quantity or not stock[warehouse]:
+            break
+        taken = min(quantity, stock[warehouse])
+        stock[warehouse] -= taken
+        selected.append(dict(warehouse_id=warehouse, quantity=taken))
+        quantity -= taken
+    return selected, quantity
+
+
+def _allocate(query: Dict, lat: float = None, lng: float = None, session: ClientSession = None) -> Dict[str, int]:
+    """Takes the committed holds matching ``query`` out of the warehouses that ship them, returns the units in none"""
+    holds = BlockedInventory._get_collection()
+    unallocated = list(holds.find(
+        dict(query, state=str(BlockedInventoryState.COMMITTED), allocated={'$ne': True}),
+        {'sku': 1, 'quantity': 1},
+        session=session
+    ))
+    if not unallocated:
+        return {}
+    stock = _warehouse_stock(list({son['sku'] for son in unallocated}), session)
+    missing = collections.Counter()
+    for son in unallocated:
+        # claimed first, so that concurrent commits allocate it once
+        claimed = holds.update_one({'_id': son['_id'], 'allocated': {'$ne': True}}, {'$set': {'allocated': True}},
+                                   session=session)
+        if not claimed.modified_count:
+            continue
+        fulfilment, lacking = _take_from_warehouses(son['sku'], son['quantity'], stock, lat, lng, session)
+        holds.update_one({'_id': son['_id']}, {'$set': {'fulfilment': fulfilment, 'unallocated': lacking}},
+                         session=session)
+        if lacking:
+            logging.warning(f"{lacking} units of {son['sku']} sold by {son['_id']} are in no warehouse")
+            missing[son['sku']] += lacking
+    return dict(missing)
+
+
+# Times an allocation picks warehouses again when concurrent commits took
+# the stock it read
+ALLOCATE_ATTEMPTS = 3
+
+
+def _take_from_warehouses(sku: str, quantity: int, stock: Dict[str, Dict[str, int]], lat: float = None,
+                          lng: float = None, session: ClientSession = None) -> Tuple[List[Dict], int]:
+    """Takes ``quantity`` units of ``sku`` out of warehouses picked from ``stock``, returns them and what lacks"""
+    rows = WarehouseInventory._get_collection()
+    fulfilment = collections.Counter()
+    for _ in range(ALLOCATE_ATTEMPTS):
+        picks, lacking = _pick_warehouses(stock[sku], quantity, lat, lng)
+        if lacking and lat is not None and lng is not None:
+            more, lacking = _pick_warehouses(stock[sku], lacking)
+            picks += more
+        missed = False
+        for pick in picks:
+            taken = rows.update_one(
+                {'sku': sku, 'warehouse': pick['warehouse_id'], 'quantity': {'$gte': pick['quantity']}},
+                {'$inc': {'quantity': -pick['quantity']}},
+                session=session
+            )
+            if taken.matched_count:
+                fulfilment[pick['warehouse_id']] += pick['quantity']
+                quantity -= pick['quantity']
+            else:
+                missed = True
+        if not missed or not quantity:
+            break
+        # another commit took the stock read, picked again from what is left
+        stock.update(_warehouse_stock([sku], session))
+    return [dict(warehouse_id=warehouse, quantity=taken) for warehouse, taken in fulfilment.items()], quantity
 
 
 def update_inventory(sku: str, quantity: int) -> Inventory:
-    inv = get_inventory_by_id(sku)
-    inv.quantity = quantity
-    inv.save()
-    return inv
+    """Sets the sellable stock of ``sku`` by changing the stock of its own warehouse as much"""
+    son = Inventory._get_collection().find_one({'_id': sku}, {'warehouse': 1, 'shards': 1})
+    if not son:
+        return None
+    warehouse_id = son.get('warehouse')
+    if not warehouse_id or not get_warehouse_by_id(warehouse_id):
+        raise ValueError(f"Invalid warehouse [{warehouse_id}] for [{sku}]")
+    _seed_warehouse_rows({sku: warehouse_id})
+    row = WarehouseInventory.objects(sku=sku, warehouse=warehouse_id).only('quantity').first()
+    stock = (row.quantity if row else 0) + quantity - get_inventory_by_id(sku).quantity
+    if stock < 0:
+        raise NotEnoughInventory(f"More than {quantity} sellable units of {sku} are in other warehouses")
+    set_warehouse_inventory(sku, warehouse_id, stock)
+    if son.get('shards'):
+        rebalance_inventory(sku)
+    return get_inventory_by_id(sku)
 
 
 def get_inventory_by_id(sku: str) -> Inventory:
-    return Inventory.objects(sku=sku).first()
+    """The inventory of ``sku``, with the stock of its shards added to its quantity"""
+    inventory = Inventory.objects(sku=sku).first()
+    if inventory and inventory.shards:
+        inventory.quantity += InventoryShard.objects(sku=sku).sum('quantity')
+    return inventory
 
 
-def block_inventory(sku: str, quantity: int) -> str:
-    inventory = get_inventory_by_id(sku)
+# Sharded SKUs are remembered by the process, so that blocks go straight to
+# their shards; stale entries only cost a retry on the Inventory.
+SHARDED_CACHE_SIZE = 4096
+SHARDED_CACHE_TTL_SECONDS = 60
+
+_sharded_inventories = LRUCache(maxsize=SHARDED_CACHE_SIZE, ttl=SHARDED_CACHE_TTL_SECONDS)
+
+
+def _shard_id(sku: str, shard: int) -> str:
+    return f'{sku}:{shard}'
+
+
+def shard_inventory(sku: str, shards: int) -> Inventory:
+    """Spreads the stock of ``sku`` over ``shards`` counters, or takes it back to the Inventory when 0"""
+    if shards < 0:
+        raise ValueError(f"Invalid number of shards [{shards}]")
+    if not Inventory.objects(sku=sku).update_one(set__shards=shards):
+        raise ValueError(f"Invalid SKU [{sku}]")
+    _sharded_inventories.invalidate()
+    rebalance_inventory(sku)
+    return get_inventory_by_id(sku)
+
+
+def rebalance_inventory(sku: str) -> Dict[str, int]:
+    """Evens out the stock of ``sku`` over its shards, or takes it back to the Inventory when unsharded"""
+    inventory = Inventory.objects(sku=sku).only('shards').first()
     if not inventory:
         raise ValueError(f"Invalid SKU [{sku}]")
+    shards = inventory.shards or 0
+    total = _spread(sku, shards)
+    InventoryShard._get_collection().delete_many({
+        'sku': sku,
+        '_id': {'$nin': [_shard_id(sku, i) for i in range(shards)]},
+        'quantity': 0
+    })
+    return dict(sku=sku, shards=shards, quantity=total)
+
+
+def rebalance_inventories() -> Dict[str, int]:
+    """Rebalances every sharded SKU, returns how many and their stock"""
+    skus = [son['_id'] for son in Inventory.objects(shards__gt=0).only('sku').as_pymongo()]
+    return dict(
+        skus=len(skus),
+        quantity=sum(rebalance_inventory(sku)['quantity'] for sku in skus)
+    )
+
+
+# A counter is the Inventory of a SKU, ``(False, sku)``, or one of its
+# shards, ``(True, shard id)``
+StockCounter = Tuple[bool, str]
+
+# Times a move is retried with what is left when concurrent blocks took the
+# units it was going to move
+MOVE_ATTEMPTS = 3
+
+
+def _counters(shard: bool) -> Collection:
+    return InventoryShard._get_collection() if shard else Inventory._get_collection()
+
+
+def _spread(sku: str, shards: int, session: ClientSession = None) -> int:
+    """Moves the stock of ``sku`` evenly to its first ``shards`` shards, or to the Inventory when 0"""
+    inventory = Inventory._get_collection().find_one({'_id': sku}, {'quantity': 1}, session=session)
+    quantities = {(False, sku): inventory['quantity'] if inventory else 0}
+    for son in InventoryShard._get_collection().find({'sku': sku}, {'quantity': 1}, session=session):
+        quantities[(True, son['_id'])] = son['quantity']
+    total = sum(quantities.values())
+
+    targets = {counter: 0 for counter in quantities}
+    if shards:
+        for i in range(shards):
+            targets[(True, _shard_id(sku, i))] = total // shards + (1 if i < total % shards else 0)
+    else:
+        targets[(False, sku)] = total
+    missing = [shard_id for shard, shard_id in targets if (shard, shard_id) not in quantities]
+    if missing:
+        InventoryShard._get_collection().bulk_write([
+            UpdateOne({'_id': shard_id}, {'$setOnInsert': {'sku': sku, 'quantity': 0}}, upsert=True)
+            for shard_id in missing
+        ], ordered=False, session=session)
+
+    surplus = [[counter, quantities[counter] - target] for counter, target in targets.items()
+               if quantities.get(counter, 0) > target]
+    for counter, target in targets.items():
+        lacking = target - quantities.get(counter, 0)
+        while lacking > 0 and surplus:
+            source, extra = surplus[0]
+            quantity = min(lacking, extra)
+            moved = _move_available(source, counter, quantity, session)
+            lacking -= moved
+            surplus[0][1] -= quantity
+            if not surplus[0][1] or moved < quantity:
+                # blocks took the rest of what was there
+                surplus.pop(0)
+    return total
+
+
+def _move_available(source: StockCounter, destination: StockCounter, quantity: int,
+                    session: ClientSession = None) -> int:
+    """Moves up to ``quantity`` units, as many as ``source`` still has"""
+    for _ in range(MOVE_ATTEMPTS):
+        if _move(source, destination, quantity, session):
+            return quantity
+        son = _counters(source[0]).find_one({'_id': source[1]}, {'quantity': 1}, session=session)
+        quantity = min(quantity, son['quantity'] if son else 0)
+        if quantity <= 0:
+            break
+    return 0
+
+
+def _move(source: StockCounter, destination: StockCounter, quantity: int, session: ClientSession = None) -> bool:
+    """Moves ``quantity`` units from one counter of a SKU to another, unless ``source`` has less"""
+    def write(session):
+        taken = _counters(source[0]).update_one(
+            {'_id': source[1], 'quantity': {'$gte': quantity}},
+            {'$inc': {'quantity': -quantity}},
+            session=session
+        )
+        if taken.modified_count:
+            _counters(destination[0]).update_one(
+                {'_id': destination[1]},
+                {'$inc': {'quantity': quantity}},
+                session=session
+            )
+        return bool(taken.modified_count)
+    return write(session) if session else _atomically(write)
+
+
+def _take_from_shards(sku: str, quantity: int, shards: int, session: ClientSession = None) -> bool:
+    """Takes ``quantity`` units of a sharded SKU from one of its counters, or all of them, whatever its buyer limit"""
+    counters = InventoryShard._get_collection()
+    inventories = Inventory._get_collection()
+    update = {'$inc': {'quantity': -quantity}}
+    for shard in random.sample(range(shards), shards):
+        taken = counters.update_one({'_id': _shard_id(sku, shard), 'quantity': {'$gte': quantity}}, update,
+                                    session=session)
+        if taken.modified_count:
+            return True
+    taken = inventories.update_one({'_id': sku, 'quantity': {'$gte': quantity}}, update, session=session)
+    if taken.modified_count:
+        return True
 
-    if quantity <= 0 or quantity > inventory.buyer_limit:
-        raise ValueError(f"0 < quantity <= {inventory.buyer_limit}")
+    inventory = inventories.find_one({'_id': sku}, {'quantity': 1}, session=session)
+    stock = sum(son['quantity'] for son in counters.find({'sku': sku}, {'quantity': 1}, session=session))
+    if not inventory or inventory['quantity'] + stock < quantity:
+        return False
+    # no counter holds them all: they are gathered in the Inventory, and the rest is spread back
+    _spread(sku, 0, session)
+    taken = inventories.update_one({'_id': sku, 'quantity': {'$gte': quantity}}, update, session=session)
+    _spread(sku, shards, session)
+    return bool(taken.modified_count)
 
-    if inventory.quantity > quantity:
+
+def get_inventories_by_ids(skus: Iterable[str], *fields: str) -> List[Inventory]:
+    """Loads the inventories of ``skus`` in a single query, leaving references as ``DBRef``"""
+    inventories = Inventory.objects(sku__in=list(skus)).no_dereference()
+    if fields:
+        inventories = inventories.only(*fields)
+    return inventories
+
+
+def block_inventory(sku: str, quantity: int) -> str:
+    """Takes ``quantity`` units of ``sku`` out of stock and holds them for a few minutes under the returned id"""
+    if quantity <= 0:
+        raise ValueError(f"Invalid quantity [{quantity}]")
+
+    sharded = _sharded_inventories.get(sku)
+    taken = False
+    if sharded is None:
+        taken = Inventory.objects(__raw__={
+            '_id': sku,
+            'quantity': {'$gte': quantity},
+            'buyer_limit': {'$gte': quantity}
+        }).update_one(__raw__={'$inc': {'quantity': -quantity}})
+        if not taken:
+            # tell why, off the hot path
+            inventory = Inventory.objects(sku=sku).only('buyer_limit', 'shards').first()
+            if not inventory:
+                raise ValueError(f"Invalid SKU [{sku}]")
+            if not inventory.shards and quantity <= inventory.buyer_limit:
+                raise NotEnoughInventory
+            sharded = (inventory.shards, inventory.buyer_limit)
+            if inventory.shards:
+                _sharded_inventories.put(sku, sharded)
+    if not taken:
+        shards, buyer_limit = sharded
+        if quantity > buyer_limit:
+            raise ValueError(f"0 < quantity <= {buyer_limit}")
+        if not _take_from_shards(sku, quantity, shards):
+            raise NotEnoughInventory
+
+    try:
         block_inv = BlockedInventory(
             sku=sku,
             quantity=quantity,
@@ -172,33 +1204,307 @@ def block_inventory(sku: str, quantity: int) -> str:
             state=str(BlockedInventoryState.BLOCKED)
         )
         block_inv.save()
-
-        inventory.quantity -= quantity
-        inventory.save()
-        return str(block_inv.id)
-    raise NotEnoughInventory
+    except Exception:
+        Inventory.objects(sku=sku).update_one(inc__quantity=quantity)
+        raise
+    return str(block_inv.id)
 
 
 def _expiry_time(delta_minutes=5):
     return arrow.utcnow().shift(minutes=delta_minutes).timestamp
 
 
+def release_expired_holds(batch_size: int = 500, now: int = None) -> Dict[str, int]:
+    """Gives the stock of up to ``batch_size`` expired holds back, returns how many holds and units"""
+    now = arrow.utcnow().timestamp if now is None else now
+    blocked = str(BlockedInventoryState.BLOCKED)
+    expired = BlockedInventory.objects(state=blocked, expiry__lt=now).order_by('expiry').limit(batch_size)
+    expired = list(expired.only('id', 'reservation').as_pymongo())
+    committed = _committed_reservations({son['reservation'] for son in expired if son.get('reservation')})
+    if committed:
+        # the process committing them died before it committed their holds
+        BlockedInventory.objects(reservation__in=committed, state=blocked).update(
+            set__state=str(BlockedInventoryState.COMMITTED)
+        )
+        _allocate({'reservation': {'$in': list(committed)}})
+    expired_ids = [son['_id'] for son in expired if son.get('reservation') not in committed]
+    if not expired_ids:
+        return dict(holds=0, units=0)
+    return _atomically(lambda session: _release_holds(
+        {'_id': {'$in': expired_ids}, 'state': blocked, 'expiry': {'$lt': now}},
+        BlockedInventoryState.EXPIRED,
+        session
+    ))
+
+
+def _release_holds(query: Dict, state: BlockedInventoryState, session: ClientSession = None) -> Dict[str, int]:
+    """Moves the holds matching ``query`` to ``state`` and gives their stock back, once whoever else releases them"""
+    holds = BlockedInventory._get_collection()
+    # only the holds this call moved carry its token
+    release = str(ObjectId())
+    holds.update_many(query, {'$set': {'state': str(state), 'release': release}}, session=session)
+    units = collections.Counter()
+    count = 0
+    for son in holds.find({'release': release}, {'sku': 1, 'quantity': 1}, session=session):
+        units[son['sku']] += son['quantity']
+        count += 1
+    if units:
+        _add_stock(units, session)
+    return dict(holds=count, units=sum(units.values()))
+
+
+# Holds of a reservation expire this much later than the reservation itself,
+# so that the sweeper can not release a reservation being committed
+RESERVATION_GRACE_SECONDS = 60
+
+
+def block_inventories(items: Dict[str, int]) -> Reservation:
+    """Holds ``quantity`` units of every ``sku`` of ``items`` under a single reservation, all or nothing"""
+    if not items:
+        raise ValueError("Nothing to block")
+    for sku, quantity in items.items():
+        if quantity <= 0:
+            raise ValueError(f"Invalid quantity [{quantity}] for [{sku}]")
+
+    reservation = Reservation(
+        id=ObjectId(),
+        state=str(BlockedInventoryState.BLOCKED),
+        expiry=_expiry_time()
+    )
+    if _supports_transactions():
+        try:
+            return _atomically(lambda session: _block_in_bulk(reservation, items, session))
+        except _Missed:
+            # unknown, over the limit, out of stock or sharded, see _take
+            pass
+    return _atomically(lambda session: _block_one_by_one(reservation, items, session))
+
+
+class _Missed(Exception):
+    pass
+
+
+def _block_in_bulk(reservation: Reservation, items: Dict[str, int], session: ClientSession) -> Reservation:
+    taken = Inventory._get_collection().bulk_write([
+        UpdateOne(
+            {'_id': sku, 'quantity': {'$gte': quantity}, 'buyer_limit': {'$gte': quantity}},
+            {'$inc': {'quantity': -quantity}}
+        )
+        for sku, quantity in items.items()
+    ], ordered=False, session=session)
+    if taken.modified_count < len(items):
+        raise _Missed
+    _record_reservation(reservation, items, session)
+    return reservation
+
+
+def _block_one_by_one(reservation: Reservation, items: Dict[str, int],
+                      session: ClientSession = None) -> Reservation:
+    """Takes ``items`` one SKU at a time, giving back what was taken on failure when outside a transaction"""
+    taken = {}
+    try:
+        for sku, quantity in items.items():
+            _take(sku, quantity, session)
+            taken[sku] = quantity
+        _record_reservation(reservation, items, session)
+    except Exception:
+        if session is None:
+            BlockedInventory.objects(reservation=str(reservation.id)).delete()
+            if taken:
+                _add_stock(taken)
+        raise
+    return reservation
+
+
+def _take(sku: str, quantity: int, session: ClientSession = None) -> None:
+    """Takes ``quantity`` units of ``sku`` within its buyer limit, or raises why not"""
+    inventories = Inventory._get_collection()
+    taken = inventories.update_one(
+        {'_id': sku, 'quantity': {'$gte': quantity}, 'buyer_limit': {'$gte': quantity}},
+        {'$inc': {'quantity': -quantity}},
+        session=session
+    )
+    if taken.modified_count:
+        return
+    inventory = inventories.find_one({'_id': sku}, {'buyer_limit': 1, 'shards': 1}, session=session)
+    if not inventory:
+        raise ValueError(f"Invalid SKU [{sku}]")
+    if quantity > inventory.get('buyer_limit', Inventory.buyer_limit.default):
+        raise ValueError(f"Quantity over the buyer limit for [{sku}]")
+    if not inventory.get('shards') or not _take_from_shards(sku, quantity, inventory['shards'], session):
+        raise NotEnoughInventory(f"Not enough inventory for {sku}")
+
+
+def _record_reservation(reservation: Reservation, items: Dict[str, int], session: ClientSession = None) -> None:
+    BlockedInventory._get_collection().insert_many([
+        BlockedInventory(
+            sku=sku,
+            quantity=quantity,
+            expiry=reservation.expiry + RESERVATION_GRACE_SECONDS,
+            state=str(BlockedInventoryState.BLOCKED),
+            reservation=str(reservation.id)
+        ).to_mongo()
+        for sku, quantity in items.items()
+    ], session=session)
+    Reservation._get_collection().insert_one(reservation.to_mongo(), session=session)
+
+
+def _committed_reservations(reservation_ids: Iterable[str]) -> set:
+    reservation_ids = [ObjectId(reservation_id) for reservation_id in reservation_ids]
+    if not reservation_ids:
+        return set()
+    return {
+        str(son['_id'])
+        for son in Reservation.objects(
+            id__in=reservation_ids,
+            state=str(BlockedInventoryState.COMMITTED)
+        ).only('id').as_pymongo()
+    }
+
+
+def get_reservation_by_id(reservation_id: str) -> Reservation:
+    return Reservation.objects(id=reservation_id).first()
+
+
+def commit_reservation(reservation_id: str, lat: float = None, lng: float = None) -> Reservation:
+    """Turns the holds of an unexpired reservation into sales shipped from near ``lat``, ``lng``, once"""
+    def write(session):
+        son = Reservation._get_collection().find_one_and_update(
+            {
+                '_id': _reservation_id(reservation_id),
+                'state': str(BlockedInventoryState.BLOCKED),
+                'expiry': {'$gte': arrow.utcnow().timestamp}
+            },
+            {'$set': {'state': str(BlockedInventoryState.COMMITTED)}},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        reservation = Reservation._from_son(son) if son else _get_reservation(reservation_id)
+        if reservation.state != str(BlockedInventoryState.COMMITTED):
+            raise BlockedInventoryExpired
+        # also commits the holds of a commit that died before it got to them
+        BlockedInventory._get_collection().update_many(
+            {'reservation': reservation_id, 'state': str(BlockedInventoryState.BLOCKED)},
+            {'$set': {'state': str(BlockedInventoryState.COMMITTED)}},
+            session=session
+        )
+        unallocated = _allocate({'reservation': reservation_id}, lat, lng, session)
+        if unallocated:
+            Reservation._get_collection().update_one(
+                {'_id': reservation.id},
+                {'$set': {'unallocated': unallocated}},
+                session=session
+            )
+            reservation.unallocated = unallocated
+        return reservation
+    return _atomically(write)
+
+
+def release_reservation(reservation_id: str) -> Reservation:
+    """Gives the stock of the holds of a reservation back, once, e.g. when a checkout is abandoned"""
+    def write(session):
+        son = Reservation._get_collection().find_one_and_update(
+            {'_id': _reservation_id(reservation_id), 'state': str(BlockedInventoryState.BLOCKED)},
+            {'$set': {'state': str(BlockedInventoryState.RELEASED)}},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if son:
+            _release_holds(
+                {'reservation': reservation_id, 'state': str(BlockedInventoryState.BLOCKED)},
+                BlockedInventoryState.RELEASED,
+                session
+            )
+        return son
+    released = _atomically(write)
+    if released:
+        return Reservation._from_son(released)
+
+    reservation = _get_reservation(reservation_id)
+    if reservation.state == str(BlockedInventoryState.COMMITTED):
+        raise ValueError(f"Reservation {reservation_id} is already committed")
+    return reservation
+
+
+def _reservation_id(reservation_id: str) -> ObjectId:
+    if not ObjectId.is_valid(reservation_id):
+        raise ValueError(f"Unknown reservation id {reservation_id}")
+    return ObjectId(reservation_id)
+
+
+def _get_reservation(reservation_id: str) -> Reservation:
+    reservation = get_reservation_by_id(_reservation_id(reservation_id))
+    if not reservation:
+        raise ValueError(f"Unknown reservation id {reservation_id}")
+    return reservation
+
+
 def get_blocked_inventory_by_id(id: str) -> BlockedInventory:
     return BlockedInventory.objects(id=id).first()
 
 
-def commit_inventory(blocked_inv_id: str):
-    blocked = get_blocked_inventory_by_id(blocked_inv_id)
+def commit_inventory(blocked_inv_id: str) -> None:
+    """Turns a hold into a sale, unless it expired; committing twice is a no-op"""
+    def write(session):
+        committed = BlockedInventory._get_collection().update_one(
+            {
+                '_id': ObjectId(blocked_inv_id),
+                'state': str(BlockedInventoryState.BLOCKED),
+                'expiry': {'$gte': arrow.utcnow().timestamp}
+            },
+            {'$set': {'state': str(BlockedInventoryState.COMMITTED)}},
+            session=session
+        )
+        if committed.modified_count:
+            _allocate({'_id': ObjectId(blocked_inv_id)}, session=session)
+        return committed.modified_count
+    if ObjectId.is_valid(blocked_inv_id) and _atomically(write):
+        return
+
+    blocked = ObjectId.is_valid(blocked_inv_id) and get_blocked_inventory_by_id(blocked_inv_id)
     if not blocked:
         raise ValueError(f"Unknown blocked inventory id {blocked_inv_id}")
+    if blocked.state != str(BlockedInventoryState.COMMITTED):
+        raise BlockedInventoryExpired
+
+
+def claim_lease(name: str, owner: str, seconds: int, now: int = None) -> bool:
+    """Takes or renews the lease ``name`` for ``seconds``, unless another owner holds it"""
+    now = arrow.utcnow().timestamp if now is None else now
+    try:
+        Lease._get_collection().update_one(
+            {'_id': name, '$or': [{'expires': {'$lt': now}}, {'owner': owner}]},
+            {'$set': {'owner': owner, 'expires': now + seconds}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # held by another owner
+        return False
+    return True
+
+
+# Whether the database runs transactions, which take a replica set or a
+# sharded cluster; without them the writes of _atomically run one by one
+_transaction_support = LRUCache(maxsize=16, ttl=3600)
+
+
+def _supports_transactions() -> bool:
+    client = Inventory._get_db().client
+    return _transaction_support.get_or_load(id(client), lambda: _asks_for_transactions(client))
+
 
-    # Make sure the blocked inventory has not expired
-    if arrow.utcnow().timestamp <= blocked.expiry:
-        inv = get_inventory_by_id(blocked.sku)
-        inv.quantity -= blocked.quantity
-        inv.save()
+def _asks_for_transactions(client) -> bool:
+    try:
+        hello = client.admin.command('ismaster')
+    except (NotImplementedError, PyMongoError):
+        # mongomock
+        return False
+    return 'setName' in hello or hello.get('msg') == 'isdbgrid'
 
-        blocked.state = str(BlockedInventoryState.COMMITTED)
-        blocked.save()
 
-    raise BlockedInventoryExpired
+def _atomically(write: Callable[[Optional[ClientSession]], T]) -> T:
+    """Runs ``write`` in a transaction where the database has them, else with no session"""
+    if not _supports_transactions():
+        return write(None)
+    with Inventory._get_db().client.start_session() as session:
+        return session.with_transaction(write)
@@ -0,0 +1,276 @@
+import abc
+import bisect
+import collections
+import heapq
+import math
+import operator
+import re
+import threading
+from typing import Dict, Iterable, List, Callable, Union
+
+from jetcart.domain import catalog
+
+_TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower()) if text else []
+
+
+class SearchBackend:
+    @abc.abstractmethod
+    def search(self, filters: Union[str, Dict], title: str, page: int = 0, size: int = 20,
+               facet_attrs: Iterable[str] = ()) -> Dict:
+        """Same contract as ``catalog.search_products``"""
+        pass
+
+    def add_product(self, son: Dict) -> None:
+        """Called with the raw document of every product created or updated"""
+        pass
+
+    def clear(self) -> None:
+        """Called when all the products are deleted"""
+        pass
+
+
+class MongoTextSearchBackend(SearchBackend):
+    """Searches with the ``$title`` text index of mongo"""
+
+    def search(self, filters: Union[str, Dict], title: str, page: int = 0, size: int = 20,
+               facet_attrs: Iterable[str] = ()) -> Dict:
+        return catalog.search_products(filters, title, page, size, facet_attrs)
+
+
+class InvertedIndexSearchBackend(SearchBackend):
+    """An in memory inverted index over the title, description, category and
+    attrs values of the products, ranked with BM25. Field boosts are folded
+    into the term frequencies. When the last term of a query is not in the
+    index it is matched as a prefix of longer terms instead, so results can be
+    shown while the user types.
+
+    The index lives in the process; products written by other processes are
+    only picked up when the index is rebuilt.
+    """
+
+    FIELD_BOOSTS = (('title', 3.0), ('category', 2.0), ('attrs', 1.5), ('description', 1.0))
+    K1 = 1.2
+    B = 0.75
+    MIN_PREFIX_LENGTH = 2
+    PREFIX_EXPANSIONS = 50
+    PREFIX_WEIGHT = 0.5
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self) -> None:
+        # documents are kept in the order they were added, which is _id order
+        # for an index built by ``build`` and then fed new products
+        self._docs = []
+        self._listings = []
+        self._doc_terms = []
+        self._doc_lengths = []
+        self._total_length = 0.0
+        self._positions = {}
+        self._postings = {}
+        self._terms = []
+
+    @classmethod
+    def build(cls, sons: Iterable[Dict]) -> 'InvertedIndexSearchBackend':
+        """Builds an index from raw product documents, e.g. ``catalog.iter_products()``"""
+        index = cls()
+        with index._lock:
+            for son in sons:
+                index._add(son)
+            index._terms = sorted(index._postings)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add_product(self, son: Dict) -> None:
+        with self._lock:
+            added, removed = self._add(son)
+            for term in removed:
+                del self._terms[bisect.bisect_left(self._terms, term)]
+            for term in added:
+                bisect.insort(self._terms, term)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def _add(self, son: Dict):
+        """Indexes a product, replacing its previous version if any. Returns
+        the terms that are new to the index and the ones no longer in it."""
+        term_freqs = collections.Counter()
+        for field, boost in self.FIELD_BOOSTS:
+            value = son.get(field)
+            if isinstance(value, dict):
+                value = ' '.join(str(v) for v in value.values())
+            for term in tokenize(value):
+                term_freqs[term] += boost
+        doc = {
+            field: son.get(field)
+            for field in ('title', 'category', 'price', 'mrp', 'attrs')
+        }
+
+        product_id = str(son['_id'])
+        position = self._positions.get(product_id)
+        removed = set()
+        if position is None:
+            position = self._positions[product_id] = len(self._docs)
+            self._docs.append(doc)
+            self._listings.append(None)
+            self._doc_terms.append(None)
+            self._doc_lengths.append(0.0)
+        else:
+            for term in self._doc_terms[position]:
+                postings = self._postings[term]
+                del postings[position]
+                if not postings:
+                    del self._postings[term]
+                    removed.add(term)
+            self._docs[position] = doc
+
+        added = set()
+        for term, freq in term_freqs.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                added.add(term)
+            postings[position] = freq
+
+        length = sum(term_freqs.values())
+        self._total_length += length - self._doc_lengths[position]
+        self._doc_lengths[position] = length
+        self._doc_terms[position] = tuple(term_freqs)
+        self._listings[position] = catalog.listing_from_son(son)
+        return added - removed, removed - added
+
+    def search(self, filters: Union[str, Dict], title: str, page: int = 0, size: int = 20,
+               facet_attrs: Iterable[str] = ()) -> Dict:
+        query = catalog.compile_filters(filters)
+        predicate = compile_predicate(query)
+        facet_attrs = list(facet_attrs)
+        tokens = tokenize(title)
+
+        with self._lock:
+            if tokens:
+                scores = self._score(tokens)
+                ranked = sorted(scores, key=lambda position: (-scores[position], position))
+            elif title:
+                ranked = []
+            else:
+                ranked = range(len(self._docs))
+            matches = [
+                position
+                for position in ranked
+                if predicate(self._docs[position])
+            ] if query else list(ranked)
+            docs = [self._docs[position] for position in matches]
+            return dict(
+                total=len(matches),
+                products=[self._listings[position] for position in matches[page * size:(page + 1) * size]],
+                facets=dict(
+                    category=_counts(doc['category'] for doc in docs),
+                    price=_price_facet(doc['price'] for doc in docs),
+                    attrs={
+                        key: _counts(
+                            (doc['attrs'] or {}).get(key)
+                            for doc in docs
+                        )
+                        for key in facet_attrs
+                    }
+                )
+            )
+
+    def _score(self, tokens: List[str]) -> Dict[int, float]:
+        weights = dict.fromkeys(tokens, 1.0)
+        if tokens[-1] not in self._postings:
+            # most likely a word being typed
+            for term in self._expand_prefix(tokens[-1]):
+                weights.setdefault(term, self.PREFIX_WEIGHT)
+
+        doc_count = len(self._docs)
+        avg_length = self._total_length / doc_count if doc_count else 0.0
+        scores = collections.defaultdict(float)
+        for term, weight in weights.items():
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, freq in postings.items():
+                norm = 1 - self.B + self.B * self._doc_lengths[position] / avg_length
+                scores[position] += weight * idf * freq * (self.K1 + 1) / (freq + self.K1 * norm)
+        return scores
+
+    def _expand_prefix(self, prefix: str) -> List[str]:
+        """The most frequent terms starting with ``prefix``"""
+        if len(prefix) < self.MIN_PREFIX_LENGTH:
+            return []
+        start = bisect.bisect_left(self._terms, prefix)
+        end = bisect.bisect_left(self._terms, prefix + '\uffff', start)
+        return heapq.nlargest(
+            self.PREFIX_EXPANSIONS,
+            self._terms[start:end],
+            key=lambda term: len(self._postings[term])
+        )
+
+
+_OPERATORS = {
+    '$gt': operator.gt,
+    '$gte': operator.ge,
+    '$lt': operator.lt,
+    '$lte': operator.le,
+    '$in': lambda value, values: value in values,
+}
+
+
+def compile_predicate(query: Dict) -> Callable[[Dict], bool]:
+    """Compiles a query made by ``catalog.compile_filters`` into a predicate
+    over raw product documents that matches the same ones mongo would"""
+    predicates = [
+        _compile_condition(field.split('.'), op, expected)
+        for field, condition in query.items()
+        for op, expected in (condition.items() if isinstance(condition, dict) else [(None, condition)])
+    ]
+    return lambda doc: all(predicate(doc) for predicate in predicates)
+
+
+def _compile_condition(path: List[str], op: str, expected) -> Callable[[Dict], bool]:
+    compare = _OPERATORS[op] if op else operator.eq
+
+    def predicate(doc: Dict) -> bool:
+        value = doc
+        for part in path:
+            if not isinstance(value, dict):
+                return False
+            value = value.get(part)
+        try:
+            return value is not None and compare(value, expected)
+        except TypeError:
+            return False
+
+    return predicate
+
+
+def _counts(values: Iterable) -> Dict[str, int]:
+    counts = collections.Counter(str(value) for value in values if value is not None)
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+
+def _price_facet(prices: Iterable[float]) -> List[Dict]:
+    boundaries = catalog.PRICE_FACET_BOUNDARIES
+    counts = collections.Counter()
+    for price in prices:
+        if price is None:
+            continue
+        i = bisect.bisect_right(boundaries, price) - 1
+        if i < 0:
+            continue
+        counts['other' if i == len(boundaries) - 1 else boundaries[i]] += 1
+    return catalog.price_buckets([
+        dict(_id=bucket, count=count)
+        for bucket, count in counts.items()
+    ])
@@ -0,0 +1,100 @@
+import bisect
+import collections
+import threading
+from typing import Dict, Iterable, List
+
+from jetcart.domain.search import tokenize
+
+
+class _Node:
+    __slots__ = ('children', 'top')
+
+    def __init__(self):
+        self.children = {}
+        # (-weight, term) of the best completions below this node, best first
+        self.top = []
+
+
+class SuggestionIndex:
+    """A prefix trie over the normalized tokens of the product titles. A
+    token weighs the number of titles it appears in plus the number of
+    searches made with it, and every node keeps its ``k`` heaviest
+    completions, so a lookup only walks the typed prefix.
+
+    Weights never decrease (``clear`` drops everything), which is what keeps
+    the per node lists exact without rescanning subtrees.
+    """
+
+    MIN_TOKEN_LENGTH = 2
+
+    def __init__(self, k: int = 10):
+        self.k = k
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self._root = _Node()
+        self._weights = {}
+
+    @classmethod
+    def build(cls, sons: Iterable[Dict], k: int = 10) -> 'SuggestionIndex':
+        """Builds an index from raw product documents, e.g. ``catalog.iter_products(1000, 'title')``"""
+        weights = collections.Counter()
+        for son in sons:
+            weights.update(set(tokenize(son.get('title'))))
+        index = cls(k)
+        for token, weight in weights.items():
+            if len(token) >= cls.MIN_TOKEN_LENGTH:
+                index._bump(token, weight)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+    def add_title(self, title: str) -> None:
+        with self._lock:
+            for token in set(tokenize(title)):
+                if len(token) >= self.MIN_TOKEN_LENGTH:
+                    self._bump(token, 1)
+
+    def record_search(self, query: str) -> None:
+        """Makes the known tokens of a search query more popular. Unknown ones
+        are ignored so that misspelt queries are never suggested."""
+        with self._lock:
+            for token in set(tokenize(query)):
+                if token in self._weights:
+                    self._bump(token, 1)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def suggest(self, query: str, limit: int = None) -> List[str]:
+        """Completes the last word of ``query`` with the most popular tokens
+        starting with it, keeping the words typed before it"""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        limit = self.k if limit is None else min(limit, self.k)
+        head = ' '.join(tokens[:-1] + [''])
+        with self._lock:
+            node = self._root
+            for char in tokens[-1]:
+                node = node.children.get(char)
+                if node is None:
+                    return []
+            return [head + term for _, term in node.top[:limit]]
+
+    def _bump(self, term: str, delta: int) -> None:
+        weight = self._weights[term] = self._weights.get(term, 0) + delta
+        entry, previous = (-weight, term), (delta - weight, term)
+        node = self._root
+        for char in term:
+            node = node.children.setdefault(char, _Node())
+            top = node.top
+            if previous in top:
+                top.remove(previous)
+            elif len(top) == self.k and entry >= top[-1]:
+                continue
+            bisect.insort(top, entry)
+            del top[self.k:]
@@ -0,0 +1,78 @@
+import heapq
+import itertools
+import math
+from typing import Hashable, Iterable, Iterator, List, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+
+_LEAF_SIZE = 8
+
+
+def to_xyz(lat: float, lng: float) -> Tuple[float, float, float]:
+    """The point of the unit sphere at ``lat``, ``lng`` (degrees)"""
+    lat, lng = math.radians(lat), math.radians(lng)
+    return math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat)
+
+
+def chord_to_km(chord: float) -> float:
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def distance_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great circle distance"""
+    return chord_to_km(math.dist(to_xyz(lat1, lng1), to_xyz(lat2, lng2)))
+
+
+class NearestIndex:
+    """A KD-tree over points of the earth, kept as unit vectors so that
+    straight line distances order them like great circle distances do, with
+    no special case for the poles or the antimeridian.
+
+    ``nearest`` walks the tree best first and yields the points lazily in
+    order of distance, so callers stop as soon as they found what they need.
+    The tree is immutable; rebuild it when the points change.
+    """
+
+    def __init__(self, points: Iterable[Tuple[Hashable, float, float]]):
+        entries = [(to_xyz(lat, lng), key) for key, lat, lng in points]
+        self._size = len(entries)
+        self._root = self._build(entries, 0) if entries else None
+
+    def __len__(self) -> int:
+        return self._size
+
+    @classmethod
+    def _build(cls, entries: List, depth: int):
+        if len(entries) <= _LEAF_SIZE:
+            return entries
+        axis = depth % 3
+        entries.sort(key=lambda entry: entry[0][axis])
+        middle = len(entries) // 2
+        return (
+            axis,
+            entries[middle][0][axis],
+            cls._build(entries[:middle], depth + 1),
+            cls._build(entries[middle:], depth + 1)
+        )
+
+    def nearest(self, lat: float, lng: float) -> Iterator[Tuple[float, Hashable]]:
+        """Yields ``(distance_km, key)`` of every point, nearest first"""
+        if self._root is None:
+            return
+        target = to_xyz(lat, lng)
+        counter = itertools.count()
+        # (lower bound of the distance, tie breaker, is a point, node or key)
+        heap = [(0.0, next(counter), False, self._root)]
+        while heap:
+            bound, _, is_point, item = heapq.heappop(heap)
+            if is_point:
+                yield chord_to_km(bound), item
+            elif isinstance(item, list):
+                for xyz, key in item:
+                    heapq.heappush(heap, (math.dist(target, xyz), next(counter), True, key))
+            else:
+                axis, split, low, high = item
+                offset = target[axis] - split
+                near, far = (low, high) if offset < 0 else (high, low)
+                heapq.heappush(heap, (bound, next(counter), False, near))
+                heapq.heappush(heap, (max(bound, abs(offset)), next(counter), False, far))
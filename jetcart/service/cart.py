@@ -14,6 +14,11 @@ class CartItemSchema(Schema):
     unit_price = fields.Float(required=True)
 
 
+class CartItemQuantitySchema(Schema):
+    quantity = fields.Int(required=True, validate=validate.Range(min=0))
+    unit_price = fields.Float()
+
+
 class CartSchema(Schema):
     items = fields.List(
         fields.Nested(CartItemSchema),
@@ -33,13 +38,19 @@ def create_cart(**kwargs) -> Dict:
 
 
 def fetch_cart(cart_id: str) -> Dict:
-    cart_dict = cart.get_cart_by_id(cart_id).as_dict()
+    cart_obj = cart.get_cart_by_id(cart_id)
+    if not cart_obj:
+        raise ValueError(f'Invalid cart ID {cart_id}')
+
+    cart_dict = cart_obj.as_dict()
+    products = catalog_service.fetch_product_summaries_by_skus(
+        item['sku']
+        for item in cart_dict['items']
+    )
     for item in cart_dict['items']:
-        sku = item['sku']
-        inv = catalog_service.fetch_inventory(sku)
-        product = catalog_service.fetch_product(inv.get('product_id'))
-        item['title'] = product['title']
-        item['image'] = product.get('images')[0]
+        product = products.get(item['sku']) or {}
+        item['title'] = product.get('title')
+        item['image'] = product.get('image')
     return cart_dict
 
 
@@ -59,6 +70,15 @@ def add_items(cart_id: str, items: List[Dict]) -> Dict:
         raise err
 
 
+def update_item(cart_id: str, sku: str, **kwargs) -> Dict:
+    try:
+        result = CartItemQuantitySchema().load(kwargs)
+        return cart.update_cart(cart_id, sku, **result).as_dict()
+    except ValidationError as err:
+        err.status_code = 400
+        raise err
+
+
 def checkout(cart_id: str) -> Dict:
     cart_obj = cart.get_cart_by_id(cart_id)
     if cart_obj:
@@ -1,11 +1,170 @@
+import base64
 import collections
-from typing import Dict, List, Union
+import json
+import threading
+import time
+from typing import Callable, Dict, List, Union, Iterable, Iterator, Tuple
 
-from jetcart.domain import catalog
+from bson import ObjectId
+from marshmallow import Schema, fields, validate, ValidationError
+
+from jetcart import sweeper
+from jetcart.cache import LRUCache
+from jetcart.domain import catalog, search, suggest
+
+MAX_PAGE_SIZE = 1000
+
+# Search traffic is heavily skewed towards a few hundred queries. Product
+# writes through this module drop every cached result.
+SEARCH_CACHE_SIZE = 2048
+SEARCH_CACHE_TTL_SECONDS = 60
+
+_search_cache = LRUCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL_SECONDS)
+
+_search_backend: search.SearchBackend = search.MongoTextSearchBackend()
+
+
+def set_search_backend(backend: search.SearchBackend) -> None:
+    global _search_backend
+    _search_backend = backend
+    _search_cache.invalidate()
+
+
+def build_search_index(batch_size: int = 1000) -> search.InvertedIndexSearchBackend:
+    """Builds an in memory search index with a single scan of the catalog"""
+    return search.InvertedIndexSearchBackend.build(catalog.iter_products(batch_size))
+
+
+MAX_SUGGESTIONS = 10
+
+# Built from a scan of the titles on the first suggestion request
+_suggestion_index: Union[suggest.SuggestionIndex, None] = None
+_suggestion_lock = threading.Lock()
+
+
+def _get_suggestion_index() -> suggest.SuggestionIndex:
+    global _suggestion_index
+    with _suggestion_lock:
+        if _suggestion_index is None:
+            _suggestion_index = suggest.SuggestionIndex.build(
+                catalog.iter_products(1000, 'title'),
+                MAX_SUGGESTIONS
+            )
+        return _suggestion_index
+
+
+def suggest_products(q: str = None, size: int = MAX_SUGGESTIONS) -> List[str]:
+    if size <= 0:
+        raise ValueError(f"Invalid size {size}")
+    return _get_suggestion_index().suggest(q, size)
+
+
+BULK_CHUNK_SIZE = 1000
+
+
+def _bulk_load(rows: Iterable[Union[Dict, str]], schema: Schema, key: str,
+               write: Callable[[List[Dict]], Dict], counts: Tuple[str, ...], chunk_size: int) -> Dict:
+    """Validates ``rows``, given as dicts or as the lines of NDJSON, and
+    passes the valid ones to ``write`` ``chunk_size`` at a time, so that a
+    stream of any length is loaded with a bounded amount of memory and a
+    constant number of round trips per chunk.
+
+    ``write`` returns ``counts``, which are summed up, and the ``(position in
+    chunk, message)`` of the rows it could not write. Bad rows are reported
+    by their position and ``key`` and do not stop the others.
+    """
+    started = time.monotonic()
+    stats = collections.Counter(dict.fromkeys(('received',) + counts, 0))
+    errors = []
+    chunk, positions = [], []
+
+    def flush():
+        try:
+            loaded, invalid = schema.load(chunk), {}
+        except ValidationError as err:
+            loaded, invalid = err.valid_data, err.messages
+        for i, messages in invalid.items():
+            errors.append(dict(row=positions[i], message=messages, **{key: chunk[i].get(key)}))
+        valid = [i for i in range(len(chunk)) if i not in invalid]
+        if valid:
+            result = write([loaded[i] for i in valid])
+            for i, message in result.pop('errors'):
+                errors.append(dict(row=positions[valid[i]], message=message, **{key: chunk[valid[i]][key]}))
+            stats.update(result)
+        chunk.clear()
+        positions.clear()
+
+    for position, row in enumerate(rows):
+        if isinstance(row, (str, bytes)):
+            if not row.strip():
+                continue
+            try:
+                row = json.loads(row)
+            except ValueError as err:
+                stats['received'] += 1
+                errors.append(dict(row=position, message=str(err), **{key: None}))
+                continue
+        stats['received'] += 1
+        if not isinstance(row, dict):
+            errors.append(dict(row=position, message='Expected an object', **{key: None}))
+            continue
+        chunk.append(row)
+        positions.append(position)
+        if len(chunk) == chunk_size:
+            flush()
+    if chunk:
+        flush()
+
+    seconds = time.monotonic() - started
+    return dict(
+        **stats,
+        failed=len(errors),
+        errors=sorted(errors, key=lambda error: error['row']),
+        seconds=round(seconds, 3),
+        rows_per_second=round(stats['received'] / seconds) if seconds else None
+    )
+
+
+class ProductSchema(Schema):
+    external_id = fields.Str(validate=validate.Length(min=1))
+    title = fields.Str(required=True, validate=validate.Length(min=1))
+    description = fields.Str(allow_none=True)
+    price = fields.Float(required=True, validate=validate.Range(min=0))
+    mrp = fields.Float(required=True, validate=validate.Range(min=0))
+    category = fields.Str(required=True, validate=validate.Length(min=1))
+    attrs = fields.Dict(keys=fields.Str())
+    images = fields.List(fields.Str())
+    sales_tax = fields.Float(validate=validate.Range(min=0))
+
+
+def _write_products(products: List[Dict]) -> Dict:
+    result = catalog.upsert_products(products)
+    created, updated = result.pop('created'), result.pop('updated')
+    for son in created + updated:
+        _search_backend.add_product(son)
+    _search_cache.invalidate()
+    with _suggestion_lock:
+        if _suggestion_index is not None:
+            for son in created:
+                _suggestion_index.add_title(son['title'])
+    return result
+
+
+def ingest_products(rows: Iterable[Union[Dict, str]], chunk_size: int = BULK_CHUNK_SIZE) -> Dict:
+    """Creates products from ``rows``, or updates the ones ingested before
+    with the same ``external_id``, see ``_bulk_load``"""
+    return _bulk_load(rows, ProductSchema(many=True), 'external_id', _write_products,
+                      ('inserted', 'upserted', 'modified'), chunk_size)
 
 
 def create_product(**kwargs) -> Dict:
-    return catalog.create_product(**kwargs).as_dict()
+    product = catalog.create_product(**kwargs)
+    _search_backend.add_product(product.to_mongo().to_dict())
+    _search_cache.invalidate()
+    with _suggestion_lock:
+        if _suggestion_index is not None:
+            _suggestion_index.add_title(product.title)
+    return product.as_dict()
 
 
 def fetch_product(product_id: str) -> Union[Dict, None]:
@@ -15,17 +174,24 @@ def fetch_product(product_id: str) -> Union[Dict, None]:
     return None
 
 
-def fetch_all_products_by_cat(cat: str, page: int, size: int) -> List[Dict]:
-    return [
-        prod.as_dict()
-        for prod in catalog.get_all_products_by_cat(cat, page, size)
-    ]
+def fetch_all_products_by_cat(cat: str, cursor: str = None, size: int = 20) -> Dict:
+    return _fetch_products_page(cursor, size, cat)
 
 
 def sanitize_kwargs(kwargs: Dict) -> Dict:
+    page, size = int(kwargs.get('page') or 0), int(kwargs.get('size') or 20)
+    if page < 0 or size <= 0:
+        raise ValueError(f"Invalid page {page} or size {size}")
     return {
         'title': kwargs.get('title'),
-        'filters': kwargs.get('filters') or {}
+        'filters': kwargs.get('filters') or {},
+        'page': page,
+        'size': min(size, MAX_PAGE_SIZE),
+        'facet_attrs': [
+            key
+            for key in (kwargs.get('facets') or '').split(',')
+            if key
+        ]
     }
 
 
@@ -35,32 +201,89 @@ import logging
 def search_products(**kwargs) -> Dict:
     kwargs = sanitize_kwargs(kwargs)
     logging.error(f'{kwargs}')
-    products = [
-        product.as_dict()
-        for product in catalog.search_products(**kwargs)
-    ]
+    kwargs['title'] = ' '.join((kwargs['title'] or '').lower().split())
+    if kwargs['title'] and _suggestion_index is not None:
+        _suggestion_index.record_search(kwargs['title'])
+    return _search_cache.get_or_load(
+        _search_cache_key(**kwargs),
+        lambda: _search_backend.search(**kwargs)
+    )
+
+
+def _search_cache_key(title: str, filters: Union[str, Dict], page: int, size: int, facet_attrs: List[str]) -> Tuple:
+    """Searches that only differ in the key order or formatting of the
+    filters share a key (titles are normalized by ``search_products``)"""
+    return (
+        title,
+        json.dumps(catalog.compile_filters(filters), sort_keys=True, separators=(',', ':')),
+        page,
+        size,
+        tuple(facet_attrs)
+    )
+
+
+def fetch_search_cache_stats() -> Dict:
+    return _search_cache.stats()
+
+
+def fetch_all_products(cursor: str = None, size: int = 10) -> Dict:
+    return _fetch_products_page(cursor, size)
+
+
+def _fetch_products_page(cursor: Union[str, None], size: int, cat: str = None) -> Dict:
+    """A page of product listings and the opaque cursor of the next page,
+    which is None on the last page"""
+    if size <= 0:
+        raise ValueError(f"Invalid page size {size}")
+    size = min(size, MAX_PAGE_SIZE)
+    products = catalog.as_listing(catalog.get_products_after(_decode_cursor(cursor), size, cat))
     return dict(
-        facets=compute_facets(products),
-        products=products
+        products=products,
+        next=_encode_cursor(products[-1]['id']) if len(products) == size else None
     )
 
 
-def compute_facets(products: List[Dict]) -> Dict[str, int]:
-    coll = collections.Counter()
-    for product in products:
-        coll[product['category']] += 1
-    return coll
+def _encode_cursor(product_id: str) -> str:
+    return base64.urlsafe_b64encode(product_id.encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor: Union[str, None]) -> Union[str, None]:
+    if not cursor:
+        return None
+    try:
+        product_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    except (ValueError, UnicodeDecodeError):
+        product_id = None
+    if not product_id or not ObjectId.is_valid(product_id):
+        raise ValueError(f"Invalid cursor [{cursor}]")
+    return product_id
 
 
-def fetch_all_products(page: int, size: int) -> List[Dict]:
-    return [
-        p.as_dict()
-        for p in catalog.get_all_products(page, size)
-    ]
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 100
+
+
+def export_products(batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[str]:
+    """Streams the whole catalog as newline delimited JSON, a chunk of
+    ``EXPORT_CHUNK_SIZE`` products at a time, holding no more than one cursor
+    batch in memory."""
+    chunk = []
+    for son in catalog.iter_products(batch_size):
+        chunk.append(json.dumps(catalog.product_from_son(son)))
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
 
 
 def delete_all_products() -> None:
     catalog.delete_all_products()
+    _search_backend.clear()
+    _search_cache.invalidate()
+    with _suggestion_lock:
+        if _suggestion_index is not None:
+            _suggestion_index.clear()
 
 
 def create_warehouse(**kwargs) -> Dict:
@@ -79,5 +302,170 @@ def fetch_inventory(sku: str) -> Dict:
     return catalog.get_inventory_by_id(sku).as_dict()
 
 
-def block_inventory(sku: str, quantity: int):
-    return
+class InventoryRowSchema(Schema):
+    sku = fields.Str(required=True, validate=validate.Length(min=1))
+    product_id = fields.Str(required=True)
+    warehouse_id = fields.Str(required=True)
+    quantity = fields.Int(required=True, validate=validate.Range(min=0))
+    buyer_limit = fields.Int(validate=validate.Range(min=1))
+
+
+def upsert_inventories(rows: Iterable[Union[Dict, str]], chunk_size: int = BULK_CHUNK_SIZE) -> Dict:
+    """Creates or overwrites inventories from ``rows``, see ``_bulk_load``"""
+    return _bulk_load(rows, InventoryRowSchema(many=True), 'sku', catalog.upsert_inventories,
+                      ('upserted', 'modified'), chunk_size)
+
+
+def set_warehouse_inventory(sku: str, warehouse_id: str, quantity: int) -> Dict:
+    return catalog.set_warehouse_inventory(sku, warehouse_id, int(quantity)).as_dict()
+
+
+def fetch_warehouse_inventories(sku: str) -> List[Dict]:
+    return [inv.as_dict() for inv in catalog.get_warehouse_inventories(sku)]
+
+
+def create_postal_code(**kwargs) -> Dict:
+    return catalog.create_postal_code(str(kwargs['code']), float(kwargs['lat']), float(kwargs['lng'])).as_dict()
+
+
+def _location(lat: float = None, lng: float = None, postal_code: str = None) -> Tuple[float, float]:
+    """A location given as ``lat`` and ``lng`` or as a known ``postal_code``,
+    ``(None, None)`` when neither is"""
+    if postal_code is not None:
+        location = catalog.get_postal_code_by_id(str(postal_code))
+        if not location:
+            raise ValueError(f"Unknown postal code [{postal_code}]")
+        return location.lat, location.lng
+    if lat is None or lng is None:
+        return None, None
+    return float(lat), float(lng)
+
+
+def select_fulfilment(sku: str, quantity: int, lat: float = None, lng: float = None,
+                      postal_code: str = None) -> List[Dict]:
+    """The warehouses to ship from to a location, given as ``lat`` and
+    ``lng`` or as a known ``postal_code``"""
+    lat, lng = _location(lat, lng, postal_code)
+    if lat is None:
+        raise ValueError("A postal code or a location is needed")
+    return catalog.select_fulfilment(sku, int(quantity), lat, lng)
+
+
+def shard_inventory(sku: str, shards: int) -> Dict:
+    return catalog.shard_inventory(sku, int(shards)).as_dict()
+
+
+def rebalance_inventories() -> Dict:
+    return catalog.rebalance_inventories()
+
+
+_inventory_sweeper: Union[sweeper.InventorySweeper, None] = None
+
+
+def start_inventory_sweeper(batch_size: int = sweeper.SWEEP_BATCH_SIZE,
+                            interval: float = sweeper.SWEEP_INTERVAL_SECONDS,
+                            rebalance: bool = False) -> Dict:
+    """Starts releasing expired holds from a thread of this process"""
+    global _inventory_sweeper
+    if _inventory_sweeper is None:
+        _inventory_sweeper = sweeper.InventorySweeper(batch_size, interval, rebalance).start()
+    return _inventory_sweeper.stats()
+
+
+def fetch_inventory_sweeper_stats() -> Dict:
+    if _inventory_sweeper is None:
+        return dict(running=False)
+    return _inventory_sweeper.stats()
+
+
+def fetch_categories_by_skus(skus: Iterable[str]) -> Dict[str, str]:
+    """Maps every known SKU to its product category.
+    SKUs without an inventory, a product or a category are left out."""
+    return {
+        sku: product.category
+        for sku, product in _fetch_products_by_skus(skus, 'category').items()
+        if product.category
+    }
+
+
+def fetch_product_summaries_by_skus(skus: Iterable[str]) -> Dict[str, Dict]:
+    """Maps every known SKU to the title and first image of its product.
+    SKUs without an inventory or a product are left out."""
+    return {
+        sku: dict(
+            title=product.title,
+            image=product.images[0] if product.images else None
+        )
+        for sku, product in _fetch_products_by_skus(skus, 'title', 'images').items()
+    }
+
+
+def _fetch_products_by_skus(skus: Iterable[str], *fields: str) -> Dict[str, catalog.Product]:
+    """Loads the products behind the given SKUs, restricted to ``fields``,
+    with one query for the inventories and one for the products however
+    many SKUs are asked for."""
+    sku_product = {
+        inv.sku: str(inv.product.id)
+        for inv in catalog.get_inventories_by_ids(set(skus), 'product')
+        if inv.product
+    }
+    if not sku_product:
+        return {}
+
+    products = {
+        str(product.id): product
+        for product in catalog.get_products_by_ids(set(sku_product.values()), *fields)
+    }
+    return {
+        sku: products[product_id]
+        for sku, product_id in sku_product.items()
+        if product_id in products
+    }
+
+
+def block_inventory(sku: str, quantity: int) -> Dict:
+    return reserve_inventory([dict(sku=sku, quantity=quantity)])
+
+
+class ReservationItemSchema(Schema):
+    sku = fields.Str(required=True)
+    quantity = fields.Int(required=True, validate=validate.Range(min=1))
+
+
+class ReservationSchema(Schema):
+    items = fields.List(
+        fields.Nested(ReservationItemSchema),
+        required=True,
+        validate=validate.Length(min=1)
+    )
+
+
+def reserve_inventory(items: List[Dict]) -> Dict:
+    """Holds the stock of every line of ``items``, e.g. the items of a cart,
+    under one reservation. Lines of the same SKU are added up."""
+    try:
+        result = ReservationSchema().load(dict(items=items))
+    except ValidationError as err:
+        err.status_code = 400
+        raise err
+    quantities = collections.Counter()
+    for item in result['items']:
+        quantities[item['sku']] += item['quantity']
+    return catalog.block_inventories(quantities).as_dict()
+
+
+def fetch_reservation(reservation_id: str) -> Union[Dict, None]:
+    reservation = catalog.get_reservation_by_id(reservation_id)
+    if reservation:
+        return reservation.as_dict()
+    return None
+
+
+def commit_reservation(reservation_id: str, lat: float = None, lng: float = None, postal_code: str = None) -> Dict:
+    """Commits a reservation, shipped from the warehouses nearest to the
+    delivery location, if given as in ``select_fulfilment``"""
+    return catalog.commit_reservation(reservation_id, *_location(lat, lng, postal_code)).as_dict()
+
+
+def release_reservation(reservation_id: str) -> Dict:
+    return catalog.release_reservation(reservation_id).as_dict()
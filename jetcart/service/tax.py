@@ -1,9 +1,29 @@
-from typing import Dict, List
+from types import MappingProxyType
+from typing import Dict, List, Iterable, Union, Mapping, NamedTuple
 
+from jetcart.cache import LRUCache
 from jetcart.domain import tax
 
 from marshmallow import Schema, fields, validate, ValidationError
 
+# Taxes change a few times a year, but are read on every cart calculation.
+# The cache is local to the process, so writes made by another process only
+# become visible once the TTL runs out.
+TAX_CACHE_SIZE = 1024
+TAX_CACHE_TTL_SECONDS = 300
+
+_cache = LRUCache(maxsize=TAX_CACHE_SIZE, ttl=TAX_CACHE_TTL_SECONDS)
+
+
+class CategoryTax(NamedTuple):
+    """All the taxes of a category folded into one rate (in percent) and the
+    comma separated tax types reported on cart items."""
+    rate: float
+    type: str
+
+
+NO_TAX = CategoryTax(rate=0.0, type='')
+
 
 class TaxSchema(Schema):
     value = fields.Float(required=True)
@@ -30,7 +50,9 @@ class TaxMappingSchema(Schema):
 def create_tax(**kwargs) -> Dict:
     try:
         tax_data = TaxSchema().load(kwargs)
-        return tax.create_tax(**tax_data).as_dict()
+        tax_obj = tax.create_tax(**tax_data)
+        _cache.invalidate()
+        return tax_obj.as_dict()
     except ValidationError as err:
         err.status_code = 400
         raise err
@@ -39,47 +61,112 @@ def create_tax(**kwargs) -> Dict:
 def fetch_tax(tax_type: str) -> Dict:
     if not tax_type:
         raise ValueError("Invalid tax type")
-    tax_data = tax.get_tax_by_id(tax_type)
+    tax_data = _cache.get_or_load(('tax', tax_type), lambda: _load_tax(tax_type))
     if not tax_data:
         raise ValueError(f"Unknown tax type [{tax_type}]")
-    return tax_data.as_dict()
+    return tax_data
+
+
+def _load_tax(tax_type: str) -> Union[Dict, None]:
+    tax_data = tax.get_tax_by_id(tax_type)
+    return tax_data.as_dict() if tax_data else None
 
 
 def fetch_all_taxes() -> List[Dict]:
-    return [
+    return _cache.get_or_load('taxes', lambda: [
         tax_obj.as_dict()
         for tax_obj in tax.get_all()
-    ]
+    ])
 
 
 def delete_all() -> None:
     tax.delete_all()
+    _cache.invalidate()
 
 
 def create_tax_mapping(**kwargs) -> Dict:
     try:
         mapping = TaxMappingSchema().load(kwargs)
-        return tax.create_tax_mapping(
+        mapping_obj = tax.create_tax_mapping(
             mapping['category'],
             tax_types=mapping['taxes']
-        ).as_dict()
+        )
+        _cache.invalidate()
+        return mapping_obj.as_dict()
     except ValidationError as err:
         err.status_code = 400
         raise err
 
 
 def fetch_all_tax_mappings() -> List[Dict]:
-    return [
+    return _cache.get_or_load('tax_mappings', lambda: [
         mapping.as_dict()
         for mapping in tax.get_all_tax_mappings()
-    ]
+    ])
+
+
+def delete_all_tax_mappings() -> None:
+    tax.delete_all_tax_mappings()
+    _cache.invalidate()
 
 
 def fetch_tax_by_category(cat: str) -> List[Dict]:
-    mapping = tax.get_tax_mapping_by_category(cat)
-    if not mapping:
-        raise ValueError(f"Unknown category {cat}")
+    category_tax = fetch_category_taxes([cat])[cat]
     return [
-        tax.get_tax_by_id(tax_type_obj.type).as_dict()
-        for tax_type_obj in mapping.taxes
+        fetch_tax(tax_type)
+        for tax_type in category_tax.type.split(',')
+        if tax_type
     ]
+
+
+def fetch_category_taxes(cats: Iterable[str]) -> Dict[str, CategoryTax]:
+    """Looks the given categories up in the rate table. A category missing from
+    the cached table may have been mapped by another process since it was
+    built, so the table is rebuilt once before the category is reported unknown."""
+    cats = set(cats)
+    table = fetch_tax_rate_table()
+    if not cats <= table.keys():
+        generation = _cache.generation
+        table = _build_tax_rate_table()
+        _cache.put('rate_table', table, generation)
+    unknown = cats - table.keys()
+    if unknown:
+        raise ValueError(f"Unknown category {', '.join(sorted(unknown))}")
+    return {
+        cat: table[cat]
+        for cat in cats
+    }
+
+
+def fetch_tax_rate_table() -> Mapping[str, CategoryTax]:
+    """Returns a read-only category -> ``CategoryTax`` table built from all the
+    tax mappings. Writes drop the cached table and the next read builds a new
+    one aside, so readers only ever see a complete table."""
+    return _cache.get_or_load('rate_table', _build_tax_rate_table)
+
+
+def _build_tax_rate_table() -> Mapping[str, CategoryTax]:
+    taxes = {
+        tax_obj.type: tax_obj.value
+        for tax_obj in tax.get_all()
+    }
+    table = {}
+    for mapping in tax.get_all_tax_mappings().no_dereference():
+        tax_ids = [
+            tax_ref.id
+            for tax_ref in mapping.taxes
+            if tax_ref.id in taxes
+        ]
+        table[mapping.category] = CategoryTax(
+            rate=sum(taxes[tax_id] for tax_id in tax_ids),
+            type=','.join(tax_ids)
+        )
+    return MappingProxyType(table)
+
+
+def fetch_cache_stats() -> Dict:
+    return _cache.stats()
+
+
+def invalidate_cache() -> None:
+    _cache.invalidate()
@@ -0,0 +1,149 @@
+"""Gives the stock of expired inventory holds back, either from a thread of
+every app process (see ``InventorySweeper.start``) or as a worker of its own:
+
+    python -m jetcart.sweeper --host mongodb://localhost --batch-size 500 --interval 10 [--rebalance]
+
+Some sweeper must always run: it also releases the holds of processes that
+died while blocking, and commits those of reservations committed by
+processes that died half way. Any number of sweepers can run, a lease in
+the database lets one of them sweep at a time and another take over within
+``SWEEP_LEASE_SECONDS`` of it dying.
+
+Blocks, commits and releases are only all or nothing on a replica set or a
+sharded cluster, where they run in transactions; a standalone server can
+lose stock to a crash, never oversell it.
+
+With --rebalance, stock given back to sharded SKUs is spread over their
+shards again after every sweep that released some.
+"""
+import argparse
+import logging
+import threading
+import time
+from typing import Dict
+
+from bson import ObjectId
+
+from jetcart.domain import catalog
+
+SWEEP_BATCH_SIZE = 500
+SWEEP_INTERVAL_SECONDS = 10
+SWEEP_LEASE = 'inventory-sweeper'
+SWEEP_LEASE_SECONDS = 60
+
+
+class InventorySweeper:
+    """Releases expired holds ``batch_size`` at a time every ``interval``
+    seconds, while it holds the sweeper lease; a sweep goes on with the next
+    batch straight away while the batches come back full."""
+
+    def __init__(self, batch_size: int = SWEEP_BATCH_SIZE, interval: float = SWEEP_INTERVAL_SECONDS,
+                 rebalance: bool = False):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.rebalance = rebalance
+        self.owner = str(ObjectId())
+        self.skus_rebalanced = 0
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.holds_released = 0
+        self.units_released = 0
+        self.last_run_at = None
+        self.last_run_seconds = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def sweep(self) -> Dict[str, int]:
+        """Releases every hold expired by now, returns how many holds and units"""
+        started = time.monotonic()
+        swept = dict(holds=0, units=0)
+        while True:
+            if not catalog.claim_lease(SWEEP_LEASE, self.owner, SWEEP_LEASE_SECONDS):
+                # another sweeper is at it
+                with self._lock:
+                    self.skipped += 1
+                return swept
+            released = catalog.release_expired_holds(self.batch_size)
+            swept['holds'] += released['holds']
+            swept['units'] += released['units']
+            if released['holds'] < self.batch_size or self._stopped.is_set():
+                break
+        rebalanced = 0
+        if self.rebalance and swept['units']:
+            rebalanced = catalog.rebalance_inventories()['skus']
+        with self._lock:
+            self.skus_rebalanced += rebalanced
+            self.runs += 1
+            self.holds_released += swept['holds']
+            self.units_released += swept['units']
+            self.last_run_at = time.time()
+            self.last_run_seconds = time.monotonic() - started
+        return swept
+
+    def run(self) -> None:
+        """Sweeps until ``stop``, surviving failed sweeps"""
+        while not self._stopped.is_set():
+            try:
+                self.sweep()
+            except Exception:
+                with self._lock:
+                    self.failures += 1
+                logging.exception('inventory sweep failed')
+            self._stopped.wait(self.interval)
+
+    def start(self) -> 'InventorySweeper':
+        self._thread = threading.Thread(target=self.run, name='inventory-sweeper', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = None) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(
+                running=bool(self._thread and self._thread.is_alive()),
+                batch_size=self.batch_size,
+                interval=self.interval,
+                rebalance=self.rebalance,
+                runs=self.runs,
+                skipped=self.skipped,
+                skus_rebalanced=self.skus_rebalanced,
+                failures=self.failures,
+                holds_released=self.holds_released,
+                units_released=self.units_released,
+                last_run_at=self.last_run_at,
+                last_run_seconds=self.last_run_seconds
+            )
+
+
+def main():
+    from mongoengine import connect
+
+    parser = argparse.ArgumentParser(description='Returns the stock of expired inventory holds')
+    parser.add_argument('--host', default='mongodb://localhost')
+    parser.add_argument('--db', default='jetcart')
+    parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE)
+    parser.add_argument('--interval', type=float, default=SWEEP_INTERVAL_SECONDS)
+    parser.add_argument('--rebalance', action='store_true', help='rebalance sharded SKUs after sweeps')
+    parser.add_argument('--once', action='store_true', help='sweep once and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    connect(args.db, host=args.host)
+    sweeper = InventorySweeper(args.batch_size, args.interval, args.rebalance)
+    if args.once:
+        logging.info(f'released {sweeper.sweep()}')
+        return
+    try:
+        sweeper.run()
+    except KeyboardInterrupt:
+        logging.info(f'stopped, {sweeper.stats()}')
+
+
+if __name__ == '__main__':
+    main()
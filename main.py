@@ -1,6 +1,10 @@
+import os
+
 from flask import Flask
 from mongoengine import connect
 
+from jetcart import sweeper
+from jetcart.service import catalog as catalog_service
 from views import cart
 from views import catalog
 from views import presentation
@@ -10,6 +14,22 @@ from views import oms
 app = Flask(__name__)
 connect('jetcart')
 
+# JETCART_SEARCH_BACKEND=index serves /product/search from an in memory index
+# built here, instead of the mongo text index
+if os.environ.get('JETCART_SEARCH_BACKEND') == 'index':
+    catalog_service.set_search_backend(catalog_service.build_search_index())
+
+# Every process runs an inventory sweeper thread, of which one at a time
+# sweeps (see jetcart.sweeper), unless JETCART_INVENTORY_SWEEPER=off because
+# `python -m jetcart.sweeper` runs next to the app. Inventory updates are only
+# atomic on a replica set or a sharded cluster.
+if os.environ.get('JETCART_INVENTORY_SWEEPER', 'thread') == 'thread':
+    catalog_service.start_inventory_sweeper(
+        int(os.environ.get('JETCART_SWEEP_BATCH_SIZE', sweeper.SWEEP_BATCH_SIZE)),
+        float(os.environ.get('JETCART_SWEEP_INTERVAL', sweeper.SWEEP_INTERVAL_SECONDS)),
+        os.environ.get('JETCART_SWEEP_REBALANCE') == '1'
+    )
+
 app.register_blueprint(catalog.blueprint)
 app.register_blueprint(cart.blueprint)
 app.register_blueprint(tax.blueprint)
@@ -1,8 +1,43 @@
 from typing import List, Union, Dict, Any
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
 import logging
 
+# BeautifulSoup tree builders, fastest first. lxml is optional; html.parser
+# ships with python and html5lib, the slowest, parses like browsers do.
+PARSERS = ('lxml', 'html.parser', 'html5lib')
+
+try:
+    import lxml  # noqa: F401
+
+    DEFAULT_PARSER = 'lxml'
+except ImportError:
+    DEFAULT_PARSER = 'html.parser'
+
+
+def available_parsers() -> List[str]:
+    parsers = []
+    for features in PARSERS:
+        try:
+            BeautifulSoup('', features=features)
+            parsers.append(features)
+        except FeatureNotFound:
+            pass
+    return parsers
+
+
+def strainer(*classes: str) -> SoupStrainer:
+    """Keeps only the elements having one of ``classes``, and their content"""
+    classes = set(classes)
+    return SoupStrainer(class_=lambda value: value is not None and not classes.isdisjoint(value.split()))
+
+
+def make_soup(html: str, features: str, parse_only: SoupStrainer = None) -> BeautifulSoup:
+    # html5lib builds the whole tree whatever parse_only says, and warns about it
+    if features == 'html5lib':
+        parse_only = None
+    return BeautifulSoup(html, features=features, parse_only=parse_only)
+
 
 def except_exceptions(fn):
     def decorator(*args, **kwargs):
@@ -16,19 +51,24 @@ def except_exceptions(fn):
 
 
 class FlipkartPLPExtractor:
-    def extract(self, html: str) -> List[str]:
+    STRAINER = strainer('_4ddWXP')
+
+    def __init__(self, features: str = DEFAULT_PARSER):
+        self.features = features
+
+    def extract(self, html: str, base_url: str = "https://www.flipkart.com") -> List[str]:
         """Returns a list of PDP URLs"""
-        soup = BeautifulSoup(html, features="html5lib")
+        soup = make_soup(html, self.features, self.STRAINER)
         links = []
         for div in soup.find_all('div', class_="_4ddWXP"):
             link = self._extract_link(div)
             if link:
-                links.append(self._add_scheme(link))
+                links.append(self._add_scheme(link, base_url))
         return links
 
-    def _add_scheme(self, url: str) -> str:
-        if not url.startswith('http:') or not url.startswith('https:'):
-            return f"https://www.flipkart.com{url}"
+    def _add_scheme(self, url: str, base_url: str) -> str:
+        if not url.startswith('http:') and not url.startswith('https:'):
+            return f"{base_url}{url}"
         return url
 
     def _extract_link(self, div) -> Union[str, None]:
@@ -41,8 +81,14 @@ class FlipkartPLPExtractor:
 
 
 class FlipkartPDPParser:
+    # the page is parsed once, into the few elements the extract_ methods look into
+    STRAINER = strainer('B_NuCI', '_1mXcCf', '_30jeq3', '_1MR4o5', '_3GnUWp')
+
+    def __init__(self, features: str = DEFAULT_PARSER):
+        self.features = features
+
     def extract(self, html: str) -> Dict:
-        soup = BeautifulSoup(html, features="html5lib")
+        soup = make_soup(html, self.features, self.STRAINER)
         return {
             'title': self.extract_title(soup),
             'description': self.extract_description(soup),
@@ -59,7 +105,6 @@ class FlipkartPDPParser:
                 a = div.find('a', class_="_2whKao")
                 if a:
                     categories.append(a.text)
-        print(categories)
         return categories
 
     def extract_title(self, soup: BeautifulSoup) -> str:
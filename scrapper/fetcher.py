@@ -1,11 +1,12 @@
 import logging
 from time import time
-from typing import Union, Dict
+from typing import Union
 
 import requests
 from mongoengine import connect, Document, StringField, IntField
 
-from scrapper.extractor import FlipkartPDPParser, FlipkartPLPExtractor
+from scrapper.extractor import FlipkartPDPParser
+from scrapper.pipeline import ScrapePipeline
 
 connect('nobita')
 
@@ -39,46 +40,16 @@ def fetch(url: str) -> str:
 # app = Flask(__name__)
 
 pdp_parser = FlipkartPDPParser()
-plp_parser = FlipkartPLPExtractor()
-
-CATALOG_BASE_URL = "http://localhost:5000/product"
 
 PLP_URLs = [
 ]
 
-import time
-
-
-def extract(plp_url):
-    html = fetch_network(plp_url)
-    pdp_links = plp_parser.extract(html) or []
-    for a_link in pdp_links:
-        time.sleep(get_sleep_interval(5))
-        try:
-            product_data = pdp_parser.extract(fetch_network(a_link))
-            add_to_catalog(product_data)
-        except Exception:
-            logging.error(f"Exception extracting PDP url {a_link}", exc_info=True)
-
 
 class Sequence(Document):
     name = StringField(primary_key=True, required=True)
     value = IntField(required=True, default=1)
 
 
-def add_to_catalog(body: Dict):
-    r = requests.post(CATALOG_BASE_URL, json=dict(
-        # id=str(_get_sequence("catalog.product")),
-        title=body['title'],
-        description=body['description'],
-        category=body['category'][1],
-        images=body['images'],
-        price=float(body['price'][1:]),
-        mrp=float(body['price'][1:])
-    ))
-    logging.error(f"{CATALOG_BASE_URL} - {r.status_code}")
-
-
 def _get_sequence(name: str):
     seq = Sequence.objects(name=name).first()
     if not seq:
@@ -90,15 +61,9 @@ def _get_sequence(name: str):
     return cur_val
 
 
-import random
-
-
-def get_sleep_interval(base_time=5):
-    return base_time + random.randint(1, base_time)
-
-
-for plp_url in PLP_URLs:
-    extract(plp_url)
+if PLP_URLs:
+    # fetches concurrently within the politeness budget, see scrapper.pipeline
+    ScrapePipeline().run(PLP_URLs)
 
 #
 # #
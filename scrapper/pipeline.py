@@ -0,0 +1,290 @@
+"""Scrapes PLPs into the catalog with stages connected by bounded queues:
+
+    PLPs -> PDP URLs -> fetchers -> pages -> parsers -> products -> sink
+
+PDPs are fetched concurrently by an asyncio event loop, as fast as the
+politeness budget of every host allows (see ``HostRateLimiter``); pages are
+parsed by a process pool, BeautifulSoup being CPU bound, and the products
+are sent to the catalog in batches through its bulk endpoint:
+
+    python -m scrapper.pipeline PLP_URL [PLP_URL ...] [--interval 5 --jitter 5 --host-concurrency 2]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import os
+import random
+import time
+from typing import Callable, Dict, Iterable, List, Union
+from urllib.parse import urlsplit
+
+import requests
+
+from scrapper.extractor import FlipkartPDPParser, FlipkartPLPExtractor, DEFAULT_PARSER, available_parsers
+
+CATALOG_BASE_URL = "http://localhost:5000/product"
+
+# the serial scraper slept 5-10 seconds between two PDPs of a host
+REQUEST_INTERVAL_SECONDS = 5
+REQUEST_JITTER_SECONDS = 5
+HOST_CONCURRENCY = 2
+FETCH_CONCURRENCY = 16
+FETCH_TIMEOUT_SECONDS = 30
+SINK_BATCH_SIZE = 100
+SINK_FLUSH_SECONDS = 30
+QUEUE_SIZE = 64
+
+# parsers of the worker process, by backend
+_pdp_parsers = {}
+_plp_parsers = {}
+
+
+def parse_pdp(html: str, features: str = DEFAULT_PARSER) -> Dict:
+    if features not in _pdp_parsers:
+        _pdp_parsers[features] = FlipkartPDPParser(features)
+    return _pdp_parsers[features].extract(html)
+
+
+def parse_plp(html: str, base_url: str, features: str = DEFAULT_PARSER) -> List[str]:
+    if features not in _plp_parsers:
+        _plp_parsers[features] = FlipkartPLPExtractor(features)
+    return _plp_parsers[features].extract(html, base_url)
+
+
+def to_catalog_product(pdp_url: str, body: Dict) -> Dict:
+    return dict(
+        # keyed by the PDP, so that scraping a page again updates the product
+        external_id=urlsplit(pdp_url).path,
+        title=body['title'],
+        description=body['description'],
+        category=body['category'][1],
+        images=body['images'],
+        price=float(body['price'][1:]),
+        mrp=float(body['price'][1:])
+    )
+
+
+def fetch_text(url: str) -> Union[str, None]:
+    r = requests.get(url, timeout=FETCH_TIMEOUT_SECONDS)
+    logging.info(f"{url} - {r.status_code} - {r.headers.get('content-length')}")
+    if r.status_code // 100 == 2:
+        return r.text
+    return None
+
+
+class CatalogSink:
+    """Sends products to the bulk ingestion endpoint of the catalog"""
+
+    def __init__(self, base_url: str = CATALOG_BASE_URL):
+        self.base_url = base_url
+
+    def __call__(self, products: List[Dict]) -> Dict:
+        r = requests.post(f"{self.base_url}/bulk", json=products, timeout=FETCH_TIMEOUT_SECONDS)
+        r.raise_for_status()
+        result = r.json()
+        for error in result['errors']:
+            logging.error(f"{self.base_url}/bulk rejected {error}")
+        return result
+
+
+class HostRateLimiter:
+    """Lets at most ``concurrency`` requests run against a host at a time,
+    starting at least ``interval`` seconds (plus up to ``jitter``) apart.
+    Hosts are limited independently, so the pipeline goes as fast as the sum
+    of their budgets."""
+
+    def __init__(self, interval: float = REQUEST_INTERVAL_SECONDS, jitter: float = REQUEST_JITTER_SECONDS,
+                 concurrency: int = HOST_CONCURRENCY):
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self._hosts = {}
+
+    def limit(self, url: str) -> '_HostLimit':
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = _HostLimit(self)
+        return self._hosts[host]
+
+
+class _HostLimit:
+    def __init__(self, limiter: HostRateLimiter):
+        self._limiter = limiter
+        self._running = asyncio.Semaphore(limiter.concurrency)
+        self._next_start = 0.0
+
+    async def __aenter__(self):
+        await self._running.acquire()
+        loop = asyncio.get_running_loop()
+        # reserve the next slot before sleeping, the ones waiting behind take the following slots
+        start = max(loop.time(), self._next_start)
+        self._next_start = start + self._limiter.interval + random.uniform(0, self._limiter.jitter)
+        await asyncio.sleep(start - loop.time())
+
+    async def __aexit__(self, *exc_info):
+        self._running.release()
+
+
+class ScrapePipeline:
+    """Scrapes the PDPs linked from PLPs into ``sink``, a callable taking a
+    batch of catalog products. Every stage keeps going past failed pages;
+    ``stats`` counts them."""
+
+    def __init__(self, sink: Callable[[List[Dict]], object] = None, limiter: HostRateLimiter = None,
+                 fetch: Callable[[str], Union[str, None]] = fetch_text, fetch_concurrency: int = FETCH_CONCURRENCY,
+                 parser_workers: int = None, batch_size: int = SINK_BATCH_SIZE,
+                 flush_interval: float = SINK_FLUSH_SECONDS, queue_size: int = QUEUE_SIZE,
+                 parser: str = DEFAULT_PARSER):
+        if parser not in available_parsers():
+            # the parser processes would fail every page
+            raise ValueError(f"Parser backend [{parser}] is not installed, pick one of {available_parsers()}")
+        self.sink = sink or CatalogSink()
+        self.limiter = limiter or HostRateLimiter()
+        self.fetch = fetch
+        self.fetch_concurrency = fetch_concurrency
+        self.parser_workers = parser_workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.parser = parser
+        self.stats = dict(plps=0, pdps=0, fetched=0, fetch_failures=0, parsed=0, parse_failures=0,
+                          products_sent=0, batches=0, sink_failures=0, seconds=None)
+
+    def run(self, plp_urls: Iterable[str]) -> Dict:
+        return asyncio.run(self.scrape(plp_urls))
+
+    async def scrape(self, plp_urls: Iterable[str]) -> Dict:
+        started = time.monotonic()
+        urls = asyncio.Queue(self.queue_size)
+        pages = asyncio.Queue(self.queue_size)
+        products = asyncio.Queue(self.queue_size)
+        with concurrent.futures.ThreadPoolExecutor(self.fetch_concurrency + 1) as io, \
+                concurrent.futures.ProcessPoolExecutor(self.parser_workers) as cpu:
+            fetchers = [asyncio.create_task(self._fetch_pdps(io, urls, pages)) for _ in range(self.fetch_concurrency)]
+            parsers = [asyncio.create_task(self._parse_pdps(cpu, pages, products)) for _ in range(self.parser_workers)]
+            sink = asyncio.create_task(self._send(io, products))
+
+            await self._read_plps(io, cpu, plp_urls, urls)
+            await self._close(urls, fetchers)
+            await self._close(pages, parsers)
+            await self._close(products, [sink])
+        self.stats['seconds'] = time.monotonic() - started
+        return self.stats
+
+    @staticmethod
+    async def _close(queue: asyncio.Queue, consumers: List[asyncio.Task]) -> None:
+        for _ in consumers:
+            await queue.put(None)
+        await asyncio.gather(*consumers)
+
+    async def _get(self, io, url: str) -> Union[str, None]:
+        async with self.limiter.limit(url):
+            try:
+                return await asyncio.get_running_loop().run_in_executor(io, self.fetch, url)
+            except Exception:
+                logging.error(f"Exception fetching {url}", exc_info=True)
+                return None
+
+    async def _read_plps(self, io, cpu, plp_urls: Iterable[str], urls: asyncio.Queue) -> None:
+        seen = set()
+        for plp_url in plp_urls:
+            self.stats['plps'] += 1
+            html = await self._get(io, plp_url)
+            if html is None:
+                self.stats['fetch_failures'] += 1
+                continue
+            base_url = '{0.scheme}://{0.netloc}'.format(urlsplit(plp_url))
+            try:
+                links = await asyncio.get_running_loop().run_in_executor(cpu, parse_plp, html, base_url, self.parser)
+            except Exception:
+                logging.error(f"Exception extracting PLP url {plp_url}", exc_info=True)
+                self.stats['parse_failures'] += 1
+                continue
+            for link in links:
+                if link not in seen:
+                    seen.add(link)
+                    self.stats['pdps'] += 1
+                    await urls.put(link)
+
+    async def _fetch_pdps(self, io, urls: asyncio.Queue, pages: asyncio.Queue) -> None:
+        while True:
+            url = await urls.get()
+            if url is None:
+                return
+            html = await self._get(io, url)
+            if html is None:
+                self.stats['fetch_failures'] += 1
+            else:
+                self.stats['fetched'] += 1
+                await pages.put((url, html))
+
+    async def _parse_pdps(self, cpu, pages: asyncio.Queue, products: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            page = await pages.get()
+            if page is None:
+                return
+            url, html = page
+            try:
+                product = to_catalog_product(url, await loop.run_in_executor(cpu, parse_pdp, html, self.parser))
+            except Exception:
+                logging.error(f"Exception extracting PDP url {url}", exc_info=True)
+                self.stats['parse_failures'] += 1
+                continue
+            self.stats['parsed'] += 1
+            await products.put(product)
+
+    async def _send(self, io, products: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = loop.time() + self.flush_interval
+        done = False
+        while not done:
+            try:
+                product = await asyncio.wait_for(products.get(), max(0.0, deadline - loop.time()))
+                done = product is None
+                if not done:
+                    batch.append(product)
+            except asyncio.TimeoutError:
+                pass
+            if batch and (done or len(batch) >= self.batch_size or loop.time() >= deadline):
+                try:
+                    await loop.run_in_executor(io, self.sink, batch)
+                    self.stats['products_sent'] += len(batch)
+                    self.stats['batches'] += 1
+                except Exception:
+                    logging.error(f"Exception sending {len(batch)} products", exc_info=True)
+                    self.stats['sink_failures'] += 1
+                batch = []
+            if loop.time() >= deadline or not batch:
+                deadline = loop.time() + self.flush_interval
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scrapes the PDPs linked from PLPs into the catalog')
+    parser.add_argument('plp_urls', nargs='+')
+    parser.add_argument('--catalog', default=CATALOG_BASE_URL)
+    parser.add_argument('--interval', type=float, default=REQUEST_INTERVAL_SECONDS)
+    parser.add_argument('--jitter', type=float, default=REQUEST_JITTER_SECONDS)
+    parser.add_argument('--host-concurrency', type=int, default=HOST_CONCURRENCY)
+    parser.add_argument('--fetch-concurrency', type=int, default=FETCH_CONCURRENCY)
+    parser.add_argument('--workers', type=int, default=None, help='parser processes, one per CPU by default')
+    parser.add_argument('--batch-size', type=int, default=SINK_BATCH_SIZE)
+    parser.add_argument('--parser', choices=available_parsers(), default=DEFAULT_PARSER, help='BeautifulSoup tree builder')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    pipeline = ScrapePipeline(
+        sink=CatalogSink(args.catalog),
+        limiter=HostRateLimiter(args.interval, args.jitter, args.host_concurrency),
+        fetch_concurrency=args.fetch_concurrency,
+        parser_workers=args.workers,
+        batch_size=args.batch_size,
+        parser=args.parser
+    )
+    logging.info(f'done, {pipeline.run(args.plp_urls)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,20 @@
+import json
+
 import requests
 
 
 def get_all_products():
-    r = requests.get('http://localhost:5000/product?page=0&size=50000')
-    return r.json()
+    with requests.get('http://localhost:5000/product/export', stream=True) as r:
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
 
 
 def define_taxes():
-    categories = [
+    categories = {
         prod_data.get('category')
         for prod_data in get_all_products()
-    ]
+    }
 
     tax_mapping_url = "http://localhost:5000//tax/mapping"
     for cat in categories:
@@ -1,17 +1,36 @@
 
 
+import itertools
+import json
+
 import requests
 
+BATCH_SIZE = 5000
+
+
+def get_all_products():
+    with requests.get('http://localhost:5000/product/export', stream=True) as r:
+        print(r.status_code)
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
+
 
-r = requests.get('http://localhost:5000/product?page=0&size=50000')
-print(r.status_code)
-for product_data in r.json():
-    inventory = dict(
-        sku=product_data['id'],
-        product_id=product_data['id'],
-        warehouse_id="WMS1",
-        quantity=100
+rows = (
+    dict(sku=product_data['id'], product_id=product_data['id'], warehouse_id="WMS1", quantity=100)
+    for product_data in get_all_products()
+)
+while True:
+    batch = list(itertools.islice(rows, BATCH_SIZE))
+    if not batch:
+        break
+    r = requests.post(
+        'http://localhost:5000/v1/inventory/bulk',
+        data='\n'.join(json.dumps(row) for row in batch),
+        headers={'Content-Type': 'application/x-ndjson'}
     )
-    r = requests.post('http://localhost:5000/v1/inventory', json=inventory)
-    print(r.status_code, r.json())
-    print('-'*80)
\ No newline at end of file
+    result = r.json()
+    print(r.status_code, {key: value for key, value in result.items() if key != 'errors'})
+    for error in result.get('errors', []):
+        print(error)
+    print('-'*80)
@@ -0,0 +1,276 @@
+import contextlib
+import random
+import unittest
+from unittest import mock
+
+import mongomock.collection
+from mongoengine import connect
+
+from jetcart.domain import cart, catalog, tax
+from jetcart.service import cart as cart_service
+from jetcart.service import tax as tax_service
+
+connect('jetcarttest', host='mongomock://localhost')
+
+
+@contextlib.contextmanager
+def count_queries():
+    """Counts the reads issued against mongo inside the block"""
+    queries = []
+    find = mongomock.collection.Collection.find
+
+    def counting_find(collection, *args, **kwargs):
+        queries.append(collection.name)
+        return find(collection, *args, **kwargs)
+
+    with mock.patch.object(mongomock.collection.Collection, 'find', counting_find):
+        yield queries
+
+
+class TestCart(unittest.TestCase):
+    def setUp(self) -> None:
+        catalog.create_warehouse(code='WMS1', name='Warehouse 1')
+        tax.create_tax(value=9, type='C_GST')
+        tax.create_tax(value=9, type='S_GST')
+        tax.create_tax(value=5, type='VAT')
+        tax.create_tax_mapping('mobile', ['C_GST', 'S_GST'])
+        tax.create_tax_mapping('book', ['VAT'])
+
+        self.skus = []
+        for i in range(30):
+            product = catalog.create_product(
+                title=f'product {i}',
+                price=100 + i,
+                mrp=100 + i,
+                category='mobile' if i % 2 else 'book'
+            )
+            catalog.create_inventory(
+                sku=f'sku-{i}',
+                product_id=str(product.id),
+                warehouse_id='WMS1',
+                quantity=10
+            )
+            self.skus.append(f'sku-{i}')
+
+    def tearDown(self) -> None:
+        cart.Cart.objects.delete()
+        catalog.Inventory.objects.delete()
+        catalog.delete_all_products()
+        tax_service.delete_all_tax_mappings()
+        tax_service.delete_all()
+
+    def _items(self, n):
+        return [
+            cart.CartItem(sku=sku, quantity=1, unit_price=100)
+            for sku in self.skus[:n]
+        ]
+
+    def test_add_items_merges_on_sku_and_price(self):
+        cart_obj = cart.Cart(items=[
+            cart.CartItem(sku='b', quantity=1, unit_price=10),
+            cart.CartItem(sku='a', quantity=1, unit_price=10),
+            cart.CartItem(sku='b', quantity=1, unit_price=20),
+        ])
+        first_line = cart_obj.items[0]
+        cart_obj.add_items([
+            cart.CartItem(sku='c', quantity=1, unit_price=10),
+            cart.CartItem(sku='b', quantity=2, unit_price=10),
+            cart.CartItem(sku='c', quantity=3, unit_price=10),
+            cart.CartItem(sku='b', quantity=1, unit_price=20),
+        ])
+        self.assertEqual(
+            [(item.sku, item.unit_price, item.quantity) for item in cart_obj.items],
+            [('b', 10, 3), ('a', 10, 1), ('b', 20, 2), ('c', 10, 4)]
+        )
+        self.assertIs(cart_obj.items[0], first_line)
+
+    def test_plan_additions_leaves_items_alone(self):
+        cart_obj = cart.Cart(items=[])
+        new_items = [cart.CartItem(sku='c', quantity=1, unit_price=10), cart.CartItem(sku='c', quantity=3, unit_price=10)]
+        _, appended = cart_obj.plan_additions(new_items)
+        self.assertEqual([item.quantity for item in appended], [4])
+        self.assertEqual([item.quantity for item in new_items], [1, 3])
+
+    def test_build_sku_tax_map(self):
+        sku_tax_map = cart.SimpleCartValueCalculator._build_sku_tax_map(self._items(3))
+        self.assertEqual(sku_tax_map, {
+            'sku-0': tax_service.CategoryTax(rate=5, type='VAT'),
+            'sku-1': tax_service.CategoryTax(rate=18, type='C_GST,S_GST'),
+            'sku-2': tax_service.CategoryTax(rate=5, type='VAT'),
+        })
+
+    def test_build_sku_tax_map_skips_unknown_sku(self):
+        items = self._items(1) + [cart.CartItem(sku='missing', quantity=1, unit_price=1)]
+        sku_tax_map = cart.SimpleCartValueCalculator._build_sku_tax_map(items)
+        self.assertEqual(list(sku_tax_map), ['sku-0'])
+
+    def test_tax_resolution_queries_do_not_grow_with_cart(self):
+        query_counts = []
+        for n in (1, 10, 30):
+            tax_service.invalidate_cache()
+            with count_queries() as queries:
+                cart.SimpleCartValueCalculator._build_sku_tax_map(self._items(n))
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts, [4, 4, 4])
+
+    def test_rate_table_is_reused_across_calculations(self):
+        cart.SimpleCartValueCalculator._build_sku_tax_map(self._items(1))
+        with count_queries() as queries:
+            cart.SimpleCartValueCalculator._build_sku_tax_map(self._items(30))
+        self.assertEqual(queries, ['inventory', 'product'])
+
+    def test_create_cart(self):
+        cart_obj = cart.create_cart(items=[
+            dict(sku='sku-0', quantity=2, unit_price=100),
+            dict(sku='sku-1', quantity=1, unit_price=200),
+        ])
+        self.assertAlmostEqual(cart_obj.value.total_value, 400)
+        self.assertAlmostEqual(cart_obj.value.total_sales_tax, 10 + 36)
+        self.assertAlmostEqual(cart_obj.value.total_payable_amount, 446)
+        self.assertEqual(cart_obj.items[1].sales_tax_type, 'C_GST,S_GST')
+
+    def test_add_items_matches_full_recalculation(self):
+        for seed in range(25):
+            rnd = random.Random(seed)
+
+            def random_items():
+                return [
+                    dict(
+                        sku=rnd.choice(self.skus[:8]),
+                        quantity=rnd.randint(1, 5),
+                        unit_price=rnd.choice([100, 150, 99.99])
+                    )
+                    for _ in range(rnd.randint(1, 6))
+                ]
+
+            cart_obj = cart.create_cart(items=random_items())
+            for _ in range(rnd.randint(1, 5)):
+                cart_obj = cart.add_items_to_cart(str(cart_obj.id), random_items())
+
+                expected_items = [cart.CartItem(**item.as_dict()) for item in cart_obj.items]
+                expected = cart.Cart(items=expected_items).calculate(cart.cart_value_calculator)
+                self.assertEqual(
+                    [item.as_dict() for item in cart_obj.items],
+                    [item.as_dict() for item in expected_items]
+                )
+                for field, value in expected.as_dict().items():
+                    self.assertAlmostEqual(getattr(cart_obj.value, field), value, places=6)
+
+    def test_add_items_prices_only_new_items(self):
+        cart_obj = cart.create_cart(items=[
+            dict(sku=sku, quantity=1, unit_price=100)
+            for sku in self.skus
+        ])
+        with count_queries() as queries:
+            cart_obj = cart.add_items_to_cart(str(cart_obj.id), [dict(sku='sku-1', quantity=2, unit_price=100)])
+        # the merged line keeps the tax it was priced with, nothing to look up
+        self.assertNotIn('inventory', queries)
+        self.assertEqual(cart_obj.items[1].quantity, 3)
+        self.assertEqual(cart_obj.items[1].unit_sales_tax, 18)
+        self.assertAlmostEqual(cart_obj.value.total_value, 3200)
+
+    def test_add_items_after_tax_change_keeps_lines_consistent(self):
+        cart_obj = cart.create_cart(items=[dict(sku='sku-1', quantity=1, unit_price=100)])
+        tax_service.create_tax_mapping(category='mobile', taxes=['VAT'])
+        cart_obj = cart.add_items_to_cart(str(cart_obj.id), [
+            dict(sku='sku-1', quantity=2, unit_price=100),
+            dict(sku='sku-3', quantity=1, unit_price=100),
+        ])
+        self.assertEqual([item.unit_sales_tax for item in cart_obj.items], [18, 5])
+        self.assertAlmostEqual(cart_obj.value.total_sales_tax, sum(
+            item.unit_sales_tax * item.quantity
+            for item in cart_obj.items
+        ))
+        self.assertAlmostEqual(cart_obj.value.total_sales_tax, 18 * 3 + 5)
+
+    def _record_updates(self):
+        updates = []
+        update_one = mongomock.collection.Collection.update_one
+
+        def recording_update_one(collection, query, update, *args, **kwargs):
+            updates.append(update)
+            return update_one(collection, query, update, *args, **kwargs)
+
+        return updates, mock.patch.object(mongomock.collection.Collection, 'update_one', recording_update_one)
+
+    def test_add_items_writes_only_changes(self):
+        cart_obj = cart.create_cart(items=[dict(sku='sku-0', quantity=1, unit_price=100)])
+        updates, patch = self._record_updates()
+        with patch:
+            cart.add_items_to_cart(str(cart_obj.id), [dict(sku='sku-0', quantity=2, unit_price=100)])
+            cart_obj = cart.add_items_to_cart(str(cart_obj.id), [dict(sku='sku-1', quantity=1, unit_price=200)])
+
+        self.assertEqual(updates[0]['$inc'], {'version': 1, 'items.0.quantity': 2})
+        self.assertNotIn('items', updates[0]['$set'])
+        self.assertEqual([item['sku'] for item in updates[1]['$push']['items']['$each']], ['sku-1'])
+        self.assertNotIn('items', updates[1]['$set'])
+
+        stored = cart.get_cart_by_id(str(cart_obj.id))
+        self.assertEqual(stored.version, 2)
+        self.assertEqual([item.as_dict() for item in stored.items], [item.as_dict() for item in cart_obj.items])
+        self.assertEqual(stored.value.as_dict(), cart_obj.value.as_dict())
+
+    def test_concurrent_add_items_are_not_lost(self):
+        cart_obj = cart.create_cart(items=[dict(sku='sku-0', quantity=1, unit_price=100)])
+        stale = cart.get_cart_by_id(str(cart_obj.id))
+
+        cart.add_items_to_cart(str(cart_obj.id), [dict(sku='sku-1', quantity=1, unit_price=100)])
+        self.assertFalse(cart._add_items_atomically(stale, [cart.CartItem(sku='sku-2', quantity=1, unit_price=100)]))
+
+        cart_obj = cart.add_items_to_cart(str(cart_obj.id), [dict(sku='sku-2', quantity=1, unit_price=100)])
+        self.assertEqual([item.sku for item in cart_obj.items], ['sku-0', 'sku-1', 'sku-2'])
+        self.assertAlmostEqual(cart.get_cart_by_id(str(cart_obj.id)).value.total_value, 300)
+
+    def test_add_items_gives_up_after_retries(self):
+        cart_obj = cart.create_cart(items=[dict(sku='sku-0', quantity=1, unit_price=100)])
+        with mock.patch.object(cart, '_add_items_atomically', return_value=False):
+            with self.assertRaises(cart.CartUpdateConflict):
+                cart.add_items_to_cart(str(cart_obj.id), [dict(sku='sku-0', quantity=1, unit_price=100)])
+
+    def test_update_cart(self):
+        cart_obj = cart.create_cart(items=[
+            dict(sku='sku-0', quantity=1, unit_price=100),
+            dict(sku='sku-1', quantity=2, unit_price=100),
+            dict(sku='sku-1', quantity=1, unit_price=150),
+        ])
+        updates, patch = self._record_updates()
+        with patch, count_queries() as queries:
+            cart_obj = cart.update_cart(str(cart_obj.id), 'sku-0', 4)
+        self.assertEqual(queries, ['cart'])
+        self.assertEqual(updates[0]['$set']['items.0.quantity'], 4)
+        self.assertEqual(cart_obj.items[0].quantity, 4)
+
+        with self.assertRaises(ValueError):
+            cart.update_cart(str(cart_obj.id), 'sku-1', 1)
+        with self.assertRaises(ValueError):
+            cart.update_cart(str(cart_obj.id), 'sku-9', 1)
+
+        cart_obj = cart.update_cart(str(cart_obj.id), 'sku-1', 0, unit_price=100)
+        self.assertEqual([(item.sku, item.unit_price) for item in cart_obj.items], [('sku-0', 100), ('sku-1', 150)])
+
+        stored = cart.get_cart_by_id(str(cart_obj.id))
+        self.assertEqual([item.as_dict() for item in stored.items], [item.as_dict() for item in cart_obj.items])
+        expected = cart.Cart(items=[cart.CartItem(**item.as_dict()) for item in stored.items]) \
+            .calculate(cart.cart_value_calculator)
+        for field, value in expected.as_dict().items():
+            self.assertAlmostEqual(getattr(stored.value, field), value, places=6)
+
+    def test_fetch_cart_hydrates_items_in_bulk(self):
+        catalog.Product.objects(title='product 1').update_one(set__images=['img-1', 'img-2'])
+        cart_obj = cart.create_cart(items=[
+            dict(sku=sku, quantity=1, unit_price=100)
+            for sku in self.skus
+        ] + [dict(sku='no-inventory', quantity=1, unit_price=100)])
+
+        with count_queries() as queries:
+            cart_dict = cart_service.fetch_cart(str(cart_obj.id))
+        self.assertEqual(queries, ['cart', 'inventory', 'product'])
+
+        items = {item['sku']: item for item in cart_dict['items']}
+        self.assertEqual((items['sku-1']['title'], items['sku-1']['image']), ('product 1', 'img-1'))
+        self.assertEqual((items['sku-2']['title'], items['sku-2']['image']), ('product 2', None))
+        self.assertEqual((items['no-inventory']['title'], items['no-inventory']['image']), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
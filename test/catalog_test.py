@@ -1,8 +1,18 @@
+import concurrent.futures
+import functools
+import json
+import sys
+import threading
+import types
 import unittest
+from unittest import mock
+from marshmallow import ValidationError
 from mongoengine import connect
 
 from jetcart.domain import catalog
+from jetcart.service import catalog as catalog_service
 from jetcart.domain.catalog import NotEnoughInventory
+from test.cart_test import count_queries
 
 connect('jetcarttest', host='mongomock://localhost')
 
@@ -17,9 +27,12 @@ class TestCatalog(unittest.TestCase):
             buyer_limit=5
         )
         inv.save()
+        catalog.create_warehouse(code='fake', name='fake')
 
     def tearDown(self) -> None:
-        pass
+        catalog.BlockedInventory.objects.delete()
+        catalog.Warehouse.objects.delete()
+        catalog.WarehouseInventory.objects.delete()
 
     def test_block_inventory(self):
         inv = catalog.get_inventory_by_id("abc")
@@ -35,6 +48,9 @@ class TestCatalog(unittest.TestCase):
         inv = catalog.get_inventory_by_id("abc")
         self.assertEqual(inv.quantity, 1)
 
+        catalog.block_inventory("abc", 1)
+        self.assertEqual(catalog.get_inventory_by_id("abc").quantity, 0)
+
         with self.assertRaises(NotEnoughInventory):
             catalog.block_inventory("abc", 1)
 
@@ -48,9 +64,775 @@ class TestCatalog(unittest.TestCase):
         with self.assertRaises(NotEnoughInventory):
             catalog.block_inventory("abc", 5)
 
+        with self.assertRaises(ValueError):
+            catalog.block_inventory("abc", 0)
+        self.assertEqual(catalog.get_inventory_by_id("abc").quantity, 3)
+
+    def test_block_inventory_gives_stock_back_when_hold_is_not_saved(self):
+        with mock.patch.object(catalog.BlockedInventory, 'save', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                catalog.block_inventory("abc", 2)
+        self.assertEqual(catalog.get_inventory_by_id("abc").quantity, 3)
+
+    def test_no_oversell_under_concurrent_buyers(self):
+        catalog.update_inventory("abc", 100)
+        buyers = 1000
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        start = threading.Barrier(50)
+
+        def buy(i):
+            if i < 50:
+                start.wait()
+            try:
+                return catalog.block_inventory("abc", 1 + i % 2)
+            except NotEnoughInventory:
+                return None
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
+                holds = [hold for hold in executor.map(buy, range(buyers)) if hold]
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        blocked = catalog.BlockedInventory.objects(id__in=holds).sum('quantity')
+        self.assertEqual(blocked + catalog.get_inventory_by_id("abc").quantity, 100)
+        self.assertGreaterEqual(blocked, 99)
+        self.assertEqual(len(holds), len(set(holds)))
+
+    def test_commit_inventory(self):
+        blocked_inv_id = catalog.block_inventory("abc", 2)
+        catalog.commit_inventory(blocked_inv_id)
+        catalog.commit_inventory(blocked_inv_id)
+        self.assertEqual(catalog.get_blocked_inventory_by_id(blocked_inv_id).state,
+                         str(catalog.BlockedInventoryState.COMMITTED))
+        self.assertEqual(catalog.get_inventory_by_id("abc").quantity, 1)
+
+        expired_id = catalog.block_inventory("abc", 1)
+        catalog.BlockedInventory.objects(id=expired_id).update_one(set__expiry=0)
+        with self.assertRaises(catalog.BlockedInventoryExpired):
+            catalog.commit_inventory(expired_id)
+
+        with self.assertRaises(ValueError):
+            catalog.commit_inventory('5f0000000000000000000000')
+
     def test_something(self):
         self.assertEqual(True, False)
 
 
+class TestReservation(unittest.TestCase):
+    def setUp(self) -> None:
+        for sku, quantity in (('a', 5), ('b', 5), ('c', 1)):
+            catalog.Inventory(sku=sku, product='fake', warehouse='fake', quantity=quantity, buyer_limit=3).save()
+
+    def tearDown(self) -> None:
+        catalog.Inventory.objects.delete()
+        catalog.BlockedInventory.objects.delete()
+        catalog.Reservation.objects.delete()
+
+    def _quantities(self):
+        return {inv.sku: inv.quantity for inv in catalog.Inventory.objects(sku__in=['a', 'b', 'c'])}
+
+    def test_block_inventories(self):
+        with count_queries() as queries:
+            reservation = catalog.block_inventories({'a': 2, 'b': 3, 'c': 1})
+        self.assertEqual(queries, [])
+        self.assertEqual(self._quantities(), {'a': 3, 'b': 2, 'c': 0})
+        self.assertEqual(
+            sorted((hold.sku, hold.quantity) for hold in catalog.BlockedInventory.objects(reservation=str(reservation.id))),
+            [('a', 2), ('b', 3), ('c', 1)]
+        )
+
+    def test_block_inventories_is_all_or_nothing(self):
+        for items, error in (({'a': 2, 'c': 2}, NotEnoughInventory),
+                             ({'a': 2, 'b': 4}, ValueError),
+                             ({'a': 2, 'unknown': 1}, ValueError)):
+            with self.assertRaises(error, msg=items):
+                catalog.block_inventories(items)
+            self.assertEqual(self._quantities(), {'a': 5, 'b': 5, 'c': 1})
+
+        with self._failing_reservations(RuntimeError):
+            with self.assertRaises(RuntimeError):
+                catalog.block_inventories({'a': 1, 'b': 1})
+        self.assertEqual(self._quantities(), {'a': 5, 'b': 5, 'c': 1})
+        self.assertEqual(catalog.BlockedInventory.objects.count(), 0)
+
+    def _failing_reservations(self, error):
+        reservations = mock.Mock(**{'insert_one.side_effect': error})
+        return mock.patch.object(catalog.Reservation, '_get_collection', return_value=reservations)
+
+    def test_commit_reservation(self):
+        reservation_id = str(catalog.block_inventories({'a': 2, 'b': 1}).id)
+        self.assertEqual(catalog.commit_reservation(reservation_id).state, str(catalog.BlockedInventoryState.COMMITTED))
+        catalog.commit_reservation(reservation_id)
+        self.assertEqual(
+            set(catalog.BlockedInventory.objects(reservation=reservation_id).distinct('state')),
+            {str(catalog.BlockedInventoryState.COMMITTED)}
+        )
+        with self.assertRaises(ValueError):
+            catalog.release_reservation(reservation_id)
+        self.assertEqual(self._quantities(), {'a': 3, 'b': 4, 'c': 1})
+
+    def test_release_reservation(self):
+        reservation_id = str(catalog.block_inventories({'a': 2, 'b': 1}).id)
+        catalog.release_reservation(reservation_id)
+        catalog.release_reservation(reservation_id)
+        self.assertEqual(self._quantities(), {'a': 5, 'b': 5, 'c': 1})
+        with self.assertRaises(catalog.BlockedInventoryExpired):
+            catalog.commit_reservation(reservation_id)
+        with self.assertRaises(ValueError):
+            catalog.commit_reservation('5f0000000000000000000000')
+
+    def test_expired_reservation(self):
+        reservation = catalog.block_inventories({'a': 2, 'b': 1})
+        reservation_id = str(reservation.id)
+        catalog.Reservation.objects(id=reservation_id).update_one(set__expiry=0)
+        with self.assertRaises(catalog.BlockedInventoryExpired):
+            catalog.commit_reservation(reservation_id)
+
+        self.assertEqual(catalog.release_expired_holds(now=reservation.expiry), dict(holds=0, units=0))
+        now = reservation.expiry + catalog.RESERVATION_GRACE_SECONDS + 1
+        self.assertEqual(catalog.release_expired_holds(now=now), dict(holds=2, units=3))
+        catalog.release_reservation(reservation_id)
+        self.assertEqual(self._quantities(), {'a': 5, 'b': 5, 'c': 1})
+
+    def test_sweeper_releases_reservation_that_died_unsaved(self):
+        # dies after recording the holds, before the reservation
+        with self._failing_reservations(SystemExit):
+            with self.assertRaises(SystemExit):
+                catalog.block_inventories({'a': 2, 'b': 1})
+        self.assertEqual(self._quantities(), {'a': 3, 'b': 4, 'c': 1})
+
+        now = catalog._expiry_time() + catalog.RESERVATION_GRACE_SECONDS + 1
+        self.assertEqual(catalog.release_expired_holds(now=now), dict(holds=2, units=3))
+        self.assertEqual(self._quantities(), {'a': 5, 'b': 5, 'c': 1})
+        self.assertEqual(catalog.release_expired_holds(now=now), dict(holds=0, units=0))
+
+    def test_sweeper_commits_holds_of_committed_reservation(self):
+        reservation = catalog.block_inventories({'a': 2, 'b': 1})
+        reservation_id = str(reservation.id)
+        # dies after committing the reservation, before its holds
+        catalog.Reservation.objects(id=reservation_id).update_one(set__state=str(catalog.BlockedInventoryState.COMMITTED))
+
+        now = reservation.expiry + catalog.RESERVATION_GRACE_SECONDS + 1
+        self.assertEqual(catalog.release_expired_holds(now=now), dict(holds=0, units=0))
+        self.assertEqual(self._quantities(), {'a': 3, 'b': 4, 'c': 1})
+        self.assertEqual(set(catalog.BlockedInventory.objects(reservation=reservation_id).distinct('state')),
+                         {str(catalog.BlockedInventoryState.COMMITTED)})
+
+    def test_commit_again_commits_holds(self):
+        reservation_id = str(catalog.block_inventories({'a': 2}).id)
+        catalog.Reservation.objects(id=reservation_id).update_one(set__state=str(catalog.BlockedInventoryState.COMMITTED))
+        catalog.commit_reservation(reservation_id)
+        self.assertEqual(set(catalog.BlockedInventory.objects(reservation=reservation_id).distinct('state')),
+                         {str(catalog.BlockedInventoryState.COMMITTED)})
+
+    def test_reserve_inventory(self):
+        reservation = catalog_service.reserve_inventory([
+            dict(sku='a', quantity=1),
+            dict(sku='b', quantity=1),
+            dict(sku='a', quantity=2),
+        ])
+        self.assertEqual(self._quantities(), {'a': 2, 'b': 4, 'c': 1})
+        self.assertEqual(catalog_service.fetch_reservation(reservation['id']), reservation)
+        self.assertEqual(catalog_service.commit_reservation(reservation['id'])['state'],
+                         str(catalog.BlockedInventoryState.COMMITTED))
+
+        catalog_service.block_inventory('c', 1)
+        self.assertEqual(self._quantities()['c'], 0)
+        for items in ([], [dict(sku='a', quantity=0)], [dict(sku='a')]):
+            with self.assertRaises(ValidationError, msg=items):
+                catalog_service.reserve_inventory(items)
+
+
+class TestInventoryShards(unittest.TestCase):
+    def setUp(self) -> None:
+        catalog.Inventory(sku='hot', product='fake', warehouse='fake', quantity=10, buyer_limit=3).save()
+        catalog.Inventory(sku='cold', product='fake', warehouse='fake', quantity=10, buyer_limit=3).save()
+        catalog.create_warehouse(code='fake', name='fake')
+
+    def tearDown(self) -> None:
+        catalog.Inventory.objects.delete()
+        catalog.InventoryShard.objects.delete()
+        catalog.Warehouse.objects.delete()
+        catalog.WarehouseInventory.objects.delete()
+        catalog.BlockedInventory.objects.delete()
+        catalog.Reservation.objects.delete()
+        catalog._sharded_inventories.invalidate()
+
+    def _shards(self):
+        return {shard.id: shard.quantity for shard in catalog.InventoryShard.objects(sku='hot')}
+
+    def test_shard_and_unshard(self):
+        inventory = catalog.shard_inventory('hot', 3)
+        self.assertEqual(inventory.quantity, 10)
+        self.assertEqual(self._shards(), {'hot:0': 4, 'hot:1': 3, 'hot:2': 3})
+        self.assertEqual(catalog.Inventory.objects(sku='hot').first().quantity, 0)
+
+        catalog.shard_inventory('hot', 2)
+        self.assertEqual(self._shards(), {'hot:0': 5, 'hot:1': 5})
+
+        inventory = catalog.shard_inventory('hot', 0)
+        self.assertEqual((inventory.quantity, self._shards()), (10, {}))
+        with self.assertRaises(ValueError):
+            catalog.shard_inventory('unknown', 2)
+
+    def test_block_from_shards(self):
+        catalog.shard_inventory('hot', 4)
+        for _ in range(4):
+            catalog.block_inventory('hot', 2)
+        self.assertEqual(catalog.get_inventory_by_id('hot').quantity, 2)
+        # whatever the shards are left with, no single one holds 2 units
+        catalog.InventoryShard.objects(sku='hot').update(set__quantity=0)
+        catalog.InventoryShard.objects(id='hot:1').update_one(set__quantity=1)
+        catalog.Inventory.objects(sku='hot').update_one(set__quantity=1)
+        catalog.block_inventory('hot', 2)
+        self.assertEqual(catalog.get_inventory_by_id('hot').quantity, 0)
+        with self.assertRaises(NotEnoughInventory):
+            catalog.block_inventory('hot', 1)
+        with self.assertRaises(ValueError):
+            catalog.block_inventory('hot', 4)
+
+    def test_released_stock_is_rebalanced(self):
+        catalog.shard_inventory('hot', 2)
+        blocked_inv_id = catalog.block_inventory('hot', 3)
+        catalog.BlockedInventory.objects(id=blocked_inv_id).update_one(set__expiry=0)
+        catalog.release_expired_holds()
+        self.assertEqual(catalog.Inventory.objects(sku='hot').first().quantity, 3)
+        self.assertEqual(catalog.get_inventory_by_id('hot').quantity, 10)
+
+        self.assertEqual(catalog.rebalance_inventories(), dict(skus=1, quantity=10))
+        self.assertEqual(self._shards(), {'hot:0': 5, 'hot:1': 5})
+        self.assertEqual(catalog.update_inventory('hot', 7).quantity, 7)
+        self.assertEqual(self._shards(), {'hot:0': 4, 'hot:1': 3})
+
+    def test_update_inventory_goes_through_the_warehouse(self):
+        catalog.shard_inventory('hot', 2)
+        catalog.block_inventory('hot', 2)
+        self.assertEqual(catalog.update_inventory('hot', 5).quantity, 5)
+        # the held units are still in the warehouse
+        self.assertEqual(catalog.WarehouseInventory.objects(sku='hot', warehouse='fake').first().quantity, 7)
+        self.assertEqual(catalog.update_inventory('hot', 9).quantity, 9)
+        self.assertEqual(catalog.WarehouseInventory.objects(sku='hot', warehouse='fake').first().quantity, 11)
+
+        catalog.Warehouse.objects(code='fake').delete()
+        with self.assertRaises(ValueError):
+            catalog.update_inventory('cold', 5)
+        with self.assertRaises(ValueError):
+            catalog.create_inventory(sku='cold', product_id='5f0000000000000000000000', warehouse_id='fake',
+                                     quantity=5)
+        self.assertEqual(catalog.get_inventory_by_id('cold').quantity, 10)
+
+    def test_rebalance_keeps_stock_for_concurrent_blocks(self):
+        catalog.shard_inventory('hot', 2)
+
+        def block_then_move(move, source, destination, quantity, session=None):
+            # every move leaves the rest of the stock sellable
+            catalog.block_inventory('hot', 1)
+            return move(source, destination, quantity, session)
+
+        move = catalog._move
+        with mock.patch.object(catalog, '_move', side_effect=functools.partial(block_then_move, move)):
+            catalog.shard_inventory('hot', 3)
+        self.assertEqual(catalog.get_inventory_by_id('hot').quantity + catalog.BlockedInventory.objects.sum('quantity'), 10)
+        self.assertEqual(catalog.Inventory.objects(sku='hot').first().quantity, 0)
+
+    def test_block_more_than_any_shard_holds(self):
+        catalog.Inventory.objects(sku='hot').update_one(set__quantity=9, set__buyer_limit=10)
+        catalog.shard_inventory('hot', 3)
+        self.assertEqual(self._shards(), {'hot:0': 3, 'hot:1': 3, 'hot:2': 3})
+        catalog.block_inventory('hot', 5)
+        catalog.block_inventories({'hot': 4})
+        self.assertEqual(catalog.get_inventory_by_id('hot').quantity, 0)
+        with self.assertRaises(NotEnoughInventory):
+            catalog.block_inventory('hot', 1)
+
+        catalog.Inventory.objects(sku='hot').update_one(set__quantity=7)
+        catalog.rebalance_inventory('hot')
+        catalog.block_inventory('hot', 5)
+        # what is left is spread over the shards again
+        self.assertEqual(self._shards(), {'hot:0': 1, 'hot:1': 1, 'hot:2': 0})
+
+    def test_block_inventories_with_sharded_sku(self):
+        catalog.shard_inventory('hot', 2)
+        reservation = catalog.block_inventories({'hot': 3, 'cold': 2})
+        self.assertEqual(catalog.get_inventory_by_id('hot').quantity, 7)
+        catalog.release_reservation(str(reservation.id))
+        self.assertEqual(catalog.get_inventory_by_id('hot').quantity, 10)
+
+        catalog.InventoryShard.objects(sku='hot').update(set__quantity=1)
+        catalog.Inventory.objects(sku='hot').update_one(set__quantity=0)
+        with self.assertRaises(NotEnoughInventory):
+            catalog.block_inventories({'hot': 3, 'cold': 2})
+        self.assertEqual(catalog.get_inventory_by_id('cold').quantity, 10)
+        self.assertEqual(catalog.get_inventory_by_id('hot').quantity, 2)
+
+    def test_no_oversell_with_shards(self):
+        catalog.update_inventory('hot', 100)
+        catalog.shard_inventory('hot', 8)
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+        def buy(i):
+            try:
+                return catalog.block_inventory('hot', 1 + i % 3)
+            except NotEnoughInventory:
+                return None
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
+                holds = [hold for hold in executor.map(buy, range(1000)) if hold]
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        blocked = catalog.BlockedInventory.objects(id__in=holds).sum('quantity')
+        self.assertEqual(blocked + catalog.get_inventory_by_id('hot').quantity, 100)
+        self.assertGreaterEqual(blocked, 90)
+
+
+class TestFulfilment(unittest.TestCase):
+    def setUp(self) -> None:
+        for code, lat, lng in (('DEL', 28.61, 77.21), ('BOM', 19.08, 72.88), ('BLR', 12.97, 77.59), ('MAA', 13.08, 80.27)):
+            catalog_service.create_warehouse(code=code, name=code, lat=lat, lng=lng)
+        catalog_service.create_warehouse(code='NOWHERE', name='no location')
+        product = catalog.create_product(title='phone', price=1, mrp=1, category='mobile')
+        catalog.create_inventory(sku='phone', product_id=str(product.id), warehouse_id='DEL', quantity=2)
+
+    def tearDown(self) -> None:
+        catalog.Inventory.objects.delete()
+        catalog.WarehouseInventory.objects.delete()
+        catalog.Warehouse.objects.delete()
+        catalog.PostalCode.objects.delete()
+        catalog.BlockedInventory.objects.delete()
+        catalog.Reservation.objects.delete()
+        catalog_service.delete_all_products()
+
+    def test_warehouse_keeps_location(self):
+        self.assertEqual(catalog_service.fetch_warehouse('BLR'), dict(code='BLR', name='BLR', lat=12.97, lng=77.59))
+
+    def test_set_warehouse_inventory(self):
+        self.assertEqual(catalog_service.fetch_warehouse_inventories('phone'),
+                         [dict(sku='phone', warehouse_id='DEL', quantity=2)])
+        catalog_service.set_warehouse_inventory('phone', 'BLR', 5)
+        catalog_service.set_warehouse_inventory('phone', 'DEL', 1)
+        self.assertEqual(catalog.get_inventory_by_id('phone').quantity, 6)
+        with self.assertRaises(ValueError):
+            catalog_service.set_warehouse_inventory('phone', 'XXX', 1)
+        with self.assertRaises(ValueError):
+            catalog_service.set_warehouse_inventory('unknown', 'BLR', 1)
+
+    def test_select_nearest_warehouses_with_stock(self):
+        catalog.set_warehouse_inventory('phone', 'MAA', 1)
+        catalog.set_warehouse_inventory('phone', 'BOM', 4)
+        catalog.set_warehouse_inventory('phone', 'NOWHERE', 10)
+        catalog_service.create_postal_code(code=560001, lat=12.97, lng=77.6)
+        catalog.get_warehouse_index()
+
+        with count_queries() as queries:
+            selected = catalog_service.select_fulfilment('phone', 3, postal_code='560001')
+        self.assertEqual(queries, ['postal_code', 'warehouse_inventory', 'inventory'])
+        self.assertEqual([(row['warehouse_id'], row['quantity']) for row in selected], [('MAA', 1), ('BOM', 2)])
+        self.assertLess(selected[0]['distance_km'], selected[1]['distance_km'])
+
+        selected = catalog_service.select_fulfilment('phone', 7, lat=29, lng=77)
+        self.assertEqual([(row['warehouse_id'], row['quantity']) for row in selected], [('DEL', 2), ('BOM', 4), ('MAA', 1)])
+        with self.assertRaises(NotEnoughInventory):
+            catalog_service.select_fulfilment('phone', 8, lat=29, lng=77)
+        with self.assertRaises(NotEnoughInventory):
+            catalog_service.select_fulfilment('phone', 20, lat=29, lng=77)
+        with self.assertRaises(ValueError):
+            catalog_service.select_fulfilment('phone', 1, postal_code='1')
+
+    def test_postal_codes_keep_leading_zeros(self):
+        catalog_service.create_postal_code(code='010001', lat=28.6, lng=77.2)
+        selected = catalog_service.select_fulfilment('phone', 1, postal_code='010001')
+        self.assertEqual([row['warehouse_id'] for row in selected], ['DEL'])
+        with self.assertRaises(ValueError):
+            catalog_service.select_fulfilment('phone', 1, postal_code='10001')
+
+    def test_select_leaves_out_sold_and_held_stock(self):
+        catalog.set_warehouse_inventory('phone', 'BLR', 5)
+        reservation = catalog.block_inventories({'phone': 3})
+        catalog_service.commit_reservation(str(reservation.id), lat=12.97, lng=77.6)
+        self.assertEqual({row['warehouse_id']: row['quantity'] for row in catalog_service.fetch_warehouse_inventories('phone')},
+                         {'DEL': 2, 'BLR': 2})
+        self.assertEqual(catalog.BlockedInventory.objects(reservation=str(reservation.id)).first().fulfilment,
+                         [dict(warehouse_id='BLR', quantity=3)])
+        selected = catalog_service.select_fulfilment('phone', 3, lat=12.97, lng=77.6)
+        self.assertEqual([(row['warehouse_id'], row['quantity']) for row in selected], [('BLR', 2), ('DEL', 1)])
+
+        # held by a buyer, still in the warehouses but not for sale
+        catalog.block_inventories({'phone': 2})
+        with self.assertRaises(NotEnoughInventory):
+            catalog_service.select_fulfilment('phone', 3, lat=12.97, lng=77.6)
+        catalog_service.select_fulfilment('phone', 2, lat=12.97, lng=77.6)
+
+    def test_commit_allocates_once(self):
+        reservation_id = str(catalog.block_inventories({'phone': 1}).id)
+        catalog.commit_reservation(reservation_id)
+        catalog.commit_reservation(reservation_id)
+        self.assertEqual(catalog.WarehouseInventory.objects(sku='phone').first().quantity, 1)
+
+    def test_commit_picks_again_when_stock_was_taken(self):
+        catalog.set_warehouse_inventory('phone', 'BLR', 1)
+        reservation_id = str(catalog.block_inventories({'phone': 1}).id)
+        stale = catalog._warehouse_stock(['phone'])
+        # another commit takes the unit in BLR once it was read
+        catalog.WarehouseInventory.objects(sku='phone', warehouse='BLR').update_one(set__quantity=0)
+        with mock.patch.object(catalog, '_warehouse_stock', side_effect=[stale, catalog._warehouse_stock(['phone'])]):
+            catalog.commit_reservation(reservation_id, lat=12.97, lng=77.6)
+        self.assertEqual(catalog.BlockedInventory.objects(reservation=reservation_id).first().fulfilment,
+                         [dict(warehouse_id='DEL', quantity=1)])
+        self.assertEqual({row.warehouse: row.quantity for row in catalog.WarehouseInventory.objects(sku='phone')},
+                         {'DEL': 1, 'BLR': 0})
+
+    def test_commit_tells_units_in_no_warehouse(self):
+        reservation_id = str(catalog.block_inventories({'phone': 2}).id)
+        # the warehouse lost track of one of them
+        catalog.WarehouseInventory.objects(sku='phone').update_one(set__quantity=1)
+        reservation = catalog_service.commit_reservation(reservation_id)
+        self.assertEqual(reservation['unallocated'], {'phone': 1})
+        self.assertEqual(catalog.BlockedInventory.objects(reservation=reservation_id).first().unallocated, 1)
+        self.assertEqual(catalog.WarehouseInventory.objects(sku='phone').first().quantity, 0)
+
+    def test_taking_warehouse_stock_leaves_held_units(self):
+        catalog.set_warehouse_inventory('phone', 'BLR', 1)
+        catalog.block_inventories({'phone': 2})
+        with self.assertRaises(NotEnoughInventory):
+            catalog.set_warehouse_inventory('phone', 'DEL', 0)
+        self.assertEqual(catalog.WarehouseInventory.objects(sku='phone', warehouse='DEL').first().quantity, 2)
+        catalog.set_warehouse_inventory('phone', 'DEL', 1)
+        self.assertEqual(catalog.get_inventory_by_id('phone').quantity, 0)
+
+    def test_take_warehouse_stock_of_sharded_sku(self):
+        catalog.set_warehouse_inventory('phone', 'BLR', 5)
+        catalog.shard_inventory('phone', 3)
+        # more than any of the shards holds
+        catalog.set_warehouse_inventory('phone', 'BLR', 0)
+        self.assertEqual(catalog.get_inventory_by_id('phone').quantity, 2)
+        self.assertEqual(catalog.InventoryShard.objects(sku='phone').sum('quantity'), 2)
+        catalog.InventoryShard.objects.delete()
+
+    def test_inventory_made_before_warehouse_stock(self):
+        product = catalog.Product.objects.first()
+        catalog.Inventory(sku='old', product=product, warehouse='BLR', quantity=100, buyer_limit=10).save()
+        catalog.block_inventory('old', 10)
+        # posting the same stock again changes nothing
+        inventory = catalog.create_inventory(sku='old', product_id=str(product.id), warehouse_id='BLR', quantity=100)
+        self.assertEqual(inventory.quantity, 90)
+        self.assertEqual(catalog_service.fetch_warehouse_inventories('old'),
+                         [dict(sku='old', warehouse_id='BLR', quantity=100)])
+
+        catalog.Inventory(sku='older', product=product, warehouse='DEL', quantity=5).save()
+        catalog.set_warehouse_inventory('older', 'BOM', 3)
+        self.assertEqual(catalog.get_inventory_by_id('older').quantity, 8)
+        self.assertEqual(catalog.WarehouseInventory.objects(sku='older', warehouse='DEL').first().quantity, 5)
+
+    def test_create_inventory_keeps_other_warehouses(self):
+        catalog.set_warehouse_inventory('phone', 'BLR', 5)
+        product_id = str(catalog.get_inventory_by_id('phone').product.id)
+        inventory = catalog.create_inventory(sku='phone', product_id=product_id, warehouse_id='BOM', quantity=1)
+        self.assertEqual(inventory.quantity, 8)
+        inventory = catalog.create_inventory(sku='phone', product_id=product_id, warehouse_id='BLR', quantity=2)
+        self.assertEqual(inventory.quantity, 5)
+
+
+class TestBulkInventory(unittest.TestCase):
+    def setUp(self) -> None:
+        catalog_service.create_warehouse(code='WMS1', name='first')
+        self.products = [str(catalog.create_product(title=f'p{i}', price=1, mrp=1, category='c').id) for i in range(3)]
+
+    def tearDown(self) -> None:
+        catalog.Inventory.objects.delete()
+        catalog.InventoryShard.objects.delete()
+        catalog.WarehouseInventory.objects.delete()
+        catalog.Warehouse.objects.delete()
+        catalog.BlockedInventory.objects.delete()
+        catalog._sharded_inventories.invalidate()
+        catalog_service.delete_all_products()
+
+    def row(self, i, **kwargs):
+        return dict(dict(sku=f'sku{i}', product_id=self.products[i], warehouse_id='WMS1', quantity=10), **kwargs)
+
+    def test_upsert_inventories(self):
+        catalog.create_inventory(sku='sku0', product_id=self.products[0], warehouse_id='WMS1', quantity=1)
+        rows = [
+            self.row(0, quantity=5),
+            self.row(1, buyer_limit=3),
+            self.row(2, sku='a', product_id='nope'),
+            self.row(2, sku='b', product_id='5f0000000000000000000000'),
+            self.row(2, sku='c', warehouse_id='XXX'),
+            self.row(2, sku='d', quantity=-1),
+            json.dumps(self.row(2, quantity=7)),
+            '',
+            '{not json',
+        ]
+        with count_queries() as queries:
+            result = catalog_service.upsert_inventories(rows, chunk_size=4)
+        # one $in on products, warehouses, SKUs without warehouse stock, the stock of the warehouses and
+        # sharded SKUs per chunk
+        self.assertEqual(queries, ['product', 'warehouse', 'warehouse_inventory', 'inventory',
+                                   'warehouse_inventory', 'inventory'] * 2)
+
+        self.assertEqual(result['received'], 8)
+        self.assertEqual((result['upserted'], result['modified'], result['failed']), (2, 1, 5))
+        self.assertEqual([error['row'] for error in result['errors']], [2, 3, 4, 5, 8])
+        self.assertEqual(result['errors'][0], dict(row=2, sku='a', message='Invalid product [nope]'))
+        self.assertEqual(result['errors'][2]['message'], 'Unknown warehouse [XXX]')
+        self.assertIn('quantity', result['errors'][3]['message'])
+
+        self.assertEqual(catalog.get_inventory_by_id('sku0').quantity, 5)
+        self.assertEqual(catalog.get_inventory_by_id('sku1').buyer_limit, 3)
+        self.assertEqual(catalog.get_inventory_by_id('sku2').buyer_limit, catalog.Inventory.buyer_limit.default)
+        self.assertEqual(catalog_service.fetch_warehouse_inventories('sku2'),
+                         [dict(sku='sku2', warehouse_id='WMS1', quantity=7)])
+
+    def test_inventory_made_before_warehouse_stock(self):
+        catalog.Inventory(sku='sku0', product=self.products[0], warehouse='WMS1', quantity=50, buyer_limit=10).save()
+        catalog.block_inventory('sku0', 5)
+        # posting the same stock again changes nothing
+        result = catalog_service.upsert_inventories([self.row(0, quantity=50)])
+        self.assertEqual((result['upserted'], result['modified'], result['errors']), (0, 1, []))
+        self.assertEqual(catalog.get_inventory_by_id('sku0').quantity, 45)
+        self.assertEqual(catalog_service.fetch_warehouse_inventories('sku0'),
+                         [dict(sku='sku0', warehouse_id='WMS1', quantity=50)])
+
+    def test_duplicate_sku_last_row_wins(self):
+        result = catalog_service.upsert_inventories([self.row(0), self.row(0, quantity=3)])
+        self.assertEqual(result['upserted'], 1)
+        self.assertEqual([error['row'] for error in result['errors']], [0])
+        self.assertEqual(catalog.get_inventory_by_id('sku0').quantity, 3)
+
+    def test_invalid_later_row_does_not_supersede(self):
+        result = catalog_service.upsert_inventories([self.row(0), self.row(0, quantity=3, warehouse_id='XXX')])
+        self.assertEqual(result['upserted'], 1)
+        self.assertEqual([error['message'] for error in result['errors']], ['Unknown warehouse [XXX]'])
+        self.assertEqual(catalog.get_inventory_by_id('sku0').quantity, 10)
+
+    def test_stock_is_the_sum_of_warehouses(self):
+        catalog_service.create_warehouse(code='WMS2', name='second')
+        catalog.create_inventory(sku='sku0', product_id=self.products[0], warehouse_id='WMS2', quantity=4)
+        catalog.block_inventory('sku0', 3)
+        result = catalog_service.upsert_inventories([self.row(0), self.row(1, quantity=0)])
+        self.assertEqual((result['upserted'], result['modified']), (1, 1))
+        self.assertEqual(catalog.get_inventory_by_id('sku0').quantity, 11)
+
+        catalog_service.upsert_inventories([self.row(0, quantity=0)])
+        self.assertEqual(catalog.get_inventory_by_id('sku0').quantity, 1)
+        # the units held by the buyer stay in the warehouses
+        result = catalog_service.upsert_inventories([self.row(0, warehouse_id='WMS2', quantity=0)])
+        self.assertEqual(result['errors'][0]['message'], 'Less than 4 units of sku0 are not held by buyers')
+        self.assertEqual({row['warehouse_id']: row['quantity'] for row in catalog_service.fetch_warehouse_inventories('sku0')},
+                         {'WMS1': 0, 'WMS2': 4})
+
+    def test_rows_changed_meanwhile_are_left_alone(self):
+        catalog_service.upsert_inventories([self.row(0)])
+        take_stock = catalog._take_stock
+
+        def concurrent_restock(sku, quantity):
+            catalog.WarehouseInventory.objects(sku=sku).update_one(set__quantity=12)
+            return take_stock(sku, quantity)
+
+        with mock.patch.object(catalog, '_take_stock', side_effect=concurrent_restock):
+            result = catalog_service.upsert_inventories([self.row(0, quantity=5)])
+        self.assertEqual(result['errors'][0]['message'], 'The stock of sku0 in WMS1 changed meanwhile')
+        self.assertEqual(catalog.get_inventory_by_id('sku0').quantity, 10)
+        self.assertEqual(catalog.WarehouseInventory.objects(sku='sku0').first().quantity, 12)
+
+    def test_restock_spreads_over_shards(self):
+        catalog_service.upsert_inventories([self.row(0)])
+        catalog.shard_inventory('sku0', 2)
+        catalog_service.upsert_inventories([self.row(0, quantity=14)])
+        self.assertEqual(catalog.get_inventory_by_id('sku0').quantity, 14)
+        self.assertEqual(catalog.Inventory.objects(sku='sku0').first().quantity, 0)
+
+
+class TestBulkProducts(unittest.TestCase):
+    def tearDown(self) -> None:
+        catalog_service.delete_all_products()
+
+    @staticmethod
+    def product(i, **kwargs):
+        return dict(dict(external_id=f'ext{i}', title=f'phone {i}', price=10, mrp=12, category='mobile'), **kwargs)
+
+    def test_ingest_products(self):
+        rows = [
+            self.product(0),
+            self.product(1, price=-1),
+            self.product(2, colour='red'),
+            json.dumps(self.product(3)),
+            self.product(4, title='first'),
+            self.product(4, title='second'),
+            dict(title='no key', price=1, mrp=1, category='mobile'),
+            7,
+        ]
+        with count_queries() as queries:
+            result = catalog_service.ingest_products(rows, chunk_size=3)
+        # reads back the upserted products once per chunk, the last one has none
+        self.assertEqual(queries, ['product'] * 2)
+        self.assertEqual((result['received'], result['inserted'], result['upserted'], result['failed']), (8, 1, 3, 4))
+        self.assertEqual([(error['row'], error['external_id']) for error in result['errors']],
+                         [(1, 'ext1'), (2, 'ext2'), (4, 'ext4'), (7, None)])
+        self.assertIn('price', result['errors'][0]['message'])
+        self.assertEqual(catalog.Product.objects(external_id='ext4').get().title, 'second')
+        self.assertEqual(catalog.Product.objects.count(), 4)
+
+    def test_ingest_is_idempotent_on_external_id(self):
+        catalog_service.ingest_products([self.product(i) for i in range(3)])
+        ids = {p.external_id: p.id for p in catalog.Product.objects}
+
+        result = catalog_service.ingest_products([self.product(0), self.product(1, price=9), self.product(5)])
+        self.assertEqual((result['inserted'], result['upserted'], result['modified']), (0, 1, 1))
+        self.assertEqual(catalog.Product.objects.count(), 4)
+        self.assertEqual(catalog.Product.objects(external_id='ext1').get().price, 9)
+        self.assertEqual({p.external_id: p.id for p in catalog.Product.objects(external_id__ne='ext5')}, ids)
+
+
+class TestProductListing(unittest.TestCase):
+    def setUp(self) -> None:
+        for i in range(5):
+            catalog.create_product(
+                title=f'product {i}',
+                description='a long description',
+                price=10 + i,
+                mrp=20 + i,
+                category='mobile' if i % 2 else 'book',
+                attrs={'color': 'red'},
+                images=[f'img-{i}-0', f'img-{i}-1']
+            )
+        catalog.create_product(title='no image', price=1, mrp=1, category='book')
+
+    def tearDown(self) -> None:
+        catalog_service.delete_all_products()
+
+    def test_as_listing(self):
+        first_page = catalog.get_products_after(size=2)
+        listing = catalog.as_listing(catalog.get_products_after(str(first_page[1].id), 2))
+        self.assertEqual([product['title'] for product in listing], ['product 2', 'product 3'])
+        self.assertEqual(listing[0], dict(
+            id=listing[0]['id'],
+            title='product 2',
+            price=12,
+            category='book',
+            image='img-2-0'
+        ))
+        self.assertEqual(str(catalog.get_product_by_id(listing[0]['id']).id), listing[0]['id'])
+
+    def test_as_listing_by_cat(self):
+        listing = catalog.as_listing(catalog.get_products_after(size=10, cat='book'))
+        self.assertEqual([product['title'] for product in listing], ['product 0', 'product 2', 'product 4', 'no image'])
+        self.assertIsNone(listing[-1]['image'])
+
+    def test_keyset_pagination(self):
+        titles, cursor = [], None
+        for _ in range(3):
+            page = catalog_service.fetch_all_products(cursor, 4)
+            titles.extend(product['title'] for product in page['products'])
+            cursor = page['next']
+            if not cursor:
+                break
+        self.assertIsNone(cursor)
+        self.assertEqual(titles, ['product 0', 'product 1', 'product 2', 'product 3', 'product 4', 'no image'])
+
+    def test_keyset_pagination_by_cat(self):
+        page = catalog_service.fetch_all_products_by_cat('book', None, 2)
+        self.assertEqual([product['title'] for product in page['products']], ['product 0', 'product 2'])
+        page = catalog_service.fetch_all_products_by_cat('book', page['next'], 2)
+        self.assertEqual([product['title'] for product in page['products']], ['product 4', 'no image'])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            catalog_service.fetch_all_products('not-a-cursor', 4)
+
+    def test_export_products(self):
+        chunks = catalog_service.export_products(batch_size=2)
+        self.assertIsInstance(chunks, types.GeneratorType)
+        products = [json.loads(line) for line in ''.join(chunks).splitlines()]
+        self.assertEqual([product['title'] for product in products],
+                         ['product 0', 'product 1', 'product 2', 'product 3', 'product 4', 'no image'])
+        self.assertEqual(products[1], catalog.get_product_by_id(products[1]['id']).as_dict())
+
+    def test_search_products_facets(self):
+        result = catalog_service.search_products(
+            filters=json.dumps({'price__gte': 11}),
+            page='1',
+            size='2',
+            facets='color'
+        )
+        self.assertEqual(result['total'], 4)
+        self.assertEqual([product['title'] for product in result['products']], ['product 3', 'product 4'])
+        self.assertEqual(result['products'][0]['image'], 'img-3-0')
+        self.assertEqual(result['facets']['category'], {'book': 2, 'mobile': 2})
+        self.assertEqual(result['facets']['price'], [dict(min=0, max=500, count=4)])
+        self.assertEqual(result['facets']['attrs'], {'color': {'red': 4}})
+
+    def test_search_products_facets_cover_all_matches(self):
+        catalog.create_product(title='expensive', price=250000, mrp=250000, category='tv')
+        result = catalog_service.search_products(size='1')
+        self.assertEqual(result['total'], 7)
+        self.assertEqual(len(result['products']), 1)
+        self.assertEqual(result['facets']['category'], {'book': 4, 'mobile': 2, 'tv': 1})
+        self.assertEqual(result['facets']['price'], [dict(min=0, max=500, count=6), dict(min=100000, max=None, count=1)])
+
+    def test_price_facet_leaves_out_invalid_prices(self):
+        catalog.create_product(title='refund', price=-5, mrp=1, category='tv')
+        catalog.Product._get_collection().insert_one(dict(title='no price', category='tv'))
+        result = catalog_service.search_products()
+        self.assertEqual(result['total'], 8)
+        self.assertEqual(result['facets']['price'], [dict(min=0, max=500, count=6)])
+
+    def test_search_products_rejects_invalid_attr(self):
+        with self.assertRaises(ValueError):
+            catalog_service.search_products(facets='$where')
+
+    def test_search_results_are_cached(self):
+        first = catalog_service.search_products(filters='{"category": "book", "price__gte": 1}')
+        with mock.patch.object(catalog, 'search_products') as search:
+            second = catalog_service.search_products(filters='{"price__gte":1, "category":"book"}')
+        search.assert_not_called()
+        self.assertIs(first, second)
+        self.assertGreaterEqual(catalog_service.fetch_search_cache_stats()['hits'], 1)
+
+        catalog_service.create_product(title='another book', price=5, mrp=5, category='book')
+        third = catalog_service.search_products(filters='{"category": "book", "price__gte": 1}')
+        self.assertEqual(third['total'], first['total'] + 1)
+
+    def test_compile_filters(self):
+        self.assertEqual(
+            catalog.compile_filters('{"category__in": ["book"], "price__gte": 10, "price__lt": 20.5, '
+                                    '"mrp": 30, "attrs__color": "red"}'),
+            {'category': {'$in': ['book']}, 'price': {'$gte': 10.0, '$lt': 20.5}, 'mrp': 30.0, 'attrs.color': 'red'}
+        )
+        self.assertEqual(catalog.compile_filters(None), {})
+        for filters in ('{"title": "x"}', '{"price__in": [1]}', '{"price": "10"}', '{"category__in": "book"}',
+                        '{"category__in": []}', '{"category": {"$ne": 1}}', '{"attrs__a.b": 1}',
+                        '{"attrs__color": {"$gt": ""}}', '{"attrs__color__in": "red"}', '{"attrs__color\\n": 1}',
+                        '{"price": 1, "price__lt": 2}', '[]', '{'):
+            with self.assertRaises(ValueError, msg=filters):
+                catalog.compile_filters(filters)
+
+    def test_unindexed_filters_are_rejected(self):
+        collection_scan = {'stage': 'FETCH', 'inputStage': {'stage': 'COLLSCAN'}}
+        index_scan = {'stage': 'FETCH', 'filter': {}, 'inputStage': {'stage': 'IXSCAN'}}
+        plans = {'attrs.color': collection_scan, 'category': index_scan}
+
+        def explain(query):
+            return plans['category' if 'category' in query else 'attrs.color']
+
+        with mock.patch.object(catalog, '_explain', side_effect=explain) as explained, \
+                mock.patch.object(catalog, '_filter_plans', catalog.LRUCache()):
+            with self.assertRaises(catalog.UnindexedFilter):
+                catalog_service.search_products(filters='{"attrs__color": "red"}')
+            with self.assertRaises(catalog.UnindexedFilter):
+                catalog_service.search_products(filters='{"attrs__color": "blue"}')
+            result = catalog_service.search_products(filters='{"category": "book", "attrs__color": "red"}')
+            self.assertEqual(result['total'], 3)
+            self.assertEqual(explained.call_count, 2)
+
+            with mock.patch.object(catalog, 'REJECT_UNINDEXED_FILTERS', False), self.assertLogs(level='WARNING'):
+                result = catalog_service.search_products(filters='{"attrs__color": "green"}')
+            self.assertEqual(result['total'], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,34 @@
+import math
+import random
+import unittest
+
+from jetcart import geo
+
+
+class TestNearestIndex(unittest.TestCase):
+    def test_distance(self):
+        self.assertAlmostEqual(geo.distance_km(28.6139, 77.2090, 19.0760, 72.8777), 1148, delta=1)
+        self.assertAlmostEqual(geo.distance_km(0, 179.5, 0, -179.5), 111.2, delta=0.1)
+        self.assertAlmostEqual(geo.distance_km(90, 0, 90, 120), 0, places=6)
+
+    def test_nearest_matches_brute_force(self):
+        rnd = random.Random(7)
+        points = [
+            (i, math.degrees(math.asin(rnd.uniform(-1, 1))), rnd.uniform(-180, 180))
+            for i in range(2000)
+        ]
+        index = geo.NearestIndex(points)
+        self.assertEqual(len(index), 2000)
+        for lat, lng in ((12.97, 77.59), (89.9, 10), (-45, 179.99), (0, -180)):
+            expected = sorted((geo.distance_km(lat, lng, p_lat, p_lng), key) for key, p_lat, p_lng in points)
+            found = list(index.nearest(lat, lng))
+            self.assertEqual([key for _, key in found], [key for _, key in expected])
+            for (distance, _), (expected_distance, _) in zip(found[:20], expected):
+                self.assertAlmostEqual(distance, expected_distance, places=6)
+
+    def test_empty(self):
+        self.assertEqual(list(geo.NearestIndex([]).nearest(0, 0)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import functools
+import glob
+import http.server
+import os
+import threading
+import time
+import unittest
+
+from scrapper import extractor, pipeline
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class FixtureHandler(http.server.SimpleHTTPRequestHandler):
+    extensions_map = {'.html': 'text/html; charset=utf-8'}
+
+    def do_GET(self):
+        self.server.requests.append((self.path, time.monotonic()))
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestScrapePipeline(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            functools.partial(FixtureHandler, directory=FIXTURES)
+        )
+        cls.server.requests = []
+        cls.base_url = 'http://{}:{}'.format(*cls.server.server_address)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self) -> None:
+        self.server.requests.clear()
+        self.batches = []
+
+    def scrape(self, interval=0.0, concurrency=4, batch_size=100):
+        scraper = pipeline.ScrapePipeline(
+            sink=self.batches.append,
+            limiter=pipeline.HostRateLimiter(interval, 0, concurrency),
+            fetch_concurrency=4,
+            parser_workers=2,
+            batch_size=batch_size
+        )
+        return scraper.run([f'{self.base_url}/plp.html'])
+
+    def test_scrapes_plp_into_catalog_products(self):
+        stats = self.scrape()
+        products = sorted((p for batch in self.batches for p in batch), key=lambda p: p['external_id'])
+        self.assertEqual([p['external_id'] for p in products], [f'/pdp/{i}.html' for i in range(1, 5)])
+        self.assertEqual(products[0], dict(
+            external_id='/pdp/1.html',
+            title='Google Pixel 4a (Just Black, 128 GB)',
+            description='A compact phone with a great camera.',
+            category='Mobiles',
+            images=[f'https://rukminim1.flixcart.com/image/832/832/p1-{i}.jpeg' for i in range(4)],
+            price=29999.0,
+            mrp=29999.0
+        ))
+        # the PDP linked twice is fetched once, the missing and broken ones are counted
+        self.assertEqual(len(self.server.requests), 7)
+        self.assertEqual(
+            {key: stats[key] for key in ('plps', 'pdps', 'fetched', 'fetch_failures', 'parsed', 'parse_failures')},
+            dict(plps=1, pdps=6, fetched=5, fetch_failures=1, parsed=4, parse_failures=1)
+        )
+        self.assertEqual((stats['products_sent'], stats['batches']), (4, 1))
+
+    def test_sends_batches(self):
+        stats = self.scrape(batch_size=3)
+        self.assertEqual(sorted(len(batch) for batch in self.batches), [1, 3])
+        self.assertEqual(stats['batches'], 2)
+
+    def test_requests_to_a_host_are_spaced(self):
+        started = time.monotonic()
+        self.scrape(interval=0.05)
+        self.assertEqual(len(self.server.requests), 7)
+        # the server sees the requests with some jitter, the last one starts
+        # at least 6 intervals after the first
+        last = max(started_at for _, started_at in self.server.requests)
+        self.assertGreaterEqual(last - started, 0.05 * 6)
+
+    def test_fetches_concurrently(self):
+        # 6 PDPs taking 0.2s each, never more than two at a time
+        lock = threading.Lock()
+        in_flight = [0]
+        most_in_flight = [0]
+
+        def slow_fetch(url):
+            with lock:
+                in_flight[0] += 1
+                most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+            try:
+                time.sleep(0.2)
+                return pipeline.fetch_text(url)
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+
+        scraper = pipeline.ScrapePipeline(
+            sink=self.batches.append,
+            limiter=pipeline.HostRateLimiter(0, 0, 2),
+            fetch=slow_fetch,
+            parser_workers=1
+        )
+        stats = scraper.run([f'{self.base_url}/plp.html'])
+        self.assertEqual(stats['parsed'], 4)
+        self.assertEqual(most_in_flight[0], 2)
+
+
+class TestParserBackends(unittest.TestCase):
+    def test_backends_extract_the_same(self):
+        pages = {path: open(path, encoding='utf-8').read() for path in glob.glob(os.path.join(FIXTURES, 'pdp', '*.html'))}
+        self.assertGreater(len(pages), 1)
+        expected = {path: self.extract(extractor.FlipkartPDPParser('html5lib'), html) for path, html in pages.items()}
+        plp = open(os.path.join(FIXTURES, 'plp.html'), encoding='utf-8').read()
+        for features in extractor.available_parsers():
+            with self.subTest(features):
+                parser = extractor.FlipkartPDPParser(features)
+                self.assertEqual({path: self.extract(parser, html) for path, html in pages.items()}, expected)
+                self.assertEqual(extractor.FlipkartPLPExtractor(features).extract(plp, 'http://h'),
+                                 extractor.FlipkartPLPExtractor('html5lib').extract(plp, 'http://h'))
+
+    @staticmethod
+    def extract(parser, html):
+        # the broken PDP fails the same way on every backend
+        try:
+            return parser.extract(html)
+        except Exception as err:
+            return type(err).__name__
+
+    def test_pipeline_rejects_missing_backend(self):
+        with self.assertRaises(ValueError):
+            pipeline.ScrapePipeline(sink=list, parser='no-such-parser')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+
+from bson import ObjectId
+from mongoengine import connect
+
+from jetcart.domain import catalog, search
+from jetcart.service import catalog as catalog_service
+
+connect('jetcarttest', host='mongomock://localhost')
+
+
+def product(title, category='mobile', price=100, description='', **attrs):
+    return dict(
+        _id=ObjectId(),
+        title=title,
+        description=description,
+        category=category,
+        price=price,
+        mrp=price,
+        attrs=attrs,
+        images=[f'{title}.jpg']
+    )
+
+
+class TestInvertedIndexSearchBackend(unittest.TestCase):
+    def setUp(self) -> None:
+        self.products = [
+            product('Google Pixel 4a Just Black', color='black'),
+            product('Apple iPhone 12', price=70000, description='the best pixel density', color='white'),
+            product('Pixel case', category='accessory', price=300, color='black'),
+            product('Samsung Galaxy S21', price=60000, color='phantom black'),
+            product('Pixelated poster', category='decor', price=200),
+        ]
+        self.index = search.InvertedIndexSearchBackend.build(self.products)
+
+    def titles(self, result):
+        return [p['title'] for p in result['products']]
+
+    def test_title_matches_rank_first(self):
+        result = self.index.search({}, 'pixel')
+        self.assertEqual(self.titles(result), ['Pixel case', 'Google Pixel 4a Just Black', 'Apple iPhone 12'])
+        self.assertEqual(result['products'][0], catalog.listing_from_son(self.products[2]))
+
+    def test_prefix_matches_last_term(self):
+        self.assertEqual(self.titles(self.index.search({}, 'galax')), ['Samsung Galaxy S21'])
+        self.assertEqual(self.titles(self.index.search({}, 'pixela')), ['Pixelated poster'])
+        self.assertEqual(self.titles(self.index.search({}, 'g')), [])
+
+    def test_filters_and_facets(self):
+        result = self.index.search('{"category__in": ["mobile", "accessory"], "price__lt": 65000}', 'pixel',
+                                   facet_attrs=['color'])
+        self.assertEqual(self.titles(result), ['Pixel case', 'Google Pixel 4a Just Black'])
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(result['facets']['category'], {'accessory': 1, 'mobile': 1})
+        self.assertEqual(result['facets']['price'], [dict(min=0, max=500, count=2)])
+        self.assertEqual(result['facets']['attrs'], {'color': {'black': 2}})
+
+    def test_price_facet_leaves_out_invalid_prices(self):
+        self.assertEqual(search._price_facet([-5, None, 10, 250000]),
+                         [dict(min=0, max=500, count=1), dict(min=100000, max=None, count=1)])
+
+    def test_paging_without_title_keeps_id_order(self):
+        result = self.index.search({'attrs__color': 'black'}, None, page=1, size=1)
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(self.titles(result), ['Pixel case'])
+
+    def test_add_product_updates_incrementally(self):
+        self.index.add_product(product('Nokia 3310 brick', price=2000))
+        self.assertEqual(self.titles(self.index.search({}, 'brick')), ['Nokia 3310 brick'])
+
+        updated = dict(self.products[3], title='Samsung Galaxy Fold')
+        self.index.add_product(updated)
+        self.assertEqual(self.titles(self.index.search({}, 's21')), [])
+        self.assertEqual(self.titles(self.index.search({}, 'fold')), ['Samsung Galaxy Fold'])
+        self.assertEqual(len(self.index), 6)
+
+    def test_clear(self):
+        self.index.clear()
+        self.assertEqual(self.index.search({}, 'pixel')['total'], 0)
+
+
+class TestSearchBackendSelection(unittest.TestCase):
+    def setUp(self) -> None:
+        for i in range(4):
+            catalog.create_product(title=f'phone {i}', price=100 * i, mrp=100 * i, category=f'cat-{i % 2}',
+                                   attrs={'color': 'red'})
+        catalog_service.set_search_backend(catalog_service.build_search_index())
+
+    def tearDown(self) -> None:
+        catalog_service.delete_all_products()
+        catalog_service.set_search_backend(search.MongoTextSearchBackend())
+
+    def test_index_agrees_with_mongo_without_title(self):
+        kwargs = dict(filters='{"price__gte": 100}', page='0', size='2', facets='color')
+        indexed = catalog_service.search_products(**kwargs)
+        catalog_service.set_search_backend(search.MongoTextSearchBackend())
+        self.assertEqual(indexed, catalog_service.search_products(**kwargs))
+
+    def test_created_products_are_searchable(self):
+        catalog_service.create_product(title='brand new tablet', price=1, mrp=1, category='tablet')
+        result = catalog_service.search_products(title='tablet')
+        self.assertEqual([p['title'] for p in result['products']], ['brand new tablet'])
+
+    def test_ingested_products_are_searchable(self):
+        catalog_service.search_products(title='tablet')
+        catalog_service.ingest_products([dict(external_id='t1', title='old tablet', price=1, mrp=1, category='misc')])
+        catalog_service.ingest_products([dict(external_id='t1', title='renamed slate', price=1, mrp=1, category='misc')])
+        self.assertEqual(catalog_service.search_products(title='tablet')['total'], 0)
+        result = catalog_service.search_products(title='slate')
+        self.assertEqual([p['title'] for p in result['products']], ['renamed slate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+from mongoengine import connect
+
+from jetcart.domain import catalog, suggest
+from jetcart.service import catalog as catalog_service
+
+connect('jetcarttest', host='mongomock://localhost')
+
+
+class TestSuggestionIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.index = suggest.SuggestionIndex.build([
+            dict(title='Apple iPhone 12'),
+            dict(title='Apple iPad Air'),
+            dict(title='Apple iPad Pro'),
+            dict(title='iPad cover'),
+            dict(title='Apricot jam, apricot flavour'),
+        ], k=3)
+
+    def test_suggests_most_popular_completions(self):
+        self.assertEqual(self.index.suggest('ip'), ['ipad', 'iphone'])
+        self.assertEqual(self.index.suggest('AP'), ['apple', 'apricot'])
+        self.assertEqual(self.index.suggest('apple  IP'), ['apple ipad', 'apple iphone'])
+        self.assertEqual(self.index.suggest('ip', 1), ['ipad'])
+
+    def test_unknown_or_empty_prefix(self):
+        self.assertEqual(self.index.suggest('xyz'), [])
+        self.assertEqual(self.index.suggest(''), [])
+        self.assertEqual(self.index.suggest(None), [])
+
+    def test_keeps_top_k_as_weights_change(self):
+        for title in ('pixel', 'pine', 'pizza', 'pizza', 'pixel', 'pixel'):
+            self.index.add_title(title)
+        self.assertEqual(self.index.suggest('p'), ['pixel', 'pizza', 'pine'])
+        self.assertEqual(self.index.suggest('pi'), ['pixel', 'pizza', 'pine'])
+
+        self.index.add_title('pipe')
+        self.index.add_title('pipe')
+        self.index.add_title('pipe')
+        self.assertEqual(self.index.suggest('pi'), ['pipe', 'pixel', 'pizza'])
+
+        self.index.record_search('pine pine')
+        self.index.record_search('pine piney')
+        self.index.record_search('pine')
+        self.assertEqual(self.index.suggest('pi'), ['pine', 'pipe', 'pixel'])
+        self.assertEqual(self.index.suggest('piney'), [])
+
+    def test_matches_brute_force(self):
+        titles = [f'item{i % 37} group{i % 5} tag{i * 7 % 11}' for i in range(300)]
+        index = suggest.SuggestionIndex.build((dict(title=title) for title in titles), k=5)
+        weights = {}
+        for title in titles:
+            for token in set(title.split()):
+                weights[token] = weights.get(token, 0) + 1
+        for prefix in ('i', 'it', 'item1', 'g', 'tag', 'tag1'):
+            expected = sorted((-weight, token) for token, weight in weights.items() if token.startswith(prefix))
+            self.assertEqual(index.suggest(prefix), [token for _, token in expected[:5]])
+
+
+class TestSuggestProducts(unittest.TestCase):
+    def setUp(self) -> None:
+        catalog.create_product(title='Samsung Galaxy S21', price=1, mrp=1, category='mobile')
+        catalog.create_product(title='Samsung Galaxy Fold', price=1, mrp=1, category='mobile')
+
+    def tearDown(self) -> None:
+        catalog_service.delete_all_products()
+
+    def test_built_lazily_and_refreshed_on_create(self):
+        self.assertEqual(catalog_service.suggest_products('gal'), ['galaxy'])
+        catalog_service.create_product(title='Galvanized bucket', price=1, mrp=1, category='mobile')
+        self.assertEqual(catalog_service.suggest_products('sams GAL'), ['sams galaxy', 'sams galvanized'])
+        with self.assertRaises(ValueError):
+            catalog_service.suggest_products('gal', 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
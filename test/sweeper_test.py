@@ -0,0 +1,96 @@
+import time
+import unittest
+
+from mongoengine import connect
+
+from jetcart import sweeper
+from jetcart.domain import catalog
+
+connect('jetcarttest', host='mongomock://localhost')
+
+
+class TestInventorySweeper(unittest.TestCase):
+    def setUp(self) -> None:
+        for sku in ('a', 'b'):
+            catalog.Inventory(sku=sku, product='fake', warehouse='fake', quantity=10, buyer_limit=5).save()
+
+    def tearDown(self) -> None:
+        catalog.Inventory.objects.delete()
+        catalog.BlockedInventory.objects.delete()
+        catalog.Lease.objects.delete()
+
+    def _block(self, sku, quantity, expired=True):
+        blocked_inv_id = catalog.block_inventory(sku, quantity)
+        if expired:
+            catalog.BlockedInventory.objects(id=blocked_inv_id).update_one(set__expiry=0)
+        return blocked_inv_id
+
+    def _quantities(self):
+        return {inv.sku: inv.quantity for inv in catalog.Inventory.objects(sku__in=['a', 'b'])}
+
+    def test_release_expired_holds(self):
+        expired = [self._block('a', 2), self._block('a', 1), self._block('b', 3)]
+        live = self._block('b', 1, expired=False)
+        committed = self._block('a', 4, expired=False)
+        catalog.commit_inventory(committed)
+        catalog.BlockedInventory.objects(id=committed).update_one(set__expiry=0)
+
+        self.assertEqual(catalog.release_expired_holds(), dict(holds=3, units=6))
+        self.assertEqual(self._quantities(), {'a': 6, 'b': 9})
+        self.assertEqual(
+            {str(hold.id): hold.state for hold in catalog.BlockedInventory.objects},
+            {
+                **{hold_id: str(catalog.BlockedInventoryState.EXPIRED) for hold_id in expired},
+                live: str(catalog.BlockedInventoryState.BLOCKED),
+                committed: str(catalog.BlockedInventoryState.COMMITTED),
+            }
+        )
+
+        self.assertEqual(catalog.release_expired_holds(), dict(holds=0, units=0))
+        self.assertEqual(self._quantities(), {'a': 6, 'b': 9})
+        with self.assertRaises(catalog.BlockedInventoryExpired):
+            catalog.commit_inventory(expired[0])
+
+    def test_sweep_in_batches(self):
+        for _ in range(5):
+            self._block('a', 1)
+            self._block('b', 2)
+        self.assertEqual(catalog.release_expired_holds(batch_size=4), dict(holds=4, units=6))
+
+        inventory_sweeper = sweeper.InventorySweeper(batch_size=4, interval=60)
+        self.assertEqual(inventory_sweeper.sweep(), dict(holds=6, units=9))
+        self.assertEqual(self._quantities(), {'a': 10, 'b': 10})
+        stats = inventory_sweeper.stats()
+        self.assertEqual((stats['runs'], stats['holds_released'], stats['units_released']), (1, 6, 9))
+
+    def test_one_sweeper_at_a_time(self):
+        self._block('a', 2)
+        first, second = sweeper.InventorySweeper(), sweeper.InventorySweeper()
+        self.assertEqual(first.sweep(), dict(holds=1, units=2))
+        self._block('b', 3)
+        self.assertEqual(second.sweep(), dict(holds=0, units=0))
+        self.assertEqual(second.stats()['skipped'], 1)
+        self.assertEqual(self._quantities(), {'a': 10, 'b': 7})
+
+        # the first one died, its lease runs out
+        catalog.Lease.objects(name=sweeper.SWEEP_LEASE).update_one(set__expires=0)
+        self.assertEqual(second.sweep(), dict(holds=1, units=3))
+        self.assertEqual(first.sweep(), dict(holds=0, units=0))
+        self.assertEqual(self._quantities(), {'a': 10, 'b': 10})
+
+    def test_sweeper_thread(self):
+        self._block('a', 3)
+        inventory_sweeper = sweeper.InventorySweeper(batch_size=10, interval=0.01).start()
+        deadline = time.monotonic() + 5
+        while not inventory_sweeper.stats()['runs'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        inventory_sweeper.stop(timeout=5)
+        stats = inventory_sweeper.stats()
+        self.assertFalse(stats['running'])
+        self.assertGreaterEqual(stats['runs'], 1)
+        self.assertEqual(stats['units_released'], 3)
+        self.assertEqual(self._quantities()['a'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+
+from mongoengine import connect
+
+from jetcart.cache import LRUCache
+from jetcart.domain import tax
+from jetcart.service import tax as service
+from test.cart_test import count_queries
+
+connect('jetcarttest', host='mongomock://localhost')
+
+
+class TestTaxCache(unittest.TestCase):
+    def setUp(self) -> None:
+        service.create_tax(value=9, type='C_GST')
+        service.create_tax(value=9, type='S_GST')
+        service.create_tax_mapping(category='mobile', taxes=['C_GST', 'S_GST'])
+
+    def tearDown(self) -> None:
+        service.delete_all_tax_mappings()
+        service.delete_all()
+
+    def test_fetch_tax_is_read_through(self):
+        with count_queries() as queries:
+            self.assertEqual(service.fetch_tax('C_GST')['value'], 9)
+            self.assertEqual(service.fetch_tax('C_GST')['value'], 9)
+        self.assertEqual(len(queries), 1)
+
+        stats = service.fetch_cache_stats()
+        self.assertGreaterEqual(stats['hits'], 1)
+        self.assertGreaterEqual(stats['misses'], 1)
+
+    def test_writes_invalidate(self):
+        self.assertEqual(service.fetch_tax('C_GST')['value'], 9)
+        service.create_tax(value=12, type='C_GST')
+        self.assertEqual(service.fetch_tax('C_GST')['value'], 12)
+        self.assertEqual(service.fetch_tax_by_category('mobile')[0]['value'], 12)
+
+        service.create_tax(value=5, type='VAT')
+        service.create_tax_mapping(category='mobile', taxes=['VAT'])
+        self.assertEqual(service.fetch_tax_by_category('mobile'), [dict(id='VAT', value=5, type='VAT')])
+
+        service.delete_all_tax_mappings()
+        with self.assertRaises(ValueError):
+            service.fetch_tax_by_category('mobile')
+
+    def test_category_taxes_are_cached(self):
+        service.fetch_tax_by_category('mobile')
+        with count_queries() as queries:
+            taxes = service.fetch_tax_by_category('mobile')
+        self.assertEqual(queries, [])
+        self.assertEqual([t['type'] for t in taxes], ['C_GST', 'S_GST'])
+
+    def test_unknown_category_reloads_rate_table_once(self):
+        service.fetch_tax_rate_table()
+        # mapped behind the cache's back, as another process would
+        tax.create_tax_mapping('book', tax_types=['S_GST'])
+        self.assertEqual(service.fetch_category_taxes(['book']), {'book': service.CategoryTax(rate=9, type='S_GST')})
+        with count_queries() as queries:
+            service.fetch_category_taxes(['book'])
+            with self.assertRaises(ValueError):
+                service.fetch_category_taxes(['book', 'toy'])
+        self.assertEqual(queries, ['tax', 'tax_mapping'])
+
+    def test_rate_table(self):
+        service.create_tax_mapping(category='book', taxes=['S_GST'])
+        table = service.fetch_tax_rate_table()
+        self.assertEqual(table['mobile'], service.CategoryTax(rate=18, type='C_GST,S_GST'))
+        self.assertEqual(table['book'], service.CategoryTax(rate=9, type='S_GST'))
+        with self.assertRaises(TypeError):
+            table['book'] = service.NO_TAX
+
+        service.create_tax_mapping(category='book', taxes=['C_GST', 'S_GST'])
+        self.assertEqual(service.fetch_tax_rate_table()['book'].rate, 18)
+        self.assertEqual(table['book'].rate, 9)
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 0
+        self.cache = LRUCache(maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_entries_expire(self):
+        self.cache.put('a', 1)
+        self.now = 11
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_stale_loads_are_dropped(self):
+        generation = self.cache.generation
+        self.cache.invalidate()
+        self.cache.put('a', 1, generation)
+        self.assertIsNone(self.cache.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
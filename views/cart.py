@@ -23,6 +23,11 @@ def get_cart(cart_id: str):
     return jsonify(), 405
 
 
+@blueprint.route('/v1/cart/<cart_id>/item/<sku>', methods=['PUT'])
+def update_cart_item(cart_id: str, sku: str):
+    return jsonify(**service.update_item(cart_id, sku, **request.get_json()))
+
+
 @blueprint.route('/v1/cart/<cart_id>/checkout', methods=['POST'])
 def checkout_cart(cart_id: str):
     order = service.checkout(cart_id)
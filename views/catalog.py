@@ -1,5 +1,7 @@
+from marshmallow import ValidationError
+
 from jetcart.service import catalog as service
-from flask import request, jsonify, Blueprint
+from flask import request, jsonify, Blueprint, Response, stream_with_context
 
 blueprint = Blueprint('catalog', __name__)
 
@@ -10,22 +12,59 @@ def create_product():
         product_data = service.create_product(**request.get_json())
         return jsonify(**product_data)
     elif request.method == 'GET':
-        products_data = service.fetch_all_products(
-            int(request.args.get('page', 0)),
-            int(request.args.get('size', 10))
-        )
-        return jsonify(products_data)
+        size = int(request.args.get('size', 10))
+        cursor = request.args.get('cursor')
+        if request.args.get('category'):
+            products_data = service.fetch_all_products_by_cat(request.args['category'], cursor, size)
+        else:
+            products_data = service.fetch_all_products(cursor, size)
+        return jsonify(**products_data)
     elif request.method == 'DELETE':
         service.delete_all_products()
         return jsonify(), 200
 
 
+@blueprint.route('/product/export', methods=['GET'])
+def export_products():
+    return Response(
+        stream_with_context(service.export_products()),
+        mimetype='application/x-ndjson'
+    )
+
+
+@blueprint.route('/product/bulk', methods=['POST'])
+def ingest_products():
+    rows = _bulk_rows()
+    if rows is None:
+        return jsonify(message="Expected a JSON array or NDJSON of products"), 400
+    return jsonify(**service.ingest_products(rows))
+
+
+def _bulk_rows():
+    """The rows of a bulk request, streamed if sent as NDJSON"""
+    if request.mimetype == 'application/x-ndjson':
+        return (line.decode() for line in request.stream)
+    rows = request.get_json()
+    return rows if isinstance(rows, list) else None
+
+
 @blueprint.route('/product/search', methods=['GET'])
 def search_products():
     products_data = service.search_products(**request.args)
     return jsonify(products_data), 200
 
 
+@blueprint.route('/product/suggest', methods=['GET'])
+def suggest_products():
+    suggestions = service.suggest_products(request.args.get('q'), int(request.args.get('size', service.MAX_SUGGESTIONS)))
+    return jsonify(suggestions=suggestions)
+
+
+@blueprint.route('/product/search/cache', methods=['GET'])
+def search_cache_stats():
+    return jsonify(**service.fetch_search_cache_stats())
+
+
 @blueprint.route('/product/<product_id>')
 def fetch_product(product_id):
     product_data = service.fetch_product(product_id)
@@ -51,7 +90,97 @@ def create_inventory():
     return jsonify(**inv)
 
 
+@blueprint.route('/v1/inventory/bulk', methods=['POST'])
+def upsert_inventories():
+    rows = _bulk_rows()
+    if rows is None:
+        return jsonify(message="Expected a JSON array or NDJSON of inventory rows"), 400
+    return jsonify(**service.upsert_inventories(rows))
+
+
+@blueprint.route('/v1/inventory/sweeper', methods=['GET'])
+def inventory_sweeper_stats():
+    return jsonify(**service.fetch_inventory_sweeper_stats())
+
+
+@blueprint.route('/v1/postal_code', methods=['POST'])
+def create_postal_code():
+    return jsonify(**service.create_postal_code(**request.get_json()))
+
+
+@blueprint.route('/v1/inventory/<sku>/warehouse', methods=['GET'])
+def fetch_warehouse_inventories(sku: str):
+    return jsonify(inventories=service.fetch_warehouse_inventories(sku))
+
+
+@blueprint.route('/v1/inventory/<sku>/warehouse/<warehouse_id>', methods=['PUT'])
+def set_warehouse_inventory(sku: str, warehouse_id: str):
+    return jsonify(**service.set_warehouse_inventory(sku, warehouse_id, request.get_json()['quantity']))
+
+
+@blueprint.route('/v1/inventory/<sku>/fulfilment', methods=['GET'])
+def select_fulfilment(sku: str):
+    warehouses = service.select_fulfilment(
+        sku,
+        request.args.get('quantity', 1),
+        request.args.get('lat'),
+        request.args.get('lng'),
+        request.args.get('postal_code')
+    )
+    return jsonify(warehouses=warehouses)
+
+
+@blueprint.route('/v1/inventory/rebalance', methods=['POST'])
+def rebalance_inventories():
+    return jsonify(**service.rebalance_inventories())
+
+
+@blueprint.route('/v1/inventory/<sku>/shards', methods=['PUT'])
+def shard_inventory(sku: str):
+    return jsonify(**service.shard_inventory(sku, request.get_json()['shards']))
+
+
 @blueprint.route('/v1/inventory/<sku>')
 def fetch_inventory(sku: str):
     inv = service.fetch_inventory(sku)
     return jsonify(**inv)
+
+
+@blueprint.route('/v1/reservation', methods=['POST'])
+def create_reservation():
+    reservation = service.reserve_inventory(request.get_json().get('items'))
+    return jsonify(**reservation)
+
+
+@blueprint.route('/v1/reservation/<reservation_id>')
+def fetch_reservation(reservation_id: str):
+    reservation = service.fetch_reservation(reservation_id)
+    if reservation:
+        return jsonify(**reservation)
+    return jsonify(message=f"Unknown reservation ID [{reservation_id}]"), 404
+
+
+@blueprint.route('/v1/reservation/<reservation_id>/commit', methods=['POST'])
+def commit_reservation(reservation_id: str):
+    delivery = request.get_json(silent=True) or {}
+    reservation = service.commit_reservation(
+        reservation_id,
+        delivery.get('lat'),
+        delivery.get('lng'),
+        delivery.get('postal_code')
+    )
+    return jsonify(**reservation)
+
+
+@blueprint.route('/v1/reservation/<reservation_id>/release', methods=['POST'])
+def release_reservation(reservation_id: str):
+    return jsonify(**service.release_reservation(reservation_id))
+
+
+@blueprint.errorhandler(Exception)
+def error_handler(error):
+    if isinstance(error, ValidationError):
+        return jsonify(message=error.messages), getattr(error, 'status_code', 500)
+    elif isinstance(error, ValueError):
+        return jsonify(message=str(error)), 400
+    return jsonify(message=str(error)), getattr(error, 'status_code', 500)
@@ -25,13 +25,26 @@ def fetch_tax(tax_type: str):
     return jsonify(**tax)
 
 
-@blueprint.route('/tax/mapping', methods=['POST', 'GET'])
+@blueprint.route('/tax/mapping', methods=['POST', 'GET', 'DELETE'])
 def crud_tax_mapping():
     if request.method == 'POST':
         mapping = service.create_tax_mapping(**request.get_json())
         return jsonify(**mapping)
     elif request.method == 'GET':
         return jsonify(service.fetch_all_tax_mappings())
+    elif request.method == 'DELETE':
+        service.delete_all_tax_mappings()
+        return jsonify()
+    return jsonify(), 405
+
+
+@blueprint.route('/tax/cache', methods=['GET', 'DELETE'])
+def tax_cache():
+    if request.method == 'GET':
+        return jsonify(**service.fetch_cache_stats())
+    elif request.method == 'DELETE':
+        service.invalidate_cache()
+        return jsonify()
     return jsonify(), 405
 
 